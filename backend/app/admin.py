@@ -0,0 +1,166 @@
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Optional
+import logging
+import os
+
+from app import schemas
+from app.auth import require_admin
+from app.profiler import profiler
+from app import memory, query_stats, bulk_import, user_listing, tracing
+from app.login_guard import failed_logins
+from app.audit import audit_log
+from app.scheduler import scheduler
+from app.database import get_db, get_primary_db
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+IMPORT_REPORT_DIR = os.getenv("IMPORT_REPORT_DIR", "/tmp/dreamapp-imports")
+
+# Every admin endpoint acts on the worker that happens to serve the request
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+@router.get("/profiler")
+async def profiler_status():
+    """Report this worker's profiler state."""
+    return profiler.status()
+
+@router.post("/profiler/start")
+async def start_profiler(options: schemas.ProfilerStart):
+    """Start sampling this worker; it stops by itself after the requested duration."""
+    try:
+        profiler.start(rate_hz=options.rate_hz, duration=options.duration_seconds, mode=options.mode)
+    except (RuntimeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return profiler.status()
+
+@router.post("/profiler/stop")
+async def stop_profiler():
+    """Stop sampling and write the collapsed stacks file."""
+    profiler.stop()
+    return profiler.status()
+
+@router.get("/profiler/output", response_class=PlainTextResponse)
+async def profiler_output():
+    """Download the last collapsed stacks file written by this worker."""
+    if not profiler.last_output:
+        raise HTTPException(status_code=404, detail="No profile has been recorded in this worker")
+    with open(profiler.last_output) as f:
+        return f.read()
+
+@router.get("/memory")
+async def memory_report():
+    """Report this worker's RSS, GC statistics and recycle policy state."""
+    return memory.report()
+
+@router.post("/memory/tracemalloc/start")
+async def start_tracemalloc(options: schemas.TracemallocStart):
+    """Start tracing allocations; tracing slows allocation, so stop it when done."""
+    memory.allocations.start(frames=options.frames)
+    return memory.report()
+
+@router.post("/memory/tracemalloc/stop")
+async def stop_tracemalloc():
+    memory.allocations.stop()
+    return memory.report()
+
+@router.get("/memory/allocations")
+async def allocation_growth(limit: int = 20):
+    """Top allocation sites, as growth since the previous call once a baseline exists."""
+    if not memory.allocations.tracing:
+        raise HTTPException(status_code=400, detail="tracemalloc is not running in this worker")
+    return {"pid": memory.report()["pid"], "sites": memory.allocations.top_growth(limit=min(limit, 100))}
+
+@router.get("/queries")
+async def query_report():
+    """SQL statements and time per route in this worker, with budgets and slow query count."""
+    return query_stats.snapshot()
+
+@router.get("/tracing")
+async def tracing_status():
+    """This worker's trace sampling: traces seen, kept by reason, exported and dropped."""
+    return tracing.exporter.status()
+
+@router.get("/audit")
+async def audit_status():
+    """This worker's audit buffer: events waiting, written, spilled to disk and dropped."""
+    return audit_log.status()
+
+@router.get("/scheduler")
+async def scheduler_status():
+    """Whether this worker is the scheduler leader, and its job run metrics."""
+    return scheduler.status()
+
+@router.get("/login-failures")
+async def login_failure_report():
+    """Accounts with recent failed logins and how many are locked (shared by all workers)."""
+    return failed_logins.stats()
+
+@router.post("/users/import")
+async def import_users(
+    file: UploadFile = File(...),
+    batch_size: int = bulk_import.DEFAULT_BATCH_SIZE,
+    hash_workers: int = bulk_import.DEFAULT_HASH_WORKERS,
+    db: Session = Depends(get_primary_db)
+):
+    """
+    Bulk-import users from a CSV or NDJSON upload.
+
+    Rows need email, username and either password or a bcrypt hashed_password.
+    Skipped rows are listed in the report file named in the response.
+    """
+    fmt = bulk_import.detect_format(file.filename or "")
+    os.makedirs(IMPORT_REPORT_DIR, exist_ok=True)
+    report_path = os.path.join(IMPORT_REPORT_DIR, f"import-{datetime.utcnow():%Y%m%d-%H%M%S}-{os.getpid()}.csv")
+    result = await run_in_threadpool(
+        bulk_import.import_users_from_binary, db, file.file, fmt, report_path,
+        batch_size=batch_size, hash_workers=max(1, hash_workers)
+    )
+    return result.as_dict()
+
+@router.get("/users")
+def list_users(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Page through users ordered by creation time.
+
+    Pass the returned next_cursor to get the following page; fields is a comma separated column list.
+    """
+    try:
+        columns = user_listing.parse_columns(fields)
+        return user_listing.list_users(db, columns, limit=limit, cursor=cursor, role=role, is_active=is_active)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/users/export")
+def export_users(
+    format: str = "ndjson",
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    fields: Optional[str] = None
+):
+    """Stream every matching user as NDJSON or CSV without loading the table into memory."""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    try:
+        columns = user_listing.parse_columns(fields)
+        chunks = user_listing.export_users(columns, fmt=format, role=role, is_active=is_active)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except user_listing.ExportBusy as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"users-{datetime.utcnow():%Y%m%d-%H%M%S}.{format}"
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
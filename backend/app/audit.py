@@ -0,0 +1,289 @@
+"""
+Buffered audit event log.
+
+Routes call ``record()``, which only appends a tuple to an in-process ring
+buffer. A background thread in each worker drains the buffer and inserts the
+events with one executemany per batch, whenever a batch fills up or every
+``AUDIT_FLUSH_SECONDS``. If the database can't keep up, batches are spilled
+to a local NDJSON file and replayed once inserts succeed again; if even the
+buffer fills, the oldest events are dropped and counted.
+
+Events go to one table per UTC day (``audit_events_YYYYMMDD``), so retention
+is a DROP TABLE of whole days instead of a large DELETE, run hourly by the
+scheduler leader (app/maintenance.py).
+"""
+import collections
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from fastapi import Request
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, String, Table, inspect
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 200))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 2))
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", 90))
+AUDIT_SPILL_DIR = os.getenv("AUDIT_SPILL_DIR", "/tmp/dreamapp-audit")
+AUDIT_SPILL_MAX_MB = float(os.getenv("AUDIT_SPILL_MAX_MB", 50))
+
+TABLE_PREFIX = "audit_events_"
+# How often the scheduler leader drops expired tables
+RETENTION_CHECK_SECONDS = 3600
+
+# occurred_at, event, user_id, subject, ip, success, detail
+Event = Tuple[datetime, str, Optional[str], Optional[str], Optional[str], bool, Optional[str]]
+FIELDS = ("occurred_at", "event", "user_id", "subject", "ip", "success", "detail")
+
+_metadata = MetaData()
+
+
+def table_for(day) -> Table:
+    """The table holding one UTC day's events."""
+    name = f"{TABLE_PREFIX}{day:%Y%m%d}"
+    if f"dbo.{name}" in _metadata.tables:
+        return _metadata.tables[f"dbo.{name}"]
+    return Table(
+        name, _metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("occurred_at", DateTime, nullable=False),
+        Column("event", String(40), nullable=False),
+        Column("user_id", String(36), nullable=True),
+        Column("subject", String(255), nullable=True),
+        Column("ip", String(45), nullable=True),
+        Column("success", Boolean, nullable=False),
+        Column("detail", String(255), nullable=True),
+        schema="dbo",
+    )
+
+
+class AuditLog:
+    def __init__(self, buffer_size: int = AUDIT_BUFFER_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_interval: float = AUDIT_FLUSH_SECONDS):
+        # deque appends and pops are atomic, so request threads never take a lock here
+        self._buffer: Deque[Event] = collections.deque(maxlen=buffer_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._created_tables = set()
+        self._spill_offsets: Dict[str, int] = {}
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.last_error: Optional[str] = None
+
+    def record(self, event: Event) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            # The deque discards the oldest event to make room
+            self.dropped += 1
+        self._buffer.append(event)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    # Flushing
+
+    def _drain(self) -> List[Event]:
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _insert(self, events: List[Event]) -> None:
+        """Insert events in a single transaction, one executemany per day table."""
+        by_day: Dict[Any, List[Dict[str, Any]]] = collections.defaultdict(list)
+        for event in events:
+            by_day[event[0].date()].append(dict(zip(FIELDS, event)))
+        with engine.begin() as conn:
+            for day, rows in by_day.items():
+                table = table_for(day)
+                if table.name not in self._created_tables:
+                    table.create(conn, checkfirst=True)
+                    self._created_tables.add(table.name)
+                conn.execute(table.insert(), rows)
+
+    def flush(self) -> int:
+        """Write out everything buffered; returns the number of events written."""
+        total = 0
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            try:
+                self._insert(batch)
+                total += len(batch)
+                self.written += len(batch)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = type(e).__name__
+                # Move everything buffered to disk instead of retrying against a struggling database
+                while batch:
+                    self._spill(batch)
+                    batch = self._drain()
+                logger.error(f"Audit flush failed, buffered events spilled to disk: {e}")
+                return total
+        # Checked every tick, not only after new events, so a quiet worker still drains its spill;
+        # the replay's first insert tells whether the database is back
+        if self._spill_files():
+            self._replay_spill()
+        return total
+
+    # Spill file
+
+    def _spill_path(self) -> str:
+        return os.path.join(AUDIT_SPILL_DIR, f"spill-{os.getpid()}.ndjson")
+
+    def _spill(self, events: List[Event]) -> None:
+        path = self._spill_path()
+        try:
+            os.makedirs(AUDIT_SPILL_DIR, exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > AUDIT_SPILL_MAX_MB * 1048576:
+                self.dropped += len(events)
+                logger.error(f"Audit spill file {path} is full, dropping {len(events)} events")
+                return
+            with open(path, "a") as f:
+                for event in events:
+                    f.write(json.dumps([event[0].isoformat(), *event[1:]]) + "\n")
+            self.spilled += len(events)
+        except OSError as e:
+            self.dropped += len(events)
+            logger.error(f"Could not spill audit events: {e}")
+
+    def _adopt_orphaned_spills(self) -> None:
+        """Take over spill files left by workers that have exited."""
+        for n, path in enumerate(glob.glob(os.path.join(AUDIT_SPILL_DIR, "spill-*.ndjson"))):
+            try:
+                pid = int(os.path.basename(path)[len("spill-"):].split(".")[0].split("-")[0])
+                if pid == os.getpid():
+                    continue
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                adopted = os.path.join(AUDIT_SPILL_DIR, f"spill-{os.getpid()}-{int(time.time())}-{n}.ndjson")
+                try:
+                    # Only one worker wins the rename
+                    os.rename(path, adopted)
+                    logger.info(f"Adopted audit spill file {path}")
+                except OSError:
+                    pass
+            except (ValueError, PermissionError):
+                continue
+
+    def _spill_files(self) -> List[str]:
+        """This worker's spill files: its own and the ones it adopted."""
+        own = glob.glob(os.path.join(AUDIT_SPILL_DIR, f"spill-{os.getpid()}-*.ndjson"))
+        current = self._spill_path()
+        if os.path.exists(current):
+            own.append(current)
+        return sorted(own)
+
+    def _replay_spill(self) -> None:
+        """Insert spilled events once the database is accepting writes again (at least once)."""
+        for path in self._spill_files():
+            offset = self._spill_offsets.get(path, 0)
+            try:
+                with open(path) as f:
+                    f.seek(offset)
+                    while True:
+                        lines = [line for line in (f.readline() for _ in range(self.batch_size)) if line]
+                        if not lines:
+                            break
+                        events = []
+                        for line in lines:
+                            values = json.loads(line)
+                            events.append((datetime.fromisoformat(values[0]), *values[1:]))
+                        self._insert(events)
+                        self.written += len(events)
+                        self._spill_offsets[path] = offset = f.tell()
+                os.remove(path)
+                self._spill_offsets.pop(path, None)
+                logger.info(f"Replayed audit spill file {path}")
+            except Exception as e:
+                logger.error(f"Audit spill replay stopped at byte {offset} of {path}: {e}")
+                return
+
+    # Retention
+
+    def drop_expired_tables(self, now: Optional[datetime] = None) -> List[str]:
+        cutoff = f"{TABLE_PREFIX}{(now or datetime.utcnow()) - timedelta(days=AUDIT_RETENTION_DAYS):%Y%m%d}"
+        # The inspector doesn't apply the SQLite schema_translate_map
+        schema = None if engine.dialect.name == "sqlite" else "dbo"
+        dropped = []
+        for name in inspect(engine).get_table_names(schema=schema):
+            if name.startswith(TABLE_PREFIX) and name < cutoff:
+                try:
+                    table_for(datetime.strptime(name[len(TABLE_PREFIX):], "%Y%m%d")).drop(engine, checkfirst=True)
+                    dropped.append(name)
+                except Exception as e:
+                    # Another worker may have dropped it first
+                    logger.debug(f"Could not drop {name}: {e}")
+        if dropped:
+            logger.info(f"Dropped expired audit tables: {', '.join(dropped)}")
+        return dropped
+
+    def _loop(self):
+        self._adopt_orphaned_spills()
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="audit-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Stop the flusher after a last flush of whatever is buffered."""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+        }
+
+
+audit_log = AuditLog()
+
+
+def record(
+    event: str,
+    request: Optional[Request] = None,
+    user_id: Optional[str] = None,
+    subject: Optional[str] = None,
+    success: bool = True,
+    detail: Optional[str] = None,
+) -> None:
+    """Queue an audit event; never blocks on the database."""
+    ip = request.client.host if request is not None and request.client else None
+    audit_log.record((
+        datetime.utcnow(),
+        event,
+        str(user_id) if user_id is not None else None,
+        subject[:255] if subject else subject,
+        ip,
+        success,
+        detail[:255] if detail else detail,
+    ))
@@ -1,30 +1,104 @@
 from fastapi import APIRouter, Depends, HTTPException, Response, Request, status, BackgroundTasks, Cookie
 from slowapi import Limiter
 from slowapi.util import get_remote_address
+from limits.storage import storage_from_string
+import asyncio
 import secrets
 import logging
+import uuid
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 limiter = Limiter(key_func=get_remote_address)
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timedelta
-from app import schemas, models, utils
-from app.database import get_db
-from app.email_service import send_verification_email, send_password_reset_email
+from app import schemas, models, utils, revocation, deadlines, audit, resilience, sharding, responses, introspection, capture
+from app.login_guard import failed_logins
+from app.database import get_db, get_primary_db
+from app.email_service import send_verification_email, send_password_reset_email, enqueue_email
 from jose import JWTError
 from typing import Optional
 import os
 
-router = APIRouter()
+router = APIRouter(default_response_class=responses.FastJSONResponse)
+
+# Bearer access tokens are optional on most routes, so don't auto-reject
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+def reset_limiter_storage(rate_limiter: Limiter) -> None:
+    """Give a slowapi limiter new, empty counter storage, e.g. in a freshly forked worker."""
+    # The in-memory storage starts an expiry Timer thread and takes a per-key RLock;
+    # neither survives fork, and a lock the master's timer held would stay held.
+    # slowapi has no public hook for this, so swap its storage and strategy.
+    rate_limiter._storage = storage_from_string(rate_limiter._storage_uri or "memory://", **rate_limiter._storage_options)
+    rate_limiter._limiter = type(rate_limiter._limiter)(rate_limiter._storage)
+
+def verify_access_token(token: str) -> dict:
+    """Verify an access token's signature, type and revocation state without touching the database."""
+    try:
+        payload = utils.verify_token(token, "access")
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid access token")
+    if revocation.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return payload
+
+def issue_tokens(user: models.User) -> tuple:
+    """Create an access/refresh token pair bound to the user's current token version."""
+    claims = {"sub": str(user.id), "token_version": user.token_version or 0}
+    shard = sharding.shard_of(user)
+    if shard is not None:
+        # Lets later lookups of this user go straight to their shard
+        claims["shard"] = shard
+    # Identity claims let authenticated routes skip the user lookup entirely
+    access_claims = dict(claims, username=user.username, role=user.role or "user")
+    return utils.create_access_token(access_claims), utils.create_refresh_token(claims)
+
+def get_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> schemas.CurrentUser:
+    """Authenticate the request from its bearer token alone; no database access."""
+    if not token:
+        raise HTTPException(
+            status_code=401,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    payload = verify_access_token(token)
+    # The token is signed by us, so skip re-validating the claims
+    return schemas.CurrentUser.model_construct(
+        id=payload["sub"],
+        username=payload.get("username"),
+        role=payload.get("role", "user"),
+        shard=payload.get("shard")
+    )
+
+def require_admin(current_user: schemas.CurrentUser = Depends(get_current_user)) -> schemas.CurrentUser:
+    """Allow only users whose token carries the admin role."""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return current_user
+
+def get_current_user_model(
+    current_user: schemas.CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_primary_db)
+) -> models.User:
+    """Load the full user row for routes that need more than the token claims."""
+    # Primary key lookup goes through the session identity map, so repeated
+    # loads within a request don't hit the database again
+    user = resilience.retry_read(db, lambda: sharding.get_user(db, current_user.id, current_user.shard))
+    if not user or not user.is_active:
+        raise HTTPException(status_code=401, detail="Invalid access token")
+    return user
 
 @router.get("/ping")
 def ping():
     """Simple endpoint to test if the API is working"""
     logger.info("Ping endpoint called")
-    return {"status": "ok", "message": "API is working"}
+    return responses.PING()
 
 @router.post("/test-register")
 def test_register(user: schemas.UserCreate):
@@ -37,6 +111,41 @@ def test_register(user: schemas.UserCreate):
         "role": "user"
     }
 
+EMAIL_TAKEN = "Email already registered"
+USERNAME_TAKEN = "Username already taken"
+
+def _find_registration_conflict(db: Session, user: schemas.UserCreate) -> Optional[str]:
+    """One query for both uniqueness checks; the email message wins, as it always has."""
+    rows = db.query(
+        case((models.User.email == user.email, 1), else_=0).label("email_taken")
+    ).filter(
+        or_(models.User.email == user.email, models.User.username == user.username)
+    ).limit(2).all()
+    if any(row.email_taken for row in rows):
+        return EMAIL_TAKEN
+    return USERNAME_TAKEN if rows else None
+
+def _insert_user(db: Session, new_user: models.User) -> None:
+    db.add(new_user)
+    db.commit()
+
+def _insert_conflict(db: Session, user: schemas.UserCreate, error: IntegrityError) -> str:
+    """Map a unique violation on insert (a registration racing this one) to the usual 400 message."""
+    db.rollback()
+    conflict = _find_registration_conflict(db, user)
+    if conflict:
+        return conflict
+    # Not visible to a query, e.g. a directory entry left by a failed cross-shard commit
+    message = str(error.orig).lower()
+    if user.username.lower() in message and user.email.lower() not in message:
+        return USERNAME_TAKEN
+    return EMAIL_TAKEN
+
+def _abandon(task: asyncio.Future) -> None:
+    # Drops the bcrypt job if it hasn't started, and keeps a failed one from logging as unretrieved
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
 @router.post("/register", response_model=schemas.UserOut)
 @limiter.limit("5/minute")
 async def register(
@@ -51,38 +160,44 @@ async def register(
         # Add timeout handling for database operations
         import time
         start_time = time.time()
-        
-        # Check if email already exists - with simplified logic
-        user_exists = False
+
+        # Hash the password off the event loop while the database checks for duplicates,
+        # so registration takes about max(hash, query) rather than the sum
+        hashing = asyncio.ensure_future(deadlines.run_hashing_async(utils.hash_password, user.password))
         try:
-            existing_email = db.query(models.User).filter(models.User.email == user.email).first()
-            if existing_email:
-                logger.info(f"Email {user.email} already exists")
-                raise HTTPException(status_code=400, detail="Email already registered")
-            
-            # Check if username already exists
-            existing_username = db.query(models.User).filter(models.User.username == user.username).first()
-            if existing_username:
-                logger.info(f"Username {user.username} already exists")
-                raise HTTPException(status_code=400, detail="Username already taken")
+            conflict = await run_in_threadpool(_find_registration_conflict, db, user)
         except Exception as db_error:
+            _abandon(hashing)
+            if isinstance(db_error, deadlines.DeadlineExceeded):
+                raise
             logger.error(f"Database error during user check: {db_error}")
             raise HTTPException(status_code=500, detail="Error checking user availability")
-            
+        if conflict:
+            _abandon(hashing)
+            logger.info(f"Registration rejected for {user.email} / {user.username}: {conflict}")
+            raise HTTPException(status_code=400, detail=conflict)
+
         # Log database query time
         logger.info(f"Database query time: {time.time() - start_time:.2f} seconds")
 
-        # Hash the password
-        hashed_pw = utils.hash_password(user.password)
+        hashed_pw = await hashing
         
         # Generate email verification token
         verification_token, token_expires = utils.create_verification_token({"email": user.email})
         
-        # Create new user
+        # Every column is set here, so nothing has to be read back after the commit
+        user_id = str(uuid.uuid4())
+        now = datetime.utcnow()
         new_user = models.User(
+            id=user_id,
             email=user.email,
             username=user.username,
-            hashed_password=hashed_pw
+            hashed_password=hashed_pw,
+            token_version=0,
+            is_active=True,
+            role="user",
+            created_at=now,
+            updated_at=now
         )
         
         # Set email verification info using our new method
@@ -91,12 +206,15 @@ async def register(
             expires_at=token_expires
         )
         
-        # Add to database
+        # Add to database; the unique constraints catch registrations that raced the check
         db_start = time.time()
         logger.info("Adding user to database...")
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        try:
+            await run_in_threadpool(_insert_user, db, new_user)
+        except IntegrityError as integrity_error:
+            conflict = await run_in_threadpool(_insert_conflict, db, user, integrity_error)
+            logger.info(f"Registration lost a race for {user.email} / {user.username}: {conflict}")
+            raise HTTPException(status_code=400, detail=conflict)
         logger.info(f"Database save time: {time.time() - db_start:.2f} seconds")
         
         # Send verification email in the background
@@ -107,7 +225,8 @@ async def register(
                 if os.getenv("WEBSITE_SITE_NAME"):
                     logger.info(f"Email would be sent to {user.email} with token {verification_token[:10]}...")
                 else:
-                    background_tasks.add_task(
+                    enqueue_email(
+                        background_tasks,
                         send_verification_email,
                         user.email,
                         verification_token
@@ -116,8 +235,16 @@ async def register(
             logger.error(f"Failed to send verification email: {str(email_error)}")
             # Don't raise error here, just log it
         
-        logger.info(f"User registered successfully: {new_user.id}")
-        return new_user
+        audit.record("register", request, user_id=user_id, subject=user.username)
+        capture.identify(request, user_id=user_id)
+        logger.info(f"User registered successfully: {user_id}")
+        # Every field comes from the validated request or was generated above
+        return responses.model_response(schemas.UserOut.model_construct(
+            id=user_id, email=user.email, username=user.username, role="user"
+        ))
+    except deadlines.DeadlineExceeded:
+        # main.py answers 504 and logs it as a warning
+        raise
     except Exception as e:
         logger.error(f"Registration error: {str(e)}")
         if isinstance(e, HTTPException):
@@ -128,7 +255,7 @@ async def register(
 @router.post("/verify-email")
 async def verify_email(
     verification_data: schemas.VerifyEmail,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_primary_db)
 ):
     """Verify a user's email using the verification token."""
     try:
@@ -158,7 +285,7 @@ async def verify_email(
         # Update the user
         db.commit()
         
-        return {"message": "Email verified successfully"}
+        return responses.EMAIL_VERIFIED()
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -176,20 +303,23 @@ async def request_password_reset(
     
     # Always return success to prevent email enumeration attacks
     if not user:
-        return {"message": "If a user with that email exists, a password reset link has been sent"}
+        return responses.PASSWORD_RESET_REQUESTED()
     
     # Generate a password reset token
     reset_token, token_expires = utils.create_password_reset_token({"sub": str(user.id)})
     
     # Store the token and expiry time using our method
     user.set_password_reset(token=reset_token, expires_at=token_expires)
+    audit.record("password_reset_requested", request, user_id=user.id, subject=user.email)
+    capture.identify(request, user_id=user.id)
     db.commit()
     
     # Send the password reset email in the background
     try:
         # Only send email if mail configuration is set
         if os.getenv("MAIL_SERVER") and os.getenv("MAIL_USERNAME"):
-            background_tasks.add_task(
+            enqueue_email(
+                background_tasks,
                 send_password_reset_email,
                 user.email,
                 reset_token
@@ -198,14 +328,14 @@ async def request_password_reset(
         logger.error(f"Failed to send password reset email: {str(email_error)}")
         # Don't raise error here, just log it
     
-    return {"message": "If a user with that email exists, a password reset link has been sent"}
+    return responses.PASSWORD_RESET_REQUESTED()
 
 @router.post("/reset-password")
 @limiter.limit("5/minute")
 async def reset_password(
     request: Request,
     reset_data: schemas.ResetPassword,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_primary_db)
 ):
     """Reset a user's password using a reset token."""
     try:
@@ -229,17 +359,19 @@ async def reset_password(
             (expires_at and expires_at < datetime.utcnow())):
             raise HTTPException(status_code=400, detail="Invalid or expired reset token")
         
-        # Hash the new password
-        hashed_password = utils.hash_password(reset_data.password)
+        # Hash the new password off the event loop
+        hashed_password = await deadlines.run_hashing_async(utils.hash_password, reset_data.password)
         
         # Update the password and clear the reset token
         user.hashed_password = hashed_password
         user.set_password_reset()
         
-        # Update the user
-        db.commit()
+        # Update the user and invalidate every token issued with the old password
+        revocation.revoke_all_for_user(db, user)
+        audit.record("password_reset", request, user_id=user_id)
+        capture.identify(request, user_id=user_id)
         
-        return {"message": "Password reset successfully"}
+        return responses.PASSWORD_RESET()
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -248,36 +380,58 @@ async def reset_password(
 def login(request: Request, response: Response, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     # Better logging
     logger.info(f"Login attempt - Username/Email: {form_data.username}")
+    # No token yet, so capture would otherwise see an anonymous request
+    capture.identify(request, subject=form_data.username)
+
+    # Locked accounts cost neither a user lookup nor a bcrypt verify
+    retry_after = failed_logins.retry_after(form_data.username)
+    if retry_after:
+        audit.record("login_locked", request, subject=form_data.username, success=False)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many failed login attempts, try again later",
+            headers={"Retry-After": str(retry_after)}
+        )
     
     # Check if the input is an email (contains @) or a username
     if "@" in form_data.username:
-        user = db.query(models.User).filter(models.User.email == form_data.username).first()
+        user = resilience.retry_read(db, lambda: db.query(models.User).filter(models.User.email == form_data.username).first())
         logger.info(f"Searching by email: {form_data.username}, Found user: {user is not None}")
     else:
-        user = db.query(models.User).filter(models.User.username == form_data.username).first()
+        user = resilience.retry_read(db, lambda: db.query(models.User).filter(models.User.username == form_data.username).first())
         logger.info(f"Searching by username: {form_data.username}, Found user: {user is not None}")
         
     if not user:
         logger.info("User not found")
+        failed_logins.record_failure(form_data.username)
+        audit.record("login", request, subject=form_data.username, success=False, detail="unknown user")
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    capture.identify(request, user_id=user.id)
     
     # Verify password
-    password_valid = utils.verify_password(form_data.password, user.hashed_password)
+    password_valid = deadlines.run_hashing(utils.verify_password, form_data.password, user.hashed_password)
     logger.info(f"Password verification result: {password_valid}")
     
     if not password_valid:
+        # Counted against the account, whichever identifier was typed
+        failed_logins.record_failure(user.username, user.email)
+        audit.record("login", request, user_id=user.id, subject=form_data.username, success=False, detail="bad password")
         raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    failed_logins.reset(user.username, user.email)
     
     # Optional: Check if email is verified (comment out if you want to allow login without verification)
     # if not user.is_email_verified:
     #     raise HTTPException(status_code=401, detail="Email not verified")
 
-    access_token = utils.create_access_token({"sub": str(user.id)})
-    refresh_token = utils.create_refresh_token({"sub": str(user.id)})
+    access_token, refresh_token = issue_tokens(user)
+    # Read before commit expires the instance, which would cost a reload
+    user_id = user.id
 
     user.refresh_token = refresh_token
     user.refresh_token_expires_at = datetime.utcnow() + timedelta(days=utils.REFRESH_TOKEN_EXPIRE_DAYS)
     db.commit()
+    audit.record("login", request, user_id=user_id, subject=form_data.username)
 
     response.set_cookie(
         key="refresh_token",
@@ -289,11 +443,11 @@ def login(request: Request, response: Response, form_data: OAuth2PasswordRequest
         path="/refresh"
     )
 
-    return schemas.Token(access_token=access_token, refresh_token=None)  
+    return responses.model_response(schemas.Token.model_construct(access_token=access_token, refresh_token=None), response)
 
 @router.post("/refresh", response_model=schemas.Token)
 @limiter.limit("20/minute")
-def refresh_token(request: Request, response: Response, db: Session = Depends(get_db)):
+def refresh_token(request: Request, response: Response, db: Session = Depends(get_primary_db)):
     token = request.cookies.get("refresh_token")
     if not token:
         raise HTTPException(status_code=401, detail="Missing refresh token")
@@ -304,18 +458,20 @@ def refresh_token(request: Request, response: Response, db: Session = Depends(ge
     except ValueError:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user or user.refresh_token != token or user.refresh_token_expires_at < datetime.utcnow():
+    user = resilience.retry_read(db, lambda: sharding.get_user(db, user_id, payload.get("shard")))
+    if (not user or user.refresh_token != token or user.refresh_token_expires_at < datetime.utcnow()
+            or payload.get("token_version", 0) < (user.token_version or 0)):
+        audit.record("refresh", request, user_id=user_id, success=False)
         raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
 
     # Issue new tokens
-    new_access_token = utils.create_access_token({"sub": str(user.id)})
-    new_refresh_token = utils.create_refresh_token({"sub": str(user.id)})
+    new_access_token, new_refresh_token = issue_tokens(user)
 
     # Save new refresh token
     user.refresh_token = new_refresh_token
     user.refresh_token_expires_at = datetime.utcnow() + timedelta(days=utils.REFRESH_TOKEN_EXPIRE_DAYS)
     db.commit()
+    audit.record("refresh", request, user_id=user_id)
 
     # Set new cookie
     response.set_cookie(
@@ -328,13 +484,79 @@ def refresh_token(request: Request, response: Response, db: Session = Depends(ge
         path="/refresh"
     )
 
-    return schemas.Token(access_token=new_access_token, refresh_token=None)
+    return responses.model_response(schemas.Token.model_construct(access_token=new_access_token, refresh_token=None), response)
 
 @router.post("/logout")
-def logout(response: Response):
+def logout(request: Request, response: Response, token: Optional[str] = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    # Revoke the presented access token so it can't be replayed until it expires
+    if token:
+        try:
+            payload = utils.verify_token(token, "access")
+            revocation.revoke_token(db, payload)
+            audit.record("logout", request, user_id=payload.get("sub"))
+        except ValueError:
+            pass
     response.delete_cookie("refresh_token", path="/refresh")
     response.delete_cookie("csrf_token")
-    return {"message": "Logged out"}
+    return responses.LOGGED_OUT(response)
+
+@router.get("/me", response_model=schemas.CurrentUser)
+def read_current_user(current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Return the authenticated user's identity from the access token claims."""
+    return responses.model_response(current_user)
+
+@router.post("/logout-all")
+def logout_all(
+    request: Request,
+    response: Response,
+    user: models.User = Depends(get_current_user_model),
+    db: Session = Depends(get_primary_db)
+):
+    """Invalidate every access and refresh token issued to the current user."""
+    user_id = user.id
+    revocation.revoke_all_for_user(db, user)
+    audit.record("logout_all", request, user_id=user_id)
+
+    response.delete_cookie("refresh_token", path="/refresh")
+    response.delete_cookie("csrf_token")
+    return responses.LOGGED_OUT_EVERYWHERE(response)
+
+@router.post("/introspect")
+async def introspect_tokens(
+    request: Request,
+    client_id: str = Depends(introspection.authenticate_client),
+    db: Session = Depends(get_db)
+):
+    """
+    RFC 7662 token introspection for other services.
+
+    Send a form field ``token`` for one token, or a JSON body ``{"tokens": [...]}``
+    for a batch, answered as ``{"results": [...]}`` in the same order.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        batch = isinstance(body, dict) and "tokens" in body
+        tokens = body.get("tokens") if batch else [body.get("token")] if isinstance(body, dict) else None
+    else:
+        batch = False
+        tokens = [(await request.form()).get("token")]
+
+    if (not isinstance(tokens, list) or not tokens or len(tokens) > introspection.INTROSPECT_MAX_TOKENS
+            or not all(isinstance(token, str) and token for token in tokens)):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Expected a token, or 1 to {introspection.INTROSPECT_MAX_TOKENS} tokens"
+        )
+
+    results, max_age = await run_in_threadpool(introspection.introspect, db, tokens)
+    logger.info(f"Introspected {len(tokens)} token(s) for {client_id}")
+    return responses.FastJSONResponse(
+        {"results": results} if batch else results[0],
+        headers={"Cache-Control": f"private, max-age={max_age}"}
+    )
 
 @router.get("/csrf-token")
 def get_csrf_token(response: Response):
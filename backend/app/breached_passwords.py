@@ -0,0 +1,106 @@
+"""
+Offline breached password check.
+
+Looks passwords up in a local copy of the Have I Been Pwned password list,
+converted by build_breached_passwords.py into a sorted binary file of
+truncated SHA-1 hashes. The file is memory-mapped read-only and searched in
+place, so it is never read into process memory: every worker shares the same
+page cache, and a lookup touches only a handful of pages.
+
+File layout (all integers little-endian):
+
+    header   magic b"HIBPPFX1", record size (u8), 7 bytes padding, record count (u64)
+    fan-out  65537 x u64: index of the first record for each leading 2-byte value
+    records  record count x record size bytes, SHA-1 prefixes in ascending order
+
+The check is off unless BREACHED_PASSWORDS_FILE points at such a file.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+BREACHED_PASSWORDS_FILE = os.getenv("BREACHED_PASSWORDS_FILE")
+
+MAGIC = b"HIBPPFX1"
+HEADER = struct.Struct("<8sB7xQ")
+FANOUT_ENTRIES = 65537
+FANOUT = struct.Struct(f"<{FANOUT_ENTRIES}Q")
+
+# 10 bytes (80 bits) keeps false positives negligible for a billion entries at half the size of full hashes
+DEFAULT_RECORD_SIZE = 10
+
+
+class BreachedPasswordIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.record_size, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a breached password file")
+        self._records_offset = HEADER.size + FANOUT.size
+        expected = self._records_offset + self.count * self.record_size
+        if len(self._map) != expected:
+            raise ValueError(f"{path} is truncated or corrupt ({len(self._map)} bytes, expected {expected})")
+        # Lookups are random reads; don't let the kernel read ahead around each one
+        if hasattr(self._map, "madvise") and hasattr(mmap, "MADV_RANDOM"):
+            self._map.madvise(mmap.MADV_RANDOM)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _fanout(self, index: int) -> int:
+        return struct.unpack_from("<Q", self._map, HEADER.size + index * 8)[0]
+
+    def contains_digest(self, digest: bytes) -> bool:
+        """Binary search for a SHA-1 digest, within the range the fan-out table gives for its first 2 bytes."""
+        prefix = digest[:self.record_size]
+        bucket = int.from_bytes(prefix[:2], "big")
+        lo, hi = self._fanout(bucket), self._fanout(bucket + 1)
+        size, base, data = self.record_size, self._records_offset, self._map
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            record = data[offset:offset + size]
+            if record < prefix:
+                lo = mid + 1
+            elif record > prefix:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def contains(self, password: str) -> bool:
+        return self.contains_digest(hashlib.sha1(password.encode("utf-8")).digest())
+
+
+_index: Optional[BreachedPasswordIndex] = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[BreachedPasswordIndex]:
+    """The configured index, opened on first use; None when the check is disabled or the file is unusable."""
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                if BREACHED_PASSWORDS_FILE:
+                    try:
+                        _index = BreachedPasswordIndex(BREACHED_PASSWORDS_FILE)
+                        logger.info(f"Loaded breached password index with {len(_index)} entries")
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Breached password check disabled: {e}")
+                _index_loaded = True
+    return _index
+
+
+def is_breached(password: str) -> bool:
+    index = get_index()
+    return index is not None and index.contains(password)
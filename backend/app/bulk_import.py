@@ -0,0 +1,227 @@
+"""
+Streaming bulk user import.
+
+Rows are read one batch at a time from CSV or NDJSON, validated with the
+UserCreate rules, hashed across a process pool (or taken as-is when the row
+already carries a bcrypt hash) and inserted with one executemany per batch.
+Rows that can't be imported are written to a report file as they are found,
+so memory use depends on the batch size, not the input size.
+"""
+import codecs
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import models, schemas, sharding, utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+# Each batch's duplicate check binds two parameters per row, and SQL Server
+# allows at most 2100 parameters per statement
+MAX_BATCH_SIZE = 1000
+
+DEFAULT_HASH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+REPORT_FIELDS = ["row", "email", "username", "reason"]
+
+
+class ImportResult:
+    def __init__(self, report_path: Optional[str] = None):
+        self.report_path = report_path
+        self.rows = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "report_path": self.report_path,
+        }
+
+
+def detect_format(filename: str) -> str:
+    return "ndjson" if filename.lower().endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+
+def iter_rows(stream: Iterable[str], fmt: str) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """Yield (line number, row) pairs without reading the whole input."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else {"_error": "not a JSON object"}
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _batches(rows: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class UserImporter:
+    def __init__(
+        self,
+        db: Session,
+        report: TextIO,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        hash_workers: int = DEFAULT_HASH_WORKERS,
+    ):
+        self.db = db
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.hash_workers = hash_workers
+        self._report = csv.writer(report)
+        self._report.writerow(REPORT_FIELDS)
+
+    def run(self, stream: Iterable[str], fmt: str, result: ImportResult) -> ImportResult:
+        # Spawned rather than forked: the caller may be a web worker with live threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.hash_workers, mp_context=context) as pool:
+            for batch in _batches(iter_rows(stream, fmt), self.batch_size):
+                self._import_batch(batch, pool, result)
+                logger.info(f"Bulk import progress: {result.as_dict()}")
+        return result
+
+    def _reject(self, result: ImportResult, line: int, row: Dict[str, str], reason: str, duplicate: bool) -> None:
+        if duplicate:
+            result.duplicates += 1
+        else:
+            result.invalid += 1
+        self._report.writerow([line, row.get("email", ""), row.get("username", ""), reason])
+
+    def _validate(self, batch, result: ImportResult) -> List[Tuple[int, schemas.UserImport]]:
+        valid = []
+        seen_emails, seen_usernames = set(), set()
+        for line, row in batch:
+            result.rows += 1
+            if "_error" in row:
+                self._reject(result, line, row, row["_error"], duplicate=False)
+                continue
+            try:
+                user = schemas.UserImport(**{k: v for k, v in row.items() if k and v not in (None, "")})
+            except ValidationError as e:
+                reason = "; ".join(f"{'.'.join(map(str, err['loc'])) or 'row'}: {err['msg']}" for err in e.errors())
+                self._reject(result, line, row, reason, duplicate=False)
+                continue
+            if user.email in seen_emails or user.username in seen_usernames:
+                self._reject(result, line, row, "duplicate within batch", duplicate=True)
+                continue
+            seen_emails.add(user.email)
+            seen_usernames.add(user.username)
+            valid.append((line, user))
+        return valid
+
+    def _drop_existing(self, valid, result: ImportResult) -> List[Tuple[int, schemas.UserImport]]:
+        """One query per batch finds rows that clash with users already stored (including earlier batches)."""
+        if not valid:
+            return valid
+        emails = [user.email for _, user in valid]
+        usernames = [user.username for _, user in valid]
+        existing = self.db.query(models.User.email, models.User.username).filter(
+            or_(models.User.email.in_(emails), models.User.username.in_(usernames))
+        ).all()
+        taken_emails = {email for email, _ in existing}
+        taken_usernames = {username for _, username in existing}
+
+        remaining = []
+        for line, user in valid:
+            if user.email in taken_emails:
+                self._reject(result, line, user.model_dump(), "email already registered", duplicate=True)
+            elif user.username in taken_usernames:
+                self._reject(result, line, user.model_dump(), "username already taken", duplicate=True)
+            else:
+                remaining.append((line, user))
+        return remaining
+
+    def _import_batch(self, batch, pool: ProcessPoolExecutor, result: ImportResult) -> None:
+        valid = self._drop_existing(self._validate(batch, result), result)
+        if not valid:
+            return
+
+        plain = [user.password for _, user in valid if not user.hashed_password]
+        chunksize = max(1, len(plain) // (self.hash_workers * 4))
+        hashed = iter(pool.map(utils.hash_password, plain, chunksize=chunksize))
+
+        now = datetime.utcnow()
+        rows = []
+        for _, user in valid:
+            rows.append({
+                "id": str(uuid.uuid4()),
+                "email": user.email,
+                "username": user.username,
+                "hashed_password": user.hashed_password or next(hashed),
+                "is_active": True,
+                "role": "user",
+                "token_version": 0,
+                "created_at": now,
+                "updated_at": now,
+            })
+
+        try:
+            sharding.insert_users(self.db, rows)
+            self.db.commit()
+            result.inserted += len(rows)
+        except IntegrityError:
+            # Someone registered one of these users since the duplicate check;
+            # retry row by row so only the clashing rows are rejected
+            self.db.rollback()
+            for (line, user), row in zip(valid, rows):
+                try:
+                    sharding.insert_users(self.db, [row])
+                    self.db.commit()
+                    result.inserted += 1
+                except IntegrityError:
+                    self.db.rollback()
+                    self._reject(result, line, row, "email or username already registered", duplicate=True)
+
+
+def import_users(
+    db: Session,
+    stream: Iterable[str],
+    fmt: str,
+    report_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hash_workers: int = DEFAULT_HASH_WORKERS,
+) -> ImportResult:
+    """Import users from CSV/NDJSON text lines, writing skipped rows to report_path."""
+    result = ImportResult(report_path)
+    with open(report_path, "w", newline="") as report:
+        UserImporter(db, report, batch_size=batch_size, hash_workers=hash_workers).run(stream, fmt, result)
+    logger.info(f"Bulk import finished: {result.as_dict()}")
+    return result
+
+
+def import_users_from_binary(db: Session, binary, fmt: str, report_path: str, **options) -> ImportResult:
+    """Same as import_users for a binary file object such as an uploaded file."""
+    # Decodes line by line, so the upload is never read into memory as a whole
+    return import_users(db, codecs.iterdecode(binary, "utf-8-sig"), fmt, report_path, **options)
@@ -0,0 +1,253 @@
+"""
+Opt-in traffic capture for capacity testing.
+
+With TRAFFIC_CAPTURE_DIR set, each worker appends one fixed-size record per
+request to its own binary log: start time, duration, status, route and
+hashed identities. Bodies, passwords and tokens are never written. The
+identity is a keyed BLAKE2b hash of the user id (noted by the auth route
+through identify(), or the subject of the token sent), or of the account
+name typed at a failed login. The client is a hash of the address and user agent. A replay
+can then keep each user's sessions and tabs together without the log naming
+anyone. The key comes from TRAFFIC_CAPTURE_SALT, or is random per master
+process and never written anywhere.
+
+``replay_traffic.py`` plays a capture back against a local instance.
+"""
+import glob
+import hashlib
+import logging
+import os
+import secrets
+import struct
+import threading
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from jose import jwt
+from starlette.requests import cookie_parser
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_CAPTURE_DIR = os.getenv("TRAFFIC_CAPTURE_DIR", "")
+TRAFFIC_CAPTURE_MAX_MB = float(os.getenv("TRAFFIC_CAPTURE_MAX_MB", 200))
+CAPTURE_ENABLED = bool(TRAFFIC_CAPTURE_DIR)
+
+# Generated before workers fork, so every worker hashes the same user the same way
+_KEY = hashlib.blake2b(os.getenv("TRAFFIC_CAPTURE_SALT", "").encode() or secrets.token_bytes(32),
+                       digest_size=32).digest()
+
+MAGIC = b"DRCAP\x01"
+KIND_ROUTE, KIND_REQUEST = 0, 1
+# kind, route id, name length; the name follows
+_ROUTE = struct.Struct("<BHB")
+# kind, started at (epoch seconds), duration (us), status, route id, identity, client, flags
+_REQUEST = struct.Struct("<BdIHHQIB")
+
+FLAG_USER_ID = 1  # identity hashes a user id rather than a typed account name
+FLAG_BEARER = 2  # the request sent an access token
+FLAG_REFRESH_COOKIE = 4  # the request sent a refresh token cookie
+
+UNMATCHED = "<unmatched>"
+MAX_ROUTES = 1024
+FLUSH_SECONDS = 1.0
+
+
+class Captured(NamedTuple):
+    route: str  # "METHOD /path", the route's path template
+    started_at: float
+    duration: float
+    status: int
+    identity: int  # 0 when anonymous
+    client: int
+    flags: int
+
+
+def _hash(value: str, size: int) -> int:
+    digest = hashlib.blake2b(value.encode("utf-8", "replace"), key=_KEY, digest_size=size).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def identify(request, user_id: Optional[str] = None, subject: Optional[str] = None) -> None:
+    """Note who a request acted for, when its token doesn't say; called from the auth routes."""
+    if not CAPTURE_ENABLED:
+        return
+    if user_id:
+        request.state.capture_user_id = str(user_id)
+    elif subject:
+        request.state.capture_subject = subject
+
+
+def _token_subject(token: str) -> Optional[str]:
+    # The signature doesn't matter here; only which user the caller claims to be
+    try:
+        return jwt.get_unverified_claims(token).get("sub")
+    except Exception:
+        return None
+
+
+def _identities(scope) -> Tuple[int, int, int]:
+    """Identity, client and flags for a finished request."""
+    state = scope.get("state") or {}
+    headers = {}
+    for name, value in scope["headers"]:
+        if name in (b"authorization", b"cookie", b"user-agent", b"x-forwarded-for"):
+            headers[name] = value.decode("latin-1")
+
+    flags, token_user = 0, None
+    authorization = headers.get(b"authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        flags |= FLAG_BEARER
+        token_user = _token_subject(authorization[7:])
+    refresh_token = cookie_parser(headers.get(b"cookie", "")).get("refresh_token")
+    if refresh_token:
+        flags |= FLAG_REFRESH_COOKIE
+        token_user = token_user or _token_subject(refresh_token)
+
+    identity = 0
+    user_id = state.get("capture_user_id") or token_user
+    if user_id:
+        identity, flags = _hash(f"user:{user_id}", 8), flags | FLAG_USER_ID
+    elif state.get("capture_subject"):
+        identity = _hash(f"name:{state['capture_subject'].strip().lower()}", 8)
+
+    address = headers.get(b"x-forwarded-for", "").split(",")[0].strip()
+    if not address and scope.get("client"):
+        address = scope["client"][0]
+    client = _hash(f"{address}|{headers.get(b'user-agent', '')}", 4)
+    return identity, client, flags
+
+
+class CaptureLog:
+    """Append-only capture file for this worker, opened on first use after fork."""
+
+    def __init__(self, directory: str = TRAFFIC_CAPTURE_DIR, max_mb: float = TRAFFIC_CAPTURE_MAX_MB):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.path: Optional[str] = None
+        self._file = None
+        self._pid: Optional[int] = None
+        self._routes = {}
+        self._lock = threading.Lock()
+        self._flushed_at = 0.0
+        self.bytes = 0
+        self.records = 0
+        self.dropped = 0
+
+    def _open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"capture-{os.getpid()}-{int(time.time())}.bin")
+        self._file = open(self.path, "wb", buffering=65536)
+        self._file.write(MAGIC)
+        self._pid = os.getpid()
+        self._routes = {}
+        self.bytes = len(MAGIC)
+        logger.info(f"Capturing traffic to {self.path}")
+
+    def write(self, route: str, started_at: float, duration: float, status: int,
+              identity: int, client: int, flags: int) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            if self.bytes >= self.max_bytes:
+                self.dropped += 1
+                return
+            route_id = self._routes.get(route)
+            if route_id is None:
+                if len(self._routes) >= MAX_ROUTES:
+                    route = UNMATCHED
+                route_id = self._routes.get(route)
+            if route_id is None:
+                route_id = self._routes[route] = len(self._routes)
+                name = route.encode()[:255]
+                self._file.write(_ROUTE.pack(KIND_ROUTE, route_id, len(name)) + name)
+                self.bytes += _ROUTE.size + len(name)
+            self._file.write(_REQUEST.pack(
+                KIND_REQUEST, started_at, min(int(duration * 1e6), 0xFFFFFFFF), status, route_id,
+                identity, client, flags,
+            ))
+            self.bytes += _REQUEST.size
+            self.records += 1
+            # Buffered, but never more than a second behind
+            if started_at - self._flushed_at > FLUSH_SECONDS:
+                self._flushed_at = started_at
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+
+
+capture_log = CaptureLog()
+
+
+class TrafficCaptureMiddleware:
+    """ASGI middleware recording every request to the capture log."""
+
+    def __init__(self, app, log: Optional[CaptureLog] = None):
+        self.app = app
+        self.log = log or capture_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started_at, start = time.time(), time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            try:
+                route = scope.get("route")
+                path = route.path if route is not None and hasattr(route, "path") else UNMATCHED
+                self.log.write(f"{scope['method']} {path}", started_at, duration, status, *_identities(scope))
+            except Exception as e:
+                logger.error(f"Traffic capture failed: {e}")
+
+
+def read(path: str) -> Iterator[Captured]:
+    """Records of one capture file, in the order they finished."""
+    routes = {}
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            if kind[0] == KIND_ROUTE:
+                header = kind + f.read(_ROUTE.size - 1)
+                if len(header) < _ROUTE.size:
+                    return
+                _, route_id, length = _ROUTE.unpack(header)
+                routes[route_id] = f.read(length).decode()
+            elif kind[0] == KIND_REQUEST:
+                record = kind + f.read(_REQUEST.size - 1)
+                # A worker that was killed may have left half a record
+                if len(record) < _REQUEST.size:
+                    return
+                _, started_at, duration_us, status, route_id, identity, client, flags = _REQUEST.unpack(record)
+                yield Captured(routes[route_id], started_at, duration_us / 1e6, status, identity, client, flags)
+            else:
+                raise ValueError(f"Corrupt record in {path}")
+
+
+def load(paths: List[str]) -> List[Captured]:
+    """Every record from capture files or directories of them, by start time."""
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "capture-*.bin"))) if os.path.isdir(path) else [path])
+    records = [record for path in files for record in read(path)]
+    records.sort(key=lambda record: record.started_at)
+    return records
@@ -0,0 +1,245 @@
+"""
+Adaptive admission control for a single worker.
+
+Caps in-flight requests with an AIMD limit driven by observed latency: the
+limit grows by roughly one per "window" of requests while latency stays near
+the route's baseline, and shrinks multiplicatively when latency rises past a
+tolerance. Requests that can't be admitted wait in a priority queue for at
+most a short target delay, then get a fast 503 with Retry-After instead of
+piling up until gunicorn kills the worker.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app import tracing
+
+logger = logging.getLogger(__name__)
+
+INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", 20))
+MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", 4))
+MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", 200))
+
+# How long a request may wait for a slot before it is shed
+QUEUE_TARGET_SECONDS = float(os.getenv("ADMISSION_QUEUE_TARGET_MS", 100)) / 1000
+
+# Latency above baseline * tolerance counts as congestion
+LATENCY_TOLERANCE = float(os.getenv("ADMISSION_LATENCY_TOLERANCE", 2.0))
+BACKOFF_RATIO = 0.9
+
+# Baselines are the minimum latency per route over a sliding window, so they
+# recover when the database or host gets faster again
+BASELINE_WINDOW_SECONDS = 60.0
+
+# Priority classes, lower is more important
+PRIORITY_EXEMPT = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+
+ROUTE_PRIORITIES: Dict[str, int] = {
+    "/health": PRIORITY_EXEMPT,
+    "/ready": PRIORITY_EXEMPT,
+    "/ping": PRIORITY_EXEMPT,
+    # Long-lived stream with its own per-worker cap (EXPORT_CONCURRENCY)
+    "/admin/users/export": PRIORITY_EXEMPT,
+    "/refresh": PRIORITY_HIGH,
+    "/register": PRIORITY_LOW,
+    "/test-register": PRIORITY_LOW,
+    "/request-password-reset": PRIORITY_LOW,
+}
+
+# Share of the limit each class may fill; low priority work leaves room for logins and refreshes
+CLASS_SHARE = {
+    PRIORITY_HIGH: 1.0,
+    PRIORITY_NORMAL: 0.9,
+    PRIORITY_LOW: float(os.getenv("ADMISSION_LOW_PRIORITY_SHARE", 0.5)),
+}
+
+# Higher priority requests are allowed to wait longer for a slot
+CLASS_QUEUE_TARGET = {
+    PRIORITY_HIGH: QUEUE_TARGET_SECONDS * 2,
+    PRIORITY_NORMAL: QUEUE_TARGET_SECONDS,
+    PRIORITY_LOW: QUEUE_TARGET_SECONDS / 2,
+}
+
+# Bound the number of tracked routes so arbitrary paths can't grow memory
+MAX_TRACKED_ROUTES = 64
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial_limit: int = INITIAL_LIMIT,
+        min_limit: int = MIN_LIMIT,
+        max_limit: int = MAX_LIMIT,
+    ):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.reset()
+
+    def reset(self) -> None:
+        """Start from scratch, e.g. in a freshly forked worker."""
+        self.limit = float(self.initial_limit)
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._baselines: Dict[str, Tuple[float, float, float]] = {}
+        self._last_decrease = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _capacity(self, priority: int) -> int:
+        return max(1, int(self.limit * CLASS_SHARE[priority]))
+
+    def _can_admit(self, priority: int) -> bool:
+        return self.in_flight < self._capacity(priority)
+
+    async def acquire(self, priority: int) -> bool:
+        """Wait for a slot; returns False if the request should be shed."""
+        if not self._waiters and self._can_admit(priority):
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        # A higher priority request may fit where the queued ones don't
+        self._wake_waiters()
+        with tracing.span("admission.queue", attributes={"priority": priority}) as queued:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), CLASS_QUEUE_TARGET[priority])
+                self.admitted += 1
+                return True
+            except asyncio.TimeoutError:
+                if future.done() and not future.cancelled():
+                    # Admitted at the same moment the wait timed out
+                    self.admitted += 1
+                    return True
+                future.cancel()
+                self.rejected += 1
+                if queued is not None:
+                    queued.error = "shed"
+                return False
+            except asyncio.CancelledError:
+                # Cancelled while queued, e.g. by the request deadline: a slot already
+                # handed to this waiter would otherwise never be released
+                if future.done() and not future.cancelled():
+                    self.release()
+                else:
+                    future.cancel()
+                raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_admit(priority):
+                break
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(True)
+
+    def _baseline(self, route: str, latency: float, now: float) -> float:
+        # (current window min, previous window min, window start)
+        current, previous, started = self._baselines.get(route, (latency, latency, now))
+        if now - started > BASELINE_WINDOW_SECONDS:
+            previous, current, started = current, latency, now
+        else:
+            current = min(current, latency)
+        if route in self._baselines or len(self._baselines) < MAX_TRACKED_ROUTES:
+            self._baselines[route] = (current, previous, started)
+        return min(current, previous)
+
+    def record(self, route: str, latency: float) -> None:
+        """Feed a completed request's latency back into the limit."""
+        now = time.monotonic()
+        baseline = self._baseline(route, latency, now)
+
+        if latency > baseline * LATENCY_TOLERANCE and latency > 0.005:
+            # Back off at most once per observed latency so a single burst of
+            # slow completions doesn't collapse the limit
+            if now - self._last_decrease > latency:
+                self.limit = max(self.min_limit, self.limit * BACKOFF_RATIO)
+                self._last_decrease = now
+        elif self.in_flight >= self.limit / 2:
+            # Only grow while the limit is actually being used
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._wake_waiters()
+
+    def retry_after(self) -> int:
+        """Rough seconds until the current backlog drains."""
+        typical = [min(current, previous) for current, previous, _ in self._baselines.values()]
+        per_request = max(typical) if typical else 1.0
+        backlog = len(self._waiters) + self.in_flight
+        return max(1, math.ceil(backlog * per_request / max(self.limit, 1)))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": round(self.limit, 1),
+            "in_flight": self.in_flight,
+            "queued": sum(1 for _, _, f in self._waiters if not f.done()),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+admission = AdaptiveLimiter()
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that admits requests through the worker's AdaptiveLimiter."""
+
+    def __init__(self, app, limiter: Optional[AdaptiveLimiter] = None):
+        self.app = app
+        self.limiter = limiter or admission
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        priority = ROUTE_PRIORITIES.get(path, PRIORITY_NORMAL)
+        if priority == PRIORITY_EXEMPT or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        if not await self.limiter.acquire(priority):
+            logger.debug(f"Shedding {scope['method']} {path}: {self.limiter.stats()}")
+            await _send_overloaded(send, self.limiter.retry_after())
+            return
+
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
+            self.limiter.record(path, time.monotonic() - start)
+
+
+async def _send_overloaded(send, retry_after: int) -> None:
+    body = b'{"detail":"Server overloaded, retry later"}'
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
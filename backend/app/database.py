@@ -23,9 +23,13 @@ try:
     logger.info("Attempting to connect to Azure SQL Database")
     
     # Use the connection string from environment variables
-    # Priority: CUSTOM_CONN_STR > SQLCONNSTR_DefaultConnection > manually build from parts
+    # Priority: DATABASE_URL > CUSTOM_CONN_STR > SQLCONNSTR_DefaultConnection > manually build from parts
     
-    if os.getenv("CUSTOM_CONN_STR"):
+    if os.getenv("DATABASE_URL"):
+        # Full SQLAlchemy URL, e.g. sqlite:///./dreamapp.db for local runs and tests
+        connection_string = None
+        logger.info("Using DATABASE_URL environment variable")
+    elif os.getenv("CUSTOM_CONN_STR"):
         connection_string = os.getenv("CUSTOM_CONN_STR")
         logger.info("Using CUSTOM_CONN_STR environment variable")
     elif os.getenv("SQLCONNSTR_DefaultConnection"):
@@ -47,33 +51,96 @@ try:
         logger.info(f"Built connection string from parts for Server={SERVER}, Database={DATABASE}, User={USERNAME}")
     
     # Create the SQLAlchemy URL
-    DATABASE_URL = f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(connection_string)}"
+    if connection_string is None:
+        DATABASE_URL = os.getenv("DATABASE_URL")
+    else:
+        DATABASE_URL = f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(connection_string)}"
     logger.info("Successfully created SQLAlchemy URL with connection string")
     
 except Exception as e:
     logger.error(f"Failed to set up database connection: {e}")
     raise  # Re-raise to prevent the app from starting with a bad database connection
 
-# Create the SQLAlchemy engine with optimized settings for Azure
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_size=3,              # Limit connections to avoid memory issues
-    max_overflow=5,           # Allow fewer overflow connections to reduce memory
-    pool_timeout=15,          # Shorter connection timeout
-    pool_recycle=900,         # Recycle connections every 15 minutes
-    connect_args={
-        "timeout": 15,        # Shorter connection timeout in seconds
-        "connect_timeout": 10 # Shorter initial connection timeout
-    }
-)
-logger.info("Created SQL Server engine with optimized settings")
-
-# Create session and base
+def _make_engine(url):
+    if url.startswith("sqlite"):
+        # SQLite has no dbo schema, so map the models' schema onto the default one
+        new_engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False}
+        ).execution_options(schema_translate_map={"dbo": None})
+        logger.info("Created SQLite engine")
+        return new_engine
+
+    # Create the SQLAlchemy engine with optimized settings for Azure
+    new_engine = create_engine(
+        url,
+        pool_pre_ping=True,
+        pool_size=3,              # Limit connections to avoid memory issues
+        max_overflow=5,           # Allow fewer overflow connections to reduce memory
+        pool_timeout=15,          # Shorter connection timeout
+        pool_recycle=900,         # Recycle connections every 15 minutes
+        fast_executemany=True,    # Send executemany batches (bulk import) in one round trip
+        connect_args={
+            "timeout": 15,        # Shorter connection timeout in seconds
+            "connect_timeout": 10 # Shorter initial connection timeout
+        }
+    )
+    logger.info("Created SQL Server engine with optimized settings")
+    return new_engine
+
+engine = _make_engine(DATABASE_URL)
+
+# Read replicas: explicit URLs, or Azure SQL read scale-out on the primary's own connection string
+REPLICA_URLS = [url.strip() for url in os.getenv("DB_READ_REPLICA_URLS", "").split(",") if url.strip()]
+if os.getenv("DB_READ_SCALE_OUT", "").lower() in ("1", "true", "yes") and connection_string is not None:
+    REPLICA_URLS.append(
+        f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(connection_string.rstrip(';') + ';ApplicationIntent=ReadOnly;')}"
+    )
+replica_engines = [_make_engine(url) for url in REPLICA_URLS]
+if replica_engines:
+    logger.info(f"Routing reads to {len(replica_engines)} read replica(s)")
+
+# User shards: the primary is shard 0, each URL adds another (see app/sharding.py)
+SHARD_URLS = [url.strip() for url in os.getenv("DB_SHARD_URLS", "").split(",") if url.strip()]
+shard_engines = [engine] + [_make_engine(url) for url in SHARD_URLS]
+
+# Every engine this process owns; gunicorn's post_fork resets each one
+all_engines = [engine] + replica_engines + shard_engines[1:]
+
+# Count transient errors against the circuit breaker
+from app.resilience import breaker, install as install_resilience
+for _shard_engine in shard_engines:
+    install_resilience(_shard_engine)
+
+# Statement routing between the primary and the read replicas
+from app.routing import RoutingSession, install as install_routing
+install_routing(engine, replica_engines)
+
+# Create session and base. SessionLocal always uses the primary; request
+# sessions from get_db send pure reads to a replica when one is configured.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+RoutingSessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+if SHARD_URLS:
+    # Every session spans the shards; the read replicas only serve unsharded deployments
+    if replica_engines:
+        logger.warning("DB_READ_REPLICA_URLS is ignored while DB_SHARD_URLS is set")
+    from app.sharding import install as install_sharding
+    SessionLocal = RoutingSessionLocal = install_sharding(shard_engines)
+
 def get_db():
+    # Fail fast with 503 while the database is known to be down
+    breaker.before_request()
+    db = RoutingSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_primary_db():
+    """For requests whose reads must see the latest writes, e.g. comparing a stored token."""
+    breaker.before_request()
     db = SessionLocal()
     try:
         yield db
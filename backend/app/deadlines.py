@@ -0,0 +1,129 @@
+"""
+Per-request deadlines.
+
+The request middleware starts a deadline for each request from the route's
+budget. The remaining budget is carried in a context variable so it follows
+the request into the threadpool, where it becomes the statement timeout for
+each database call and the wait limit for password hashing jobs. Work that
+runs past the deadline is abandoned and the client gets a 504, instead of the
+request holding a pool connection until gunicorn restarts the worker.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import math
+import os
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import event
+
+from app import tracing, utils
+from app.database import all_engines
+
+logger = logging.getLogger(__name__)
+
+# Must stay below gunicorn's worker timeout (30s) so a request is cut off before the worker is
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("DEFAULT_DEADLINE_SECONDS", 10))
+
+ROUTE_DEADLINES: Dict[str, float] = {
+    "/token": 5,
+    "/refresh": 3,
+    "/register": 8,
+    "/reset-password": 8,
+    "/request-password-reset": 5,
+    # Bulk jobs run as long as their input takes
+    "/admin/users/import": 0,
+    "/admin/users/export": 0,
+}
+
+# Overrides in the form "/token=4,/register=6"; 0 disables the deadline for a route
+for _item in filter(None, os.getenv("ROUTE_DEADLINES", "").split(",")):
+    _path, _, _seconds = _item.partition("=")
+    try:
+        ROUTE_DEADLINES[_path.strip()] = float(_seconds)
+    except ValueError:
+        logger.error(f"Ignoring invalid ROUTE_DEADLINES entry: {_item}")
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's time budget runs out before work could start or finish."""
+
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+def budget_for(path: str) -> float:
+    return ROUTE_DEADLINES.get(path, DEFAULT_DEADLINE_SECONDS)
+
+
+def start(seconds: float) -> contextvars.Token:
+    """Start a deadline for the current context. A budget of 0 means no deadline."""
+    return _deadline.set(time.monotonic() + seconds if seconds > 0 else None)
+
+
+def reset(token: contextvars.Token) -> None:
+    _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left in the current request's budget, or None without a deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check() -> None:
+    """Raise DeadlineExceeded if the current request is already out of time."""
+    if expired():
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+def run_hashing(func, *args):
+    """Run a password hashing call on the hashing pool, giving up once the deadline passes."""
+    check()
+    # The time from this span's start to its bcrypt span's start is spent queued for the pool
+    with tracing.span("password_hashing"):
+        # Run in a copy of this context so the bcrypt call joins the request's trace
+        future = utils.hash_executor.submit(contextvars.copy_context().run, func, *args)
+        try:
+            return future.result(timeout=remaining())
+        except concurrent.futures.TimeoutError:
+            # Drops the job if it hasn't started; a running bcrypt round finishes but its result is discarded
+            future.cancel()
+            raise DeadlineExceeded("Password hashing exceeded the request deadline")
+
+
+async def run_hashing_async(func, *args):
+    """Async variant of run_hashing that keeps bcrypt off the event loop."""
+    check()
+    with tracing.span("password_hashing"):
+        future = asyncio.wrap_future(utils.hash_executor.submit(contextvars.copy_context().run, func, *args))
+        try:
+            return await asyncio.wait_for(future, remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Password hashing exceeded the request deadline")
+
+
+def _apply_statement_timeout(conn, clauseelement, multiparams, params, execution_options):
+    """Refuse to start statements past the deadline and cap the rest by the remaining budget."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded before query")
+
+    # pyodbc applies Connection.timeout to cursors created afterwards, which is
+    # why this runs before execute rather than before the cursor is used
+    dbapi_connection = conn.connection.dbapi_connection
+    if hasattr(dbapi_connection, "timeout"):
+        dbapi_connection.timeout = max(1, math.ceil(left)) if left is not None else 0
+
+
+for _engine in all_engines:
+    event.listen(_engine, "before_execute", _apply_statement_timeout)
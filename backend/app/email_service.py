@@ -6,6 +6,8 @@ from dotenv import load_dotenv
 import jinja2
 import logging
 
+from app import tracing
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -56,6 +58,30 @@ template_env = jinja2.Environment(
 # Create the email templates directory if it doesn't exist
 os.makedirs("./app/email_templates", exist_ok=True)
 
+# Emails scheduled as background tasks that haven't finished sending yet.
+# Only touched from the event loop, so no locking is needed.
+_pending_emails = 0
+
+
+def queue_depth() -> int:
+    """Number of emails scheduled in this worker that haven't been sent yet."""
+    return _pending_emails
+
+
+def enqueue_email(background_tasks, send_func, *args) -> None:
+    """Schedule an email send as a background task, tracking it in the queue depth."""
+    global _pending_emails
+    _pending_emails += 1
+
+    async def _send():
+        global _pending_emails
+        try:
+            await send_func(*args)
+        finally:
+            _pending_emails -= 1
+
+    background_tasks.add_task(_send)
+
 
 async def send_email(
     recipients: List[EmailStr],
@@ -83,7 +109,9 @@ async def send_email(
                 
                 for to_email in to_emails:
                     message = Mail(from_email=from_email, to_emails=to_email, subject=subject, html_content=content)
-                    response = sg.send(message)
+                    with tracing.span("email.send", tracing.KIND_CLIENT,
+                                      {"email.provider": "sendgrid", "email.template": template_name}):
+                        response = sg.send(message)
                     logger.info(f"Email sent via SendGrid. Status: {response.status_code}")
             except Exception as e:
                 logger.error(f"Failed to send email via SendGrid: {str(e)}")
@@ -100,7 +128,9 @@ async def send_email(
 
             try:
                 fm = FastMail(fastapi_mail_conf)
-                await fm.send_message(message)
+                with tracing.span("email.send", tracing.KIND_CLIENT,
+                                  {"email.provider": "fastapi_mail", "email.template": template_name}):
+                    await fm.send_message(message)
                 logger.info(f"Email sent via FastAPI Mail to {recipients}")
             except Exception as e:
                 logger.error(f"Failed to send email via FastAPI Mail: {str(e)}")
@@ -0,0 +1,104 @@
+"""
+Cached readiness probe.
+
+A background thread runs ``SELECT 1`` against the engine on a fixed interval
+and stores the outcome. ``/ready`` only reads that cached state, so probe cost
+stays at one query per interval per worker however often Azure calls it.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from app.database import engine
+from app.email_service import queue_depth
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL_SECONDS = float(os.getenv("READINESS_PROBE_SECONDS", 5))
+
+# A result older than this means the probe thread itself is stuck
+MAX_PROBE_AGE_SECONDS = PROBE_INTERVAL_SECONDS * 3 + 15
+
+
+class ReadinessProbe:
+    def __init__(self, interval: float = PROBE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.database_ok = False
+        self.checked_at: Optional[float] = None
+        self.latency_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def check_once(self) -> bool:
+        start = time.monotonic()
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            self.database_ok = True
+            self.error = None
+        except Exception as e:
+            if self.database_ok:
+                logger.error(f"Readiness probe failed: {e}")
+            self.database_ok = False
+            self.error = type(e).__name__
+        self.latency_ms = round((time.monotonic() - start) * 1000, 1)
+        self.checked_at = time.time()
+        return self.database_ok
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            self.check_once()
+            self._stop_event.wait(self.interval)
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="readiness-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    @property
+    def is_ready(self) -> bool:
+        if not self.database_ok or self.checked_at is None:
+            return False
+        return time.time() - self.checked_at <= MAX_PROBE_AGE_SECONDS
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.is_ready else "unavailable",
+            "database": {
+                "ok": self.database_ok,
+                "checked_at": self.checked_at,
+                "age_seconds": round(time.time() - self.checked_at, 1) if self.checked_at else None,
+                "latency_ms": self.latency_ms,
+                "error": self.error,
+            },
+            "pool": pool_status(),
+            "email_queue_depth": queue_depth(),
+        }
+
+
+def pool_status() -> Dict[str, Any]:
+    """Connection pool usage; only QueuePool exposes size and overflow."""
+    pool = engine.pool
+    status: Dict[str, Any] = {"class": type(pool).__name__}
+    if hasattr(pool, "checkedout"):
+        checked_out = pool.checkedout()
+        status["checked_out"] = checked_out
+        if hasattr(pool, "size"):
+            capacity = pool.size() + getattr(pool, "_max_overflow", 0)
+            status["size"] = pool.size()
+            status["overflow"] = max(pool.overflow(), 0)
+            status["saturation"] = round(checked_out / capacity, 2) if capacity > 0 else None
+    return status
+
+
+readiness = ReadinessProbe()
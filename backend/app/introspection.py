@@ -0,0 +1,131 @@
+"""
+Token introspection for other services (RFC 7662), one token or a batch.
+
+Each distinct token in a batch is verified once with python-jose, exactly as
+the API's own routes verify it. Tokens that verify are checked against the
+in-memory revocation state, then one
+grouped query loads the status of every user they name, so a batch costs a
+single round trip whatever its size. Callers may cache the answer for the
+``max-age`` in the Cache-Control header, which never outlives a token.
+
+Callers authenticate with HTTP Basic credentials from INTROSPECTION_CLIENTS
+("client_id:secret" pairs, comma separated); without it the endpoint
+rejects every request.
+"""
+import logging
+import os
+import secrets
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from jose import JWTError, jwt
+from sqlalchemy.orm import Session
+
+from app import models, revocation, utils
+
+logger = logging.getLogger(__name__)
+
+INTROSPECT_MAX_TOKENS = int(os.getenv("INTROSPECT_MAX_TOKENS", 100))
+INTROSPECT_CACHE_SECONDS = int(os.getenv("INTROSPECT_CACHE_SECONDS", 30))
+
+# Longer than any token this API issues
+MAX_TOKEN_LENGTH = 4096
+
+CLIENTS: Dict[str, str] = {}
+for _pair in filter(None, os.getenv("INTROSPECTION_CLIENTS", "").split(",")):
+    _client_id, _, _secret = _pair.strip().partition(":")
+    if _client_id and _secret:
+        CLIENTS[_client_id] = _secret
+    else:
+        logger.error("Ignoring INTROSPECTION_CLIENTS entry without a secret")
+
+_basic = HTTPBasic(auto_error=False)
+
+
+def authenticate_client(credentials: Optional[HTTPBasicCredentials] = Depends(_basic)) -> str:
+    """Dependency: the calling service's client id."""
+    expected = CLIENTS.get(credentials.username) if credentials else None
+    supplied = credentials.password if credentials else ""
+    # Compare even for unknown clients so response times don't reveal which ids exist
+    valid = secrets.compare_digest((expected or secrets.token_hex(16)).encode(), supplied.encode())
+    if expected is None or not valid:
+        raise HTTPException(status_code=401, detail="Invalid client credentials",
+                            headers={"WWW-Authenticate": 'Basic realm="introspect"'})
+    return credentials.username
+
+
+class BatchVerifier:
+    """Verifies a batch of tokens with python-jose, decoding repeated tokens only once."""
+
+    def __init__(self, secret: str, algorithm: str = utils.ALGORITHM):
+        self._secret = secret
+        self._algorithms = [algorithm]
+
+    def _decode(self, token: str) -> Optional[Dict[str, Any]]:
+        if not self._secret or len(token) > MAX_TOKEN_LENGTH:
+            return None
+        try:
+            payload = jwt.decode(token, self._secret, algorithms=self._algorithms)
+        except JWTError:
+            return None
+        # jose accepts tokens without an expiry, but every token this API issues has one
+        if not isinstance(payload.get("exp"), (int, float)):
+            return None
+        return payload
+
+    def verify(self, tokens: Sequence[str]) -> List[Optional[Dict[str, Any]]]:
+        """The payload of each valid, unexpired token, None for the rest."""
+        cache: Dict[str, Optional[Dict[str, Any]]] = {}
+        results = []
+        for token in tokens:
+            if token not in cache:
+                cache[token] = self._decode(token)
+            results.append(cache[token])
+        return results
+
+
+verifier = BatchVerifier(utils.SECRET_KEY)
+
+INACTIVE: Dict[str, Any] = {"active": False}
+
+
+def introspect(db: Session, tokens: Sequence[str]) -> Tuple[List[Dict[str, Any]], int]:
+    """Per-token RFC 7662 results in request order, and how long callers may cache them."""
+    now = time.time()
+    payloads = dict(zip(tokens, verifier.verify(tokens)))
+
+    # Only access tokens are for other services; refresh tokens never leave the auth cookie
+    candidates = {
+        token: payload for token, payload in payloads.items()
+        if payload is not None and payload.get("type") == "access" and not revocation.is_revoked(payload)
+    }
+    user_ids = {payload["sub"] for payload in candidates.values() if isinstance(payload.get("sub"), str)}
+    users = {}
+    if user_ids:
+        users = {
+            user_id: (is_active, token_version)
+            for user_id, is_active, token_version in db.query(
+                models.User.id, models.User.is_active, models.User.token_version
+            ).filter(models.User.id.in_(user_ids))
+        }
+
+    results: Dict[str, Dict[str, Any]] = {}
+    max_age = INTROSPECT_CACHE_SECONDS
+    for token, payload in candidates.items():
+        user = users.get(payload.get("sub"))
+        # The database version may be newer than this worker's revocation state
+        if user is None or not user[0] or payload.get("token_version", 0) < (user[1] or 0):
+            continue
+        results[token] = {
+            "active": True,
+            "token_type": "access_token",
+            "sub": payload["sub"],
+            "username": payload.get("username"),
+            "role": payload.get("role", "user"),
+            "exp": payload["exp"],
+            "jti": payload.get("jti"),
+        }
+        max_age = min(max_age, int(payload["exp"] - now))
+    return [results.get(token, INACTIVE) for token in tokens], max(0, max_age)
@@ -0,0 +1,194 @@
+"""
+Per-account failed login tracking.
+
+The /token rate limit is per client address, which does nothing against a
+credential stuffing run spread over many addresses. This tracks failures per
+account name instead: past a threshold the account is locked for a period
+that doubles with each further failure, and attempts against a locked
+account are turned away before the user lookup and the bcrypt verify.
+
+Failures against a known account count once, under its username, and a
+lockout covers its email too, so switching identifiers doesn't buy extra
+attempts. Unknown names count as typed.
+
+Counters live in a small fixed-size table in a shared memory file, so every
+worker sees the same state without a database round trip. The file is named
+per deployment, so other apps or containers on the host never share it. Scores decay
+exponentially, applied when a slot is read, so old failures fade on their own
+and rarely-seen accounts are the first evicted when a bucket is full.
+"""
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from app import utils
+
+logger = logging.getLogger(__name__)
+
+# Failures (after decay) before an account is locked
+LOCKOUT_THRESHOLD = int(os.getenv("LOGIN_LOCKOUT_THRESHOLD", 5))
+LOCKOUT_BASE_SECONDS = int(os.getenv("LOGIN_LOCKOUT_BASE_SECONDS", 30))
+LOCKOUT_MAX_SECONDS = int(os.getenv("LOGIN_LOCKOUT_MAX_SECONDS", 900))
+FAILURE_HALF_LIFE_SECONDS = float(os.getenv("LOGIN_FAILURE_HALF_LIFE_SECONDS", 900))
+
+# 64k slots take 1.25 MB; a full bucket evicts its lowest score
+TRACKER_SLOTS = int(os.getenv("LOGIN_TRACKER_SLOTS", 65536))
+BUCKET_SLOTS = 8
+
+# Keeps deployments on one host apart; by default derived from SECRET_KEY without revealing it
+TRACKER_NAMESPACE = os.getenv("LOGIN_TRACKER_NAMESPACE") or hashlib.blake2b(
+    b"login-failures", key=hashlib.sha256(utils.SECRET_KEY.encode()).digest(), digest_size=8
+).hexdigest()
+
+# key hash, failure score, time of last failure, locked until (epoch seconds)
+_SLOT = struct.Struct("<QfII")
+_BUCKET_BYTES = _SLOT.size * BUCKET_SLOTS
+
+
+def _default_path() -> str:
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    # The slot count is part of the name so a resized table never reuses an old layout
+    return os.path.join(directory, f"dreamapp-login-failures-{TRACKER_NAMESPACE}-{TRACKER_SLOTS}")
+
+
+class FailedLoginTracker:
+    def __init__(self, path: str = None, slots: int = TRACKER_SLOTS):
+        self.path = path or _default_path()
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        size = self.buckets * _BUCKET_BYTES
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            # New pages read as zeros, which is an empty slot
+            os.ftruncate(self._fd, size)
+        # Opened once; workers forked from a preloading master share the same mapping
+        self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED)
+        # fcntl locks keep other processes out of a bucket, but not other threads of this one
+        self._thread_lock = threading.Lock()
+        # Keyed hash so nobody can pick names that collide with, or evict, a given account
+        self._hash_key = hashlib.sha256(utils.SECRET_KEY.encode()).digest()[:32]
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return name.strip().lower()
+
+    def _key(self, name: str) -> int:
+        digest = hashlib.blake2b(self.normalize(name).encode(), digest_size=8, key=self._hash_key).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    @contextmanager
+    def _locked_bucket(self, key: int):
+        offset = (key % self.buckets) * _BUCKET_BYTES
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _BUCKET_BYTES, offset)
+            try:
+                yield offset
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _BUCKET_BYTES, offset)
+
+    @staticmethod
+    def _decayed(score: float, last: int, now: int) -> float:
+        if score <= 0:
+            return 0.0
+        return score * math.pow(0.5, max(0, now - last) / FAILURE_HALF_LIFE_SECONDS)
+
+    def _find(self, offset: int, key: int):
+        for i in range(BUCKET_SLOTS):
+            slot_offset = offset + i * _SLOT.size
+            entry = _SLOT.unpack_from(self._map, slot_offset)
+            if entry[0] == key:
+                return slot_offset, entry
+        return None, None
+
+    def retry_after(self, name: str) -> int:
+        """Seconds until the account may try again, 0 if it isn't locked."""
+        key = self._key(name)
+        now = int(time.time())
+        with self._locked_bucket(key) as offset:
+            _, entry = self._find(offset, key)
+        if entry is None:
+            return 0
+        return max(0, entry[3] - now)
+
+    def _claim(self, offset: int, key: int, now: int):
+        """The key's slot and its decayed score and lock, taking a slot if it has none."""
+        slot_offset, entry = self._find(offset, key)
+        if entry is not None:
+            _, score, last, locked_until = entry
+            return slot_offset, self._decayed(score, last, now), locked_until
+        # Take an empty slot or evict the one with the least recent trouble
+        slot_offset, lowest = offset, None
+        for i in range(BUCKET_SLOTS):
+            candidate = offset + i * _SLOT.size
+            other_key, score, last, locked_until = _SLOT.unpack_from(self._map, candidate)
+            weight = -1.0 if other_key == 0 else (
+                math.inf if locked_until > now else self._decayed(score, last, now))
+            if lowest is None or weight < lowest:
+                slot_offset, lowest = candidate, weight
+        return slot_offset, 0.0, 0
+
+    def record_failure(self, name: str, *aliases: str) -> int:
+        """
+        Count a failed attempt against name; returns the lockout in seconds it triggered (0 for none).
+
+        A lockout also applies to the aliases (the account's other identifiers), which are
+        checked before the account is looked up.
+        """
+        key = self._key(name)
+        now = int(time.time())
+        with self._locked_bucket(key) as offset:
+            slot_offset, score, locked_until = self._claim(offset, key, now)
+
+            score += 1
+            # Counted in whole failures: the decay between a quick run of attempts
+            # would otherwise keep the score just under the threshold
+            failures = round(score)
+            lockout = 0
+            if failures >= LOCKOUT_THRESHOLD:
+                lockout = min(LOCKOUT_MAX_SECONDS, LOCKOUT_BASE_SECONDS * 2 ** min(failures - LOCKOUT_THRESHOLD, 20))
+                locked_until = max(locked_until, now + lockout)
+            _SLOT.pack_into(self._map, slot_offset, key, score, now, locked_until)
+
+        if lockout:
+            for alias in aliases:
+                alias_key = self._key(alias)
+                if alias_key == key:
+                    continue
+                with self._locked_bucket(alias_key) as offset:
+                    slot_offset, alias_score, alias_locked_until = self._claim(offset, alias_key, now)
+                    _SLOT.pack_into(self._map, slot_offset, alias_key, alias_score, now,
+                                    max(alias_locked_until, locked_until))
+            logger.warning(f"Account {self.normalize(name)!r} locked for {lockout}s after {score:.1f} recent failed logins")
+        return lockout
+
+    def reset(self, *names: str) -> None:
+        """Forget failures after a successful login."""
+        for name in names:
+            key = self._key(name)
+            with self._locked_bucket(key) as offset:
+                slot_offset, _ = self._find(offset, key)
+                if slot_offset is not None:
+                    _SLOT.pack_into(self._map, slot_offset, 0, 0.0, 0, 0)
+
+    def stats(self) -> Dict[str, int]:
+        now = int(time.time())
+        tracked = locked = 0
+        for slot_offset in range(0, len(self._map), _SLOT.size):
+            key, _, _, locked_until = _SLOT.unpack_from(self._map, slot_offset)
+            if key:
+                tracked += 1
+                locked += locked_until > now
+        return {"tracked": tracked, "locked": locked, "slots": self.buckets * BUCKET_SLOTS}
+
+
+failed_logins = FailedLoginTracker()
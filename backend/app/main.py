@@ -1,10 +1,17 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+import asyncio
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from starlette.middleware.sessions import SessionMiddleware
 from app.auth import router as auth_router
-from app.database import engine
-from app import models
+from app.admin import router as admin_router
+from app.database import shard_engines
+from app import revocation, deadlines, profiler, memory, query_stats, breached_passwords, routing, sharding, responses, maintenance, capture, tracing, migrations
+from app.audit import audit_log
+from app.scheduler import scheduler
+from app.resilience import DatabaseUnavailable, breaker
+from app.health import readiness
+from app.concurrency import AdmissionControlMiddleware, admission
 import os
 import logging
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -35,7 +42,10 @@ try:
         try:
             # Set a short timeout for database operations
             import threading
-            db_setup_thread = threading.Thread(target=lambda: models.Base.metadata.create_all(bind=engine))
+            db_setup_thread = threading.Thread(
+                target=lambda: [migrations.setup(shard_engine) for shard_engine in shard_engines],
+                name="db-setup"
+            )
             db_setup_thread.daemon = True  # Allow app to exit even if thread is running
             db_setup_thread.start()
             logger.info("Database setup initiated in background thread")
@@ -45,6 +55,31 @@ try:
     
     # Call the function directly for now - we'll make it async for production
     setup_database()
+
+    # Open the breached password index before workers fork so they share one mapping
+    breached_passwords.get_index()
+
+    # Maintenance jobs (app/maintenance.py) run only in the elected worker
+    maintenance.register(scheduler)
+
+    # Keep the in-memory token revocation state in sync with other workers
+    @app.on_event("startup")
+    def start_background_tasks():
+        revocation.start_refresher()
+        readiness.start()
+        audit_log.start()
+        scheduler.start()
+        tracing.exporter.start()
+        profiler.install_signal_toggle()
+
+    @app.on_event("shutdown")
+    def stop_background_tasks():
+        revocation.stop_refresher()
+        readiness.stop()
+        audit_log.stop()
+        scheduler.stop()
+        capture.capture_log.close()
+        tracing.exporter.stop()
         
     # Rate limiting setup - with lighter settings
     limiter = Limiter(
@@ -56,15 +91,29 @@ try:
     # Apply rate limiter to FastAPI app
     app.state.limiter = limiter
     app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+    # Work that notices its deadline has passed answers with a clean 504
+    async def deadline_exceeded_handler(request: Request, exc: deadlines.DeadlineExceeded):
+        logger.warning(f"Deadline exceeded: {request.method} {request.url.path}: {exc}")
+        return Response(content="Request timed out", status_code=504)
+
+    app.add_exception_handler(deadlines.DeadlineExceeded, deadline_exceeded_handler)
+
+    # An open circuit breaker answers at once instead of waiting on connect timeouts
+    async def database_unavailable_handler(request: Request, exc: DatabaseUnavailable):
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Database temporarily unavailable, retry later"},
+            headers={"Retry-After": str(exc.retry_after)}
+        )
+
+    app.add_exception_handler(DatabaseUnavailable, database_unavailable_handler)
     
-    # Add CSRF protection middleware with appropriate secret key
-    secret_key = os.getenv("SECRET_KEY", "my-super-secret-key")
-    app.add_middleware(
-        SessionMiddleware, 
-        secret_key=secret_key,
-        # Lower max_age to reduce memory usage
-        max_age=3600  # 1 hour instead of default
-    )
+    # No session middleware: routes that need a session declare it (app/sessions.py)
+
+    # Shed load before requests queue behind bcrypt and the connection pool.
+    # Added before CORS so rejections still carry CORS headers.
+    app.add_middleware(AdmissionControlMiddleware, limiter=admission)
     
     # Setup CORS based on environment
     if ENVIRONMENT == "production":
@@ -78,7 +127,9 @@ try:
             ],
             allow_credentials=True,
             allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-            allow_headers=["Content-Type", "Authorization", "X-CSRF-Token"],
+            allow_headers=["Content-Type", "Authorization", "X-CSRF-Token", "traceparent"],
+            # Lets the frontend read the trace id of a slow or failed request
+            expose_headers=[tracing.TRACE_ID_HEADER],
         )
         
         # Add trusted host middleware in production, but handle Azure host names
@@ -98,10 +149,48 @@ try:
             allow_credentials=True,
             allow_methods=["*"],
             allow_headers=["*"],
+            expose_headers=[tracing.TRACE_ID_HEADER],
         )
     
+    # Outside admission control, so time queued for a slot is part of the request's trace
+    if tracing.TRACING_ENABLED:
+        app.add_middleware(tracing.TracingMiddleware)
+        logger.info(f"Tracing enabled: {tracing.TRACE_SAMPLE_RATE:.1%} of requests and all slower than "
+                    f"{tracing.TRACE_SLOW_MS:.0f} ms or failing")
+
+    # Outermost, so requests shed by admission control are captured too
+    if capture.CAPTURE_ENABLED:
+        app.add_middleware(capture.TrafficCaptureMiddleware)
+        logger.info(f"Traffic capture enabled in {capture.TRAFFIC_CAPTURE_DIR}")
+
     logger.info("Middleware configured successfully")
     
+    async def call_with_deadline(request: Request, call_next):
+        """Run the rest of the stack within the route's deadline."""
+        path = request.url.path
+        budget = deadlines.budget_for(path)
+        token = deadlines.start(budget)
+        queries_token = query_stats.start_request()
+        try:
+            if budget > 0:
+                return await asyncio.wait_for(call_next(request), timeout=budget)
+            return await call_next(request)
+        except asyncio.TimeoutError:
+            logger.warning(f"Request exceeded {budget}s deadline: {request.method} {path}")
+            return Response(content="Request timed out", status_code=504)
+        except Exception as e:
+            # A database statement timeout surfaces as a driver error once the budget is spent
+            if deadlines.expired():
+                logger.warning(f"Request exceeded {budget}s deadline: {request.method} {path}: {e}")
+                return Response(content="Request timed out", status_code=504)
+            logger.error(f"Request processing error: {e}")
+            return Response(content="Server error", status_code=500)
+        finally:
+            query_stats.end_request(path, queries_token)
+            deadlines.reset(token)
+            # Restart this worker once it has actually grown, rather than every N requests
+            memory.recycle_policy.after_request()
+
     # Enhanced request middleware for debugging and reliability
     @app.middleware("http")
     async def request_middleware(request: Request, call_next):
@@ -115,12 +204,7 @@ try:
             
         # Skip CSRF check in development or for safe methods
         if ENVIRONMENT != "production" or request.method in ["GET", "HEAD", "OPTIONS"]:
-            try:
-                response = await call_next(request)
-                return response
-            except Exception as e:
-                logger.error(f"Request processing error: {e}")
-                return Response(content="Server error", status_code=500)
+            return await call_with_deadline(request, call_next)
         
         # Check for token, but don't fail the entire app if missing
         try:
@@ -134,21 +218,30 @@ try:
             # Continue request if there's an error with CSRF check
         
         # Wrap call_next with timeout to prevent hanging requests
-        try:
-            response = await call_next(request)
-            return response
-        except Exception as e:
-            logger.error(f"Request processing error: {e}")
-            return Response(content="Server error", status_code=500)
+        return await call_with_deadline(request, call_next)
         
     # Health check endpoint
     @app.get("/health")
     async def health_check():
         """Simple health check endpoint that doesn't touch the database"""
-        return {"status": "healthy"}
+        return responses.HEALTHY()
+
+    # Readiness endpoint for the load balancer
+    @app.get("/ready")
+    async def readiness_check(response: Response):
+        """Report cached database reachability, pool saturation, email queue depth, admission and breaker stats"""
+        if not readiness.is_ready:
+            response.status_code = 503
+        state = readiness.state()
+        state["admission"] = admission.stats()
+        state["database_breaker"] = breaker.status()
+        state["database_routing"] = routing.status()
+        state["database_shards"] = sharding.status()
+        return state
         
 except Exception as e:
     logger.error(f"Error during app setup: {e}")
     # Let the app continue with minimal functionality
 
 app.include_router(auth_router)
+app.include_router(admin_router)
@@ -0,0 +1,74 @@
+"""
+Periodic database maintenance, run by the scheduler leader (app/scheduler.py).
+app/main.py adds the jobs to the worker's scheduler with ``register()``.
+
+Each job works through its table in chunks of ``MAINTENANCE_BATCH_SIZE``
+rows, one short transaction per chunk, and yields after each one. No job
+holds locks on a large range of rows, and each stops soon after the worker
+shuts down. A job that is stopped partway resumes safely on its next run.
+"""
+import os
+from datetime import datetime
+from typing import Iterator
+
+from sqlalchemy import delete, select, update
+
+from app import audit, database, models
+from app.scheduler import Scheduler
+
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", 500))
+REFRESH_TOKEN_PURGE_SECONDS = int(os.getenv("REFRESH_TOKEN_PURGE_SECONDS", 900))
+REVOKED_TOKEN_PURGE_SECONDS = int(os.getenv("REVOKED_TOKEN_PURGE_SECONDS", 3600))
+
+
+def purge_expired_refresh_tokens() -> Iterator[int]:
+    """Clear stored refresh tokens past their expiry, on every shard."""
+    users = models.User.__table__
+    for shard_engine in database.shard_engines:
+        # Walk the primary key, so each chunk costs the same with or without expired rows
+        last_id = ""
+        while True:
+            now = datetime.utcnow()
+            with shard_engine.begin() as conn:
+                ids = conn.execute(
+                    select(users.c.id).where(users.c.id > last_id).order_by(users.c.id).limit(MAINTENANCE_BATCH_SIZE)
+                ).scalars().all()
+                if not ids:
+                    break
+                purged = conn.execute(
+                    update(users)
+                    .where(users.c.id >= ids[0], users.c.id <= ids[-1], users.c.refresh_token_expires_at < now)
+                    .values(refresh_token=None, refresh_token_expires_at=None)
+                ).rowcount
+            yield purged
+            if len(ids) < MAINTENANCE_BATCH_SIZE:
+                break
+            last_id = ids[-1]
+
+
+def purge_revoked_tokens() -> Iterator[int]:
+    """Delete deny list rows for tokens that have expired anyway."""
+    revoked = models.RevokedToken.__table__
+    while True:
+        with database.engine.begin() as conn:
+            jtis = conn.execute(
+                select(revoked.c.jti).where(revoked.c.expires_at < datetime.utcnow()).limit(MAINTENANCE_BATCH_SIZE)
+            ).scalars().all()
+            if jtis:
+                conn.execute(delete(revoked).where(revoked.c.jti.in_(jtis)))
+        yield len(jtis)
+        if len(jtis) < MAINTENANCE_BATCH_SIZE:
+            return
+
+
+def drop_expired_audit_tables() -> Iterator[int]:
+    """Drop daily audit tables older than AUDIT_RETENTION_DAYS."""
+    yield len(audit.audit_log.drop_expired_tables())
+
+
+def register(scheduler: Scheduler) -> None:
+    """Add the maintenance jobs to a scheduler."""
+    scheduler.job("purge-expired-refresh-tokens", interval=REFRESH_TOKEN_PURGE_SECONDS)(purge_expired_refresh_tokens)
+    scheduler.job("purge-revoked-tokens", interval=REVOKED_TOKEN_PURGE_SECONDS)(purge_revoked_tokens)
+    if audit.AUDIT_RETENTION_DAYS > 0:
+        scheduler.job("drop-expired-audit-tables", interval=audit.RETENTION_CHECK_SECONDS)(drop_expired_audit_tables)
@@ -0,0 +1,178 @@
+"""
+Worker memory instrumentation and RSS-based recycling.
+
+Reports resident memory, garbage collector statistics and, when tracemalloc
+is switched on, the allocation sites that grew since the previous snapshot.
+The recycle policy replaces gunicorn's fixed ``max_requests``: a worker asks
+to be restarted only once its private memory actually passes a threshold.
+RSS alone would also count the pages still shared copy-on-write with the
+preloaded master, which are no cost of the worker's own.
+"""
+import gc
+import logging
+import os
+import random
+import resource
+import signal
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 0 disables RSS-based recycling
+MAX_WORKER_RSS_MB = float(os.getenv("MAX_WORKER_RSS_MB", 350))
+
+# Reading /proc is cheap, but there's no need to do it on every request
+RSS_CHECK_EVERY_REQUESTS = int(os.getenv("RSS_CHECK_EVERY_REQUESTS", 50))
+
+# Don't recycle a worker that starts out above the threshold over and over
+MIN_WORKER_UPTIME_SECONDS = 60
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size; falls back to peak RSS where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def private_bytes() -> int:
+    """Resident memory only this process maps (Private_Clean + Private_Dirty); RSS where that isn't available."""
+    try:
+        private = 0
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                    private += int(line.split()[1]) * 1024
+        return private
+    except (OSError, IndexError, ValueError):
+        # smaps_rollup needs Linux 4.14
+        return rss_bytes()
+
+
+def gc_stats() -> Dict[str, Any]:
+    return {
+        "counts": gc.get_count(),
+        "thresholds": gc.get_threshold(),
+        "generations": gc.get_stats(),
+        "frozen": gc.get_freeze_count(),
+    }
+
+
+class AllocationTracker:
+    """tracemalloc wrapper that reports growth between successive snapshots."""
+
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._previous = None
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self._previous = None
+
+    def top_growth(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Allocation sites that grew the most since the previous call."""
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if self._previous is None:
+            stats = snapshot.statistics("lineno")
+            sites = [{"site": str(s.traceback), "size_kb": round(s.size / 1024, 1), "count": s.count} for s in stats[:limit]]
+        else:
+            stats = snapshot.compare_to(self._previous, "lineno")
+            sites = [{
+                "site": str(s.traceback),
+                "size_kb": round(s.size / 1024, 1),
+                "size_diff_kb": round(s.size_diff / 1024, 1),
+                "count_diff": s.count_diff,
+            } for s in stats[:limit]]
+        self._previous = snapshot
+        return sites
+
+
+class RecyclePolicy:
+    def __init__(self, max_rss_mb: float = MAX_WORKER_RSS_MB):
+        self.max_rss_mb = max_rss_mb
+        self.reset()
+
+    def reset(self) -> None:
+        """Start counting for a new worker process (the app may have been imported before fork)."""
+        # Spread thresholds a little so workers started together don't all restart together
+        self.max_rss_bytes = int(self.max_rss_mb * 1024 * 1024 * random.uniform(0.95, 1.05))
+        self.requests = 0
+        self.started_at = time.monotonic()
+        self.recycle_requested = False
+        self._under_gunicorn: Optional[bool] = None
+
+    def under_gunicorn(self) -> bool:
+        """Only a gunicorn worker can exit and be replaced; a standalone uvicorn would just stop."""
+        if self._under_gunicorn is None:
+            try:
+                with open(f"/proc/{os.getppid()}/cmdline", "rb") as f:
+                    self._under_gunicorn = b"gunicorn" in f.read()
+            except OSError:
+                self._under_gunicorn = False
+        return self._under_gunicorn
+
+    def after_request(self) -> None:
+        self.requests += 1
+        if (self.max_rss_bytes <= 0 or self.recycle_requested
+                or self.requests % RSS_CHECK_EVERY_REQUESTS):
+            return
+        private = private_bytes()
+        if private < self.max_rss_bytes or time.monotonic() - self.started_at < MIN_WORKER_UPTIME_SECONDS:
+            return
+        if not self.under_gunicorn():
+            return
+
+        self.recycle_requested = True
+        logger.warning(
+            f"Worker {os.getpid()} private memory {private / 1048576:.0f} MB exceeds {self.max_rss_bytes / 1048576:.0f} MB "
+            f"after {self.requests} requests, requesting graceful restart"
+        )
+        # The uvicorn worker treats SIGTERM as a graceful shutdown: in-flight
+        # requests finish and the gunicorn master forks a replacement
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "max_rss_mb": round(self.max_rss_bytes / 1048576, 1),
+            "requests": self.requests,
+            "uptime_seconds": round(time.monotonic() - self.started_at),
+            "recycle_requested": self.recycle_requested,
+        }
+
+
+allocations = AllocationTracker()
+recycle_policy = RecyclePolicy()
+
+
+def report() -> Dict[str, Any]:
+    return {
+        "pid": os.getpid(),
+        "rss_mb": round(rss_bytes() / 1048576, 1),
+        "private_mb": round(private_bytes() / 1048576, 1),
+        "gc": gc_stats(),
+        "tracemalloc": {
+            "tracing": allocations.tracing,
+            "traced_mb": round(tracemalloc.get_traced_memory()[0] / 1048576, 1) if allocations.tracing else None,
+        },
+        "recycle": recycle_policy.status(),
+    }
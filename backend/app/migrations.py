@@ -0,0 +1,57 @@
+"""
+Schema upgrades that create_all can't make.
+
+create_all only creates missing tables, so columns and indexes added to an
+existing table (users.token_version, the users indexes) are applied here at
+startup, after create_all, on each shard. Every step checks the live schema
+first, so running it again or from several processes is harmless.
+"""
+import logging
+from typing import List
+
+from sqlalchemy import inspect, text
+
+from app import models
+
+logger = logging.getLogger(__name__)
+
+# Columns added to users after the table first shipped: name -> DDL type and default
+ADDED_USER_COLUMNS = {
+    "token_version": "INT NOT NULL DEFAULT 0",
+}
+
+
+def upgrade(engine) -> List[str]:
+    """Add missing users columns and indexes; returns what was applied."""
+    # The inspector doesn't apply the SQLite schema_translate_map
+    schema = None if engine.dialect.name == "sqlite" else "dbo"
+    prefix = f"{schema}." if schema else ""
+    inspector = inspect(engine)
+    applied = []
+
+    columns = {column["name"] for column in inspector.get_columns("users", schema=schema)}
+    for name, ddl in ADDED_USER_COLUMNS.items():
+        if name not in columns:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {prefix}users ADD {name} {ddl}"))
+            applied.append(f"column users.{name}")
+
+    indexes = {index["name"] for index in inspector.get_indexes("users", schema=schema)}
+    for index in models.User.__table__.indexes:
+        if index.name not in indexes:
+            index.create(bind=engine)
+            applied.append(f"index {index.name}")
+
+    if applied:
+        logger.info(f"Schema upgraded on {engine.url.database}: {', '.join(applied)}")
+    return applied
+
+
+def setup(engine) -> None:
+    """Create missing tables, then apply upgrades to existing ones."""
+    models.Base.metadata.create_all(bind=engine)
+    try:
+        upgrade(engine)
+    except Exception as e:
+        # Another process may have applied the same step first
+        logger.error(f"Schema upgrade failed on {engine.url.database}: {e}")
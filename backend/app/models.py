@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Boolean
+from sqlalchemy import Column, String, DateTime, Boolean, Integer, Index
 from datetime import datetime
 import uuid
 import os
@@ -12,7 +12,13 @@ id_column_type = String(36)
 
 class User(Base):
     __tablename__ = "users"
-    __table_args__ = {'schema': 'dbo'}  # SQL Server uses dbo schema
+    __table_args__ = (
+        # Keyset pagination order for the admin listing and export
+        Index("ix_users_created_at_id", "created_at", "id"),
+        # Each worker's revocation sync reads users changed since its last poll
+        Index("ix_users_updated_at", "updated_at"),
+        {'schema': 'dbo'},  # SQL Server uses dbo schema
+    )
 
     id = Column(id_column_type, primary_key=True, default=lambda: str(uuid.uuid4()))
     email = Column(String(255), unique=True, nullable=False)
@@ -22,6 +28,8 @@ class User(Base):
     # Auth fields
     refresh_token = Column(String(512), nullable=True)
     refresh_token_expires_at = Column(DateTime, nullable=True)
+    # Bumped to invalidate every token issued to this user (password reset, log out everywhere)
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)
     
     # Status fields
     is_active = Column(Boolean, default=True)
@@ -57,4 +65,25 @@ class User(Base):
         return getattr(self, '_password_reset_token', None)
         
     def get_password_reset_expires_at(self):
-        return getattr(self, '_password_reset_expires_at', None)
\ No newline at end of file
+        return getattr(self, '_password_reset_expires_at', None)
+
+
+class RevokedToken(Base):
+    """Individually revoked token ids, kept only until the token would have expired."""
+    __tablename__ = "revoked_tokens"
+    __table_args__ = {'schema': 'dbo'}
+
+    jti = Column(String(36), primary_key=True)
+    user_id = Column(id_column_type, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    revoked_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class UserDirectory(Base):
+    """Which shard holds each user, by normalized email and username; only used when users are sharded."""
+    __tablename__ = "user_directory"
+    __table_args__ = {'schema': 'dbo'}
+
+    lookup_key = Column(String(300), primary_key=True)  # "email:<address>" or "username:<name>"
+    user_id = Column(id_column_type, nullable=False, index=True)
+    shard = Column(Integer, nullable=False)
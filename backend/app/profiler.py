@@ -0,0 +1,172 @@
+"""
+On-demand stack-sampling profiler for a single worker.
+
+A timer signal interrupts the main thread at a fixed rate; the handler walks
+``sys._current_frames()`` and counts each thread's stack. Stopping writes the
+counts in collapsed-stack format (``frame;frame;frame count`` per line), which
+flamegraph.pl, speedscope and inferno read directly.
+
+Signal handlers only run on the main thread, which is the event loop thread in
+a uvicorn worker, so start and stop must be called from there (an async
+endpoint or the toggle signal handler).
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/dreamapp-profiles")
+DEFAULT_RATE_HZ = int(os.getenv("PROFILER_RATE_HZ", 100))
+DEFAULT_DURATION_SECONDS = float(os.getenv("PROFILER_DURATION_SECONDS", 30))
+MAX_RATE_HZ = 1000
+MAX_DURATION_SECONDS = 600
+
+# Signal that toggles profiling on a worker: kill -USR2 <worker pid>
+TOGGLE_SIGNAL = getattr(signal, os.getenv("PROFILER_SIGNAL", "SIGUSR2"), None)
+
+# wall samples every thread whether or not it is running, which shows time
+# spent waiting on the database; cpu only advances while the process uses CPU
+TIMERS = {
+    "wall": (signal.ITIMER_REAL, signal.SIGALRM),
+    "cpu": (signal.ITIMER_PROF, signal.SIGPROF),
+}
+
+# Threads parked in these modules are idle and would drown out real work
+IDLE_MODULES = ("threading.py", "selectors.py", "queue.py", "concurrent/futures/thread.py")
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.running = False
+        self.mode = "wall"
+        self.rate_hz = DEFAULT_RATE_HZ
+        self.started_at: Optional[float] = None
+        self.ends_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.samples = 0
+        self.last_output: Optional[str] = None
+        self._stacks: Counter = Counter()
+        self._labels: Dict[Any, str] = {}
+        self._handler_seconds = 0.0
+        self._previous_handler = None
+
+    def start(self, rate_hz: int = DEFAULT_RATE_HZ, duration: float = DEFAULT_DURATION_SECONDS, mode: str = "wall") -> None:
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+        if mode not in TIMERS:
+            raise ValueError(f"Unknown profiler mode: {mode}")
+
+        self.mode = mode
+        self.rate_hz = max(1, min(int(rate_hz), MAX_RATE_HZ))
+        duration = max(0.1, min(float(duration), MAX_DURATION_SECONDS))
+        self._stacks = Counter()
+        self.samples = 0
+        self._handler_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.ends_at = self.started_at + duration
+
+        timer, signum = TIMERS[mode]
+        self._previous_handler = signal.signal(signum, self._sample)
+        interval = 1.0 / self.rate_hz
+        signal.setitimer(timer, interval, interval)
+        self.running = True
+        logger.info(f"Profiler started in worker {os.getpid()}: {mode} mode, {self.rate_hz} Hz, {duration}s")
+
+    def stop(self) -> Optional[str]:
+        """Stop sampling and write the collapsed stacks. Returns the output path."""
+        if not self.running:
+            return None
+        timer, signum = TIMERS[self.mode]
+        signal.setitimer(timer, 0, 0)
+        signal.signal(signum, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+        self.stopped_at = time.monotonic()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}-{self.mode}.folded")
+        with open(path, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.last_output = path
+        logger.info(f"Profiler stopped in worker {os.getpid()}: {self.samples} samples written to {path} "
+                    f"(overhead {self.overhead():.2%})")
+        return path
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+            self._labels[code] = label
+        return label
+
+    def _sample(self, signum, frame) -> None:
+        start = time.perf_counter()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        main_ident = threading.main_thread().ident
+
+        for ident, thread_frame in sys._current_frames().items():
+            # For the main thread, start at the interrupted frame rather than this handler
+            if ident == main_ident:
+                thread_frame = frame
+            if thread_frame is None or thread_frame.f_code.co_filename.endswith(IDLE_MODULES):
+                continue
+            labels = []
+            while thread_frame is not None:
+                labels.append(self._label(thread_frame.f_code))
+                thread_frame = thread_frame.f_back
+            labels.append(thread_names.get(ident, str(ident)))
+            labels.reverse()
+            self._stacks[";".join(labels)] += 1
+
+        self.samples += 1
+        self._handler_seconds += time.perf_counter() - start
+        if time.monotonic() >= self.ends_at:
+            self.stop()
+
+    def overhead(self) -> float:
+        """Share of wall time spent inside the sampling handler."""
+        if self.started_at is None:
+            return 0.0
+        elapsed = (time.monotonic() if self.running else self.stopped_at) - self.started_at
+        return self._handler_seconds / elapsed if elapsed > 0 else 0.0
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "running": self.running,
+            "mode": self.mode,
+            "rate_hz": self.rate_hz,
+            "samples": self.samples,
+            "distinct_stacks": len(self._stacks),
+            "overhead": round(self.overhead(), 4),
+            "seconds_left": round(max(0.0, self.ends_at - time.monotonic()), 1) if self.running else None,
+            "last_output": self.last_output,
+        }
+
+
+profiler = SamplingProfiler()
+
+
+def _toggle(signum, frame) -> None:
+    if profiler.running:
+        profiler.stop()
+    else:
+        profiler.start()
+
+
+def install_signal_toggle() -> None:
+    """Let operators start and stop profiling a worker with a Unix signal."""
+    if TOGGLE_SIGNAL is None:
+        return
+    try:
+        signal.signal(TOGGLE_SIGNAL, _toggle)
+        logger.info(f"Profiler toggle installed on {TOGGLE_SIGNAL.name} for worker {os.getpid()}")
+    except ValueError:
+        # Not on the main thread (e.g. some test runners); the admin endpoint still works
+        logger.warning("Could not install profiler signal toggle outside the main thread")
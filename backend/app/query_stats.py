@@ -0,0 +1,216 @@
+"""
+SQL query instrumentation.
+
+Cursor execution hooks on the engine count statements and time spent per
+request and per route, log statements slower than a threshold in normalized
+form, and flag routes that issue more statements than their budget allows.
+Set QUERY_BUDGET_STRICT=1 (as the benchmarks do) to turn an exceeded budget
+into a QueryBudgetWarning raised as an error. In a traced request each
+statement is also recorded as a db.query span (app/tracing.py).
+"""
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+import warnings
+from typing import Any, Dict, Optional
+
+from sqlalchemy import event
+
+from app import sharding, tracing
+from app.database import all_engines, engine as primary_engine, replica_engines, shard_engines
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "").lower() in ("1", "true", "yes")
+
+# Maximum statements per request. Anything above this is a round trip someone added.
+QUERY_BUDGETS: Dict[str, int] = {
+    "/register": 2,
+    "/token": 2,
+    "/refresh": 2,
+    "/logout": 2,
+    "/logout-all": 2,
+    "/reset-password": 2,
+    "/request-password-reset": 1,
+    "/verify-email": 1,
+    "/introspect": 1,
+    "/admin/users": 1,
+    "/admin/users/export": 1,
+    "/me": 0,
+    "/ping": 0,
+    "/health": 0,
+    "/ready": 0,
+}
+
+# Statements a route adds when users are sharded (app/sharding.py): a directory lookup per
+# email, username or id it finds users by without a token's shard claim, and for /register
+# the directory insert. Added to the route's budget while sharding is enabled.
+SHARDED_EXTRA_QUERIES: Dict[str, int] = {
+    "/register": 3,
+    "/token": 1,
+    "/reset-password": 1,
+    "/request-password-reset": 1,
+    "/verify-email": 1,
+}
+# Routes that query every shard, so their budget applies per shard
+SHARDED_SCATTER_ROUTES = {"/introspect", "/admin/users", "/admin/users/export"}
+
+# Bound the number of tracked routes so arbitrary paths can't grow memory
+MAX_TRACKED_ROUTES = 64
+
+
+class QueryBudgetWarning(UserWarning):
+    """A route issued more SQL statements than its budget."""
+
+
+class RequestQueries:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+_current: contextvars.ContextVar[Optional[RequestQueries]] = contextvars.ContextVar("request_queries", default=None)
+
+_lock = threading.Lock()
+_routes: Dict[str, Dict[str, float]] = {}
+_totals = {"queries": 0, "seconds": 0.0, "slow": 0}
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """Collapse literals, IN lists and whitespace so similar statements group together."""
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _IN_LIST.sub("(...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def budget_for(route: str) -> Optional[int]:
+    budget = QUERY_BUDGETS.get(route)
+    if budget is not None and sharding.enabled():
+        if route in SHARDED_SCATTER_ROUTES:
+            budget *= len(sharding.shards)
+        budget += SHARDED_EXTRA_QUERIES.get(route, 0)
+    return budget
+
+
+def start_request() -> contextvars.Token:
+    return _current.set(RequestQueries())
+
+
+def end_request(route: str, token: contextvars.Token) -> RequestQueries:
+    """Record the finished request's statements against its route and check the budget."""
+    queries = _current.get()
+    _current.reset(token)
+
+    with _lock:
+        stats = _routes.get(route)
+        if stats is None and len(_routes) < MAX_TRACKED_ROUTES:
+            stats = _routes[route] = {"requests": 0, "queries": 0, "seconds": 0.0, "max_queries": 0, "over_budget": 0}
+        if stats is not None:
+            stats["requests"] += 1
+            stats["queries"] += queries.count
+            stats["seconds"] += queries.seconds
+            stats["max_queries"] = max(stats["max_queries"], queries.count)
+
+    budget = budget_for(route)
+    if budget is not None and queries.count > budget:
+        if stats is not None:
+            with _lock:
+                stats["over_budget"] += 1
+        message = f"{route} issued {queries.count} SQL statements, budget is {budget}"
+        logger.warning(message)
+        if QUERY_BUDGET_STRICT:
+            warnings.warn(message, QueryBudgetWarning)
+    return queries
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        routes = {}
+        for route, stats in _routes.items():
+            requests = stats["requests"] or 1
+            routes[route] = {
+                "requests": stats["requests"],
+                "queries_per_request": round(stats["queries"] / requests, 2),
+                "query_ms_per_request": round(stats["seconds"] * 1000 / requests, 2),
+                "max_queries": stats["max_queries"],
+                "budget": budget_for(route),
+                "over_budget": stats["over_budget"],
+            }
+        return {
+            "total_queries": _totals["queries"],
+            "total_query_seconds": round(_totals["seconds"], 3),
+            "slow_queries": _totals["slow"],
+            "slow_query_ms": SLOW_QUERY_MS,
+            "routes": routes,
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _routes.clear()
+        _totals.update(queries=0, seconds=0.0, slow=0)
+
+
+# Which database a span's statement went to
+_ENGINE_NAMES = {id(primary_engine): "primary"}
+_ENGINE_NAMES.update((id(e), f"replica-{n}") for n, e in enumerate(replica_engines, 1))
+_ENGINE_NAMES.update((id(e), f"shard-{n}") for n, e in enumerate(shard_engines[1:], 1))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context so a failed statement leaves nothing behind
+    context._query_started = time.perf_counter()
+    span = tracing.start_span("db.query", tracing.KIND_CLIENT)
+    if span is not None:
+        # Normalized at export time, off the request path; parameters are never recorded
+        span.attributes.update({
+            "db.system": conn.dialect.name,
+            "db.instance": _ENGINE_NAMES.get(id(conn.engine), "other"),
+            "db.statement": statement,
+            "db.executemany": executemany,
+        })
+    context._trace_span = span
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    if context._trace_span is not None:
+        context._trace_span.finish()
+
+    queries = _current.get()
+    if queries is not None:
+        queries.count += 1
+        queries.seconds += elapsed
+
+    slow = elapsed * 1000 >= SLOW_QUERY_MS
+    with _lock:
+        _totals["queries"] += 1
+        _totals["seconds"] += elapsed
+        if slow:
+            _totals["slow"] += 1
+    if slow:
+        logger.warning(f"Slow query ({elapsed * 1000:.0f} ms): {normalize(statement)}")
+
+
+def _handle_error(exception_context):
+    span = getattr(exception_context.execution_context, "_trace_span", None)
+    if span is not None:
+        span.finish(type(exception_context.original_exception).__name__)
+
+
+for _engine in all_engines:
+    event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(_engine, "handle_error", _handle_error)
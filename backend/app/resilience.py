@@ -0,0 +1,230 @@
+"""
+Database resilience: transient error classification, jittered retry for
+idempotent reads, and a circuit breaker.
+
+Engine hooks feed every database error and success into the breaker. After
+``DB_BREAKER_FAILURES`` transient errors in a row it opens (statement
+timeouts imposed by request deadlines don't count), and ``get_db``
+turns requests away with a 503 straight away instead of letting each one sit
+in connect and pool timeouts while Azure SQL fails over. After
+``DB_BREAKER_OPEN_SECONDS`` it half-opens and lets ``DB_BREAKER_PROBES``
+requests through; the first success closes it, a failure opens it again.
+Background work (the readiness probe in particular) keeps touching the
+database while the breaker is open, so recovery is noticed within seconds.
+"""
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", 5))
+BREAKER_OPEN_SECONDS = float(os.getenv("DB_BREAKER_OPEN_SECONDS", 10))
+BREAKER_PROBES = int(os.getenv("DB_BREAKER_PROBES", 2))
+
+RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", 3))
+RETRY_BASE_SECONDS = float(os.getenv("DB_RETRY_BASE_SECONDS", 0.1))
+RETRY_MAX_SECONDS = 2.0
+
+# Azure SQL errors that clear up on their own: failover, throttling, dropped connections, deadlocks
+TRANSIENT_ERROR_NUMBERS = {
+    -2, 20, 64, 233, 1205, 4060, 4221, 10053, 10054, 10060, 10928, 10929,
+    40143, 40197, 40501, 40540, 40613, 42108, 42109, 49918, 49919, 49920,
+}
+# ODBC states for lost links, failed connects, timeouts and serialization failures
+TRANSIENT_SQLSTATES = {"08S01", "08001", "08004", "08007", "HYT00", "HYT01", "40001"}
+# Timeouts: the pyodbc states, and SQL Server's native "Timeout expired"
+TIMEOUT_SQLSTATES = {"HYT00", "HYT01"}
+TIMEOUT_ERROR_NUMBERS = {-2}
+
+_ERROR_NUMBER = re.compile(r"\((-?\d+)\)")
+
+T = TypeVar("T")
+
+
+class DatabaseUnavailable(Exception):
+    """The circuit breaker is open; the database is presumed down."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Database temporarily unavailable")
+        self.retry_after = retry_after
+
+
+def _classify(exc: BaseException, sqlstates, error_numbers) -> bool:
+    args = getattr(exc, "args", ())
+    # pyodbc errors are (sqlstate, message), with native error numbers in the message
+    if len(args) >= 2 and isinstance(args[0], str) and args[0] in sqlstates:
+        return True
+    message = " ".join(str(arg) for arg in args)
+    return any(int(number) in error_numbers for number in _ERROR_NUMBER.findall(message))
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether an error is worth retrying."""
+    if isinstance(exc, DBAPIError):
+        if exc.connection_invalidated:
+            return True
+        exc = exc.orig if exc.orig is not None else exc
+    return _classify(exc, TRANSIENT_SQLSTATES, TRANSIENT_ERROR_NUMBERS)
+
+
+def is_timeout(exc: BaseException) -> bool:
+    if isinstance(exc, DBAPIError):
+        exc = exc.orig if exc.orig is not None else exc
+    return _classify(exc, TIMEOUT_SQLSTATES, TIMEOUT_ERROR_NUMBERS)
+
+
+def counts_against_breaker(exc: BaseException, connected: bool, is_disconnect: bool = False) -> bool:
+    """
+    Whether an error says the database itself is unhealthy.
+
+    A timeout on an established connection is the statement timeout a request's
+    deadline imposed (app/deadlines.py): slow requests running out of their own
+    budget must not open the breaker for every route. Timeouts while connecting
+    still count.
+    """
+    if connected and is_timeout(exc):
+        return False
+    return is_disconnect or is_transient(exc)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 probes: int = BREAKER_PROBES):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.outage_started: Optional[float] = None
+        self._state_changed_at = time.monotonic()
+        self._probes_in_flight = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self.transient_errors = 0
+
+    def before_request(self) -> None:
+        """Let a request through or raise DatabaseUnavailable."""
+        if self.state == self.CLOSED:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Also restarts probing if the last probes never reached the database
+            if self.state != self.CLOSED and now - self._state_changed_at >= self.open_seconds:
+                if self.state == self.OPEN:
+                    logger.info("Database circuit breaker half-open, letting probe requests through")
+                self.state = self.HALF_OPEN
+                self._state_changed_at = now
+                self._probes_in_flight = 0
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return
+            self.rejected += 1
+            raise DatabaseUnavailable(self.retry_after())
+
+    def record_success(self) -> None:
+        # Called for every statement; the common case takes no lock
+        if self.state == self.CLOSED and self.consecutive_failures == 0:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Database circuit breaker closed after {self.outage_seconds():.1f}s")
+                self._state_changed_at = time.monotonic()
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.outage_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.transient_errors += 1
+            self.consecutive_failures += 1
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                logger.warning("Database circuit breaker probe failed, reopening")
+                self.state = self.OPEN
+                self._state_changed_at = now
+            elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+                logger.error(f"Database circuit breaker opened after {self.consecutive_failures} transient errors")
+                self.state = self.OPEN
+                self._state_changed_at = self.outage_started = now
+                self.times_opened += 1
+
+    def outage_seconds(self) -> float:
+        return time.monotonic() - self.outage_started if self.outage_started else 0.0
+
+    def retry_after(self) -> int:
+        waited = time.monotonic() - self._state_changed_at
+        return max(1, int(self.open_seconds - waited + 0.999))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "outage_seconds": round(self.outage_seconds(), 1),
+            "times_opened": self.times_opened,
+            "rejected_requests": self.rejected,
+            "transient_errors": self.transient_errors,
+        }
+
+
+breaker = CircuitBreaker()
+
+
+def install(engine) -> None:
+    """Feed an engine's statement outcomes into the breaker."""
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(context):
+        from app import deadlines
+
+        # Whatever the error, work past its request's deadline was cut short by the caller
+        if context.connection is not None and deadlines.expired():
+            return
+        if counts_against_breaker(context.original_exception, context.connection is not None,
+                                  context.is_disconnect):
+            breaker.record_failure()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _on_success(conn, cursor, statement, parameters, context, executemany):
+        breaker.record_success()
+
+
+def retry_read(db, read: Callable[[], T], attempts: int = RETRY_ATTEMPTS) -> T:
+    """
+    Run an idempotent read, retrying transient errors with full-jitter backoff.
+
+    Only for reads: the session is rolled back between attempts, so anything
+    pending in it would be lost.
+    """
+    from app import deadlines
+
+    for attempt in range(attempts):
+        try:
+            return read()
+        except DBAPIError as e:
+            if attempt == attempts - 1 or not is_transient(e):
+                raise
+            db.rollback()
+            delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+            left = deadlines.remaining()
+            if left is not None and delay >= left:
+                raise
+            logger.warning(f"Transient database error, retrying in {delay:.2f}s: {e.orig or e}")
+            time.sleep(delay)
+            # Don't keep hammering a database the breaker has given up on
+            breaker.before_request()
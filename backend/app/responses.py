@@ -0,0 +1,73 @@
+"""
+Fast response rendering for the auth routes.
+
+FastAPI's default path validates a route's return value against its
+``response_model`` (from ORM attributes for ``UserOut``), converts it with
+``jsonable_encoder`` and encodes it with the standard ``json`` module. The
+auth routes skip all of that: they build their response models with
+``model_construct`` from values that are already valid, and return them as
+a ``Response`` rendered by pydantic's serializer. Fixed messages are
+encoded once at import. Anything else the router returns goes through
+``FastJSONResponse``, which uses orjson when it is installed.
+
+A returned ``Response`` bypasses FastAPI's merging of headers set on the
+injected ``response`` parameter, so the helpers here copy them (cookies).
+
+``benchmarks/bench_serialization.py`` compares both paths per route.
+"""
+import json
+from typing import Any, Optional
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def dumps(content: Any) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _respond(body: bytes, sub_response: Optional[Response], status_code: int) -> Response:
+    response = Response(content=body, status_code=status_code, media_type="application/json")
+    if sub_response is not None:
+        response.headers.raw.extend(sub_response.headers.raw)
+    return response
+
+
+def model_response(model: BaseModel, sub_response: Optional[Response] = None, status_code: int = 200) -> Response:
+    """Render an already valid model without validating it again."""
+    return _respond(model.model_dump_json().encode("utf-8"), sub_response, status_code)
+
+
+class ConstantResponse:
+    """A fixed JSON body, encoded once."""
+
+    def __init__(self, content: Any):
+        self.body = dumps(content)
+
+    def __call__(self, sub_response: Optional[Response] = None, status_code: int = 200) -> Response:
+        return _respond(self.body, sub_response, status_code)
+
+
+PING = ConstantResponse({"status": "ok", "message": "API is working"})
+HEALTHY = ConstantResponse({"status": "healthy"})
+EMAIL_VERIFIED = ConstantResponse({"message": "Email verified successfully"})
+PASSWORD_RESET_REQUESTED = ConstantResponse(
+    {"message": "If a user with that email exists, a password reset link has been sent"}
+)
+PASSWORD_RESET = ConstantResponse({"message": "Password reset successfully"})
+LOGGED_OUT = ConstantResponse({"message": "Logged out"})
+LOGGED_OUT_EVERYWHERE = ConstantResponse({"message": "Logged out from all sessions"})
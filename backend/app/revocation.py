@@ -0,0 +1,205 @@
+"""
+In-memory access token revocation.
+
+Every access token carries a ``token_version`` claim and a ``jti``. A token is
+rejected when its version is older than the user's current version, or when
+its jti is on the deny list. Both structures live in memory and are refreshed
+incrementally from the database by a background thread, so checking a token
+costs two dict lookups and no query.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How often each worker pulls revocations made by other workers
+REFRESH_INTERVAL_SECONDS = int(os.getenv("REVOCATION_REFRESH_SECONDS", 15))
+
+# Re-read a small window behind the watermark so rows written by instances
+# with a slightly skewed clock are not missed
+SYNC_OVERLAP = timedelta(seconds=30)
+
+
+class TokenVersionMap:
+    """Current token version per user. Users still on version 0 are not stored."""
+
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+        self._watermark: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def current(self, user_id: str) -> int:
+        return self._versions.get(user_id, 0)
+
+    def update(self, user_id: str, version: int) -> None:
+        # Versions only move forward, so out-of-order syncs are harmless
+        if version and version > self._versions.get(user_id, 0):
+            with self._lock:
+                if version > self._versions.get(user_id, 0):
+                    self._versions[user_id] = version
+
+    def sync(self, db: Session) -> int:
+        """Load versions changed since the last sync. Returns the number of rows read."""
+        started = datetime.utcnow()
+        query = db.query(models.User.id, models.User.token_version).filter(models.User.token_version > 0)
+        if self._watermark is not None:
+            query = query.filter(models.User.updated_at >= self._watermark)
+
+        count = 0
+        for user_id, version in query:
+            self.update(user_id, version)
+            count += 1
+        self._watermark = started - SYNC_OVERLAP
+        return count
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+
+class DenyList:
+    """Revoked jtis mapped to their token expiry; entries drop out once the token would have expired anyway."""
+
+    def __init__(self):
+        self._entries: Dict[str, float] = {}
+        self._watermark: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def add(self, jti: str, expires_at: float) -> None:
+        if expires_at > time.time():
+            with self._lock:
+                self._entries[jti] = expires_at
+
+    def contains(self, jti: str) -> bool:
+        expires_at = self._entries.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def prune(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, expires_at in self._entries.items() if expires_at <= now]
+            for jti in expired:
+                del self._entries[jti]
+        return len(expired)
+
+    def sync(self, db: Session) -> int:
+        started = datetime.utcnow()
+        query = db.query(models.RevokedToken.jti, models.RevokedToken.expires_at).filter(
+            models.RevokedToken.expires_at > started
+        )
+        if self._watermark is not None:
+            query = query.filter(models.RevokedToken.revoked_at >= self._watermark)
+
+        count = 0
+        for jti, expires_at in query:
+            self.add(jti, _to_timestamp(expires_at))
+            count += 1
+        self._watermark = started - SYNC_OVERLAP
+        return count
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+token_versions = TokenVersionMap()
+deny_list = DenyList()
+
+
+def _to_timestamp(value: datetime) -> float:
+    # Expiry datetimes are stored as naive UTC
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+
+def is_revoked(payload: Dict[str, Any]) -> bool:
+    """Check a verified token payload against the in-memory revocation state."""
+    jti = payload.get("jti")
+    if jti and deny_list.contains(jti):
+        return True
+    user_id = payload.get("sub")
+    return payload.get("token_version", 0) < token_versions.current(user_id)
+
+
+def revoke_token(db: Session, payload: Dict[str, Any]) -> None:
+    """Revoke a single token by jti, e.g. on logout."""
+    jti = payload.get("jti")
+    exp = payload.get("exp")
+    if not jti or not exp:
+        return
+    deny_list.add(jti, float(exp))
+    if db.get(models.RevokedToken, jti) is None:
+        db.add(models.RevokedToken(
+            jti=jti,
+            user_id=payload.get("sub"),
+            expires_at=datetime.utcfromtimestamp(exp)
+        ))
+    db.commit()
+
+
+def revoke_all_for_user(db: Session, user: models.User) -> int:
+    """
+    Invalidate every access and refresh token issued to a user.
+
+    The caller's session must have the user loaded; the change is committed here.
+    Returns the user's new token version.
+    """
+    # Read before commit expires the instance, which would cost a reload
+    user_id, version = user.id, (user.token_version or 0) + 1
+    user.token_version = version
+    user.refresh_token = None
+    user.refresh_token_expires_at = None
+    user.updated_at = datetime.utcnow()
+    db.commit()
+    token_versions.update(user_id, version)
+    logger.info(f"Revoked all tokens for user {user_id} (token_version={version})")
+    return version
+
+
+def sync(db: Optional[Session] = None) -> None:
+    """Pull revocations made by other workers and drop expired deny list entries."""
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        versions = token_versions.sync(db)
+        denied = deny_list.sync(db)
+        pruned = deny_list.prune()
+        if versions or denied or pruned:
+            logger.info(f"Revocation sync: {versions} versions, {denied} denied jtis, {pruned} pruned")
+    finally:
+        if own_session:
+            db.close()
+
+
+_stop_event = threading.Event()
+_refresher: Optional[threading.Thread] = None
+
+
+def _refresh_loop():
+    while not _stop_event.is_set():
+        try:
+            sync()
+        except Exception as e:
+            logger.error(f"Revocation sync failed: {e}")
+        _stop_event.wait(REFRESH_INTERVAL_SECONDS)
+
+
+def start_refresher() -> None:
+    """Start the background sync thread for this worker."""
+    global _refresher
+    if _refresher is not None and _refresher.is_alive():
+        return
+    _stop_event.clear()
+    _refresher = threading.Thread(target=_refresh_loop, name="revocation-sync", daemon=True)
+    _refresher.start()
+    logger.info("Revocation refresher started")
+
+
+def stop_refresher() -> None:
+    _stop_event.set()
@@ -0,0 +1,125 @@
+"""
+Read replica routing.
+
+``RoutingSession`` picks an engine per statement: pure reads go to a healthy
+read replica, while writes, flushes, locking reads and raw SQL go to the
+primary. Once a session has written, it stays on the primary for the rest of
+its life, so a request always reads its own writes. A replica that raises a
+transient error is skipped for ``REPLICA_RETRY_SECONDS`` and its reads fall
+back to the primary.
+
+Replicas lag the primary slightly. Routes that compare against freshly
+written state (refresh tokens, reset tokens) use ``get_primary_db`` instead.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import TextClause
+
+from app.resilience import is_transient
+
+logger = logging.getLogger(__name__)
+
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", 30))
+
+
+class EngineRoute:
+    """One engine with its routing counters and health."""
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.statements = 0
+        self.errors = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def mark_unhealthy(self) -> None:
+        if self.healthy:
+            logger.warning(f"Read replica {self.name} failed, sending its reads to the primary "
+                           f"for {REPLICA_RETRY_SECONDS:.0f}s")
+        self.unhealthy_until = time.monotonic() + REPLICA_RETRY_SECONDS
+
+    def status(self) -> Dict[str, Any]:
+        pool = self.engine.pool
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "statements": self.statements,
+            "errors": self.errors,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        }
+
+
+primary: Optional[EngineRoute] = None
+replicas: List[EngineRoute] = []
+fallbacks = 0
+_next_replica = itertools.count()
+_lock = threading.Lock()
+
+
+def install(primary_engine, replica_engines) -> None:
+    """Register the engines and the hooks that count statements and track replica health."""
+    global primary
+    primary = EngineRoute("primary", primary_engine)
+    replicas[:] = [EngineRoute(f"replica-{i}", e) for i, e in enumerate(replica_engines)]
+
+    for route in [primary] + replicas:
+        def _on_execute(conn, cursor, statement, parameters, context, executemany, route=route):
+            route.statements += 1
+
+        def _on_error(context, route=route):
+            route.errors += 1
+            if route is not primary and (context.is_disconnect or is_transient(context.original_exception)):
+                route.mark_unhealthy()
+
+        event.listen(route.engine, "after_cursor_execute", _on_execute)
+        event.listen(route.engine, "handle_error", _on_error)
+
+
+def read_engine():
+    """A healthy replica engine, round robin, or the primary when none is available."""
+    global fallbacks
+    if not replicas:
+        return primary.engine
+    for _ in range(len(replicas)):
+        route = replicas[next(_next_replica) % len(replicas)]
+        if route.healthy:
+            return route.engine
+    with _lock:
+        fallbacks += 1
+    return primary.engine
+
+
+def _is_write(clause) -> bool:
+    if clause is None:
+        return False
+    # Raw SQL can't be inspected, so it is treated as a write
+    if isinstance(clause, TextClause) or getattr(clause, "is_dml", False):
+        return True
+    return getattr(clause, "_for_update_arg", None) is not None
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or _is_write(clause):
+            self.info["wrote"] = True
+        if not replicas or self.info.get("wrote"):
+            return primary.engine
+        return read_engine()
+
+
+def status() -> Dict[str, Any]:
+    return {
+        "engines": [route.status() for route in ([primary] + replicas) if route is not None],
+        "replica_fallbacks": fallbacks,
+    }
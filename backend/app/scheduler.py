@@ -0,0 +1,369 @@
+"""
+Periodic maintenance jobs that run in one worker at a time.
+
+Every worker runs a scheduler thread, but only the elected leader runs jobs.
+``SCHEDULER_LEADER=file`` (default) elects one leader per host with an
+exclusive flock on a file under /dev/shm. The kernel drops the lock however
+the leader exits, so when a worker is recycled another one takes over within
+``SCHEDULER_ELECTION_SECONDS``. ``database`` elects one leader across hosts
+with a lease row in ``dbo.scheduler_state``, renewed by the leader and taken
+over once it expires. ``off`` runs no jobs.
+
+A job is a generator that handles one chunk per step and yields how many
+items it handled. The scheduler pauses between chunks, and stops the job
+when the worker shuts down or loses leadership. Intervals are jittered so
+hosts don't line up. The last run of each job is stored next to the lock, so
+a new leader keeps the schedule instead of starting it over.
+"""
+import fcntl
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LEADER = os.getenv("SCHEDULER_LEADER", "file")
+SCHEDULER_ELECTION_SECONDS = float(os.getenv("SCHEDULER_ELECTION_SECONDS", 5))
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", 30))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", 0.1))
+# Pause between chunks, so a long job leaves room for request traffic
+SCHEDULER_CHUNK_PAUSE_SECONDS = float(os.getenv("SCHEDULER_CHUNK_PAUSE_SECONDS", 0.05))
+
+JobFunc = Callable[[], Iterator[int]]
+
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return datetime.utcfromtimestamp(value).isoformat() + "Z" if value else None
+
+
+class Job:
+    def __init__(self, name: str, func: JobFunc, interval: float, jitter: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run_at: Optional[float] = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.interrupted = 0
+        self.chunks = 0
+        self.items = 0
+        self.last_started_at: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_items = 0
+        self.last_error: Optional[str] = None
+
+    def next_interval(self) -> float:
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "interval_seconds": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "interrupted": self.interrupted,
+            "chunks": self.chunks,
+            "items": self.items,
+            "last_started_at": _timestamp(self.last_started_at),
+            "last_duration_seconds": round(self.last_duration, 3) if self.last_duration is not None else None,
+            "last_items": self.last_items,
+            "last_error": self.last_error,
+            "next_run_at": _timestamp(self.next_run_at),
+        }
+
+
+class FileElection:
+    """One leader per host: whichever worker holds an exclusive flock on the lock file."""
+
+    def __init__(self, directory: Optional[str] = None):
+        directory = directory or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+        self.lock_path = os.path.join(directory, "dreamapp-scheduler.lock")
+        self.state_path = os.path.join(directory, "dreamapp-scheduler-state.json")
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            # Closing the descriptor drops the lock
+            os.close(self._fd)
+            self._fd = None
+
+    def load_runs(self) -> Dict[str, float]:
+        try:
+            with open(self.state_path) as f:
+                return {name: float(started) for name, started in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def save_run(self, name: str, started_at: float) -> None:
+        runs = self.load_runs()
+        runs[name] = started_at
+        temporary = f"{self.state_path}.{os.getpid()}"
+        with open(temporary, "w") as f:
+            json.dump(runs, f)
+        os.replace(temporary, self.state_path)
+
+
+_metadata = MetaData()
+
+# One "leader" row holding the lease, and one "job:<name>" row per job with its last run
+state_table = Table(
+    "scheduler_state", _metadata,
+    Column("name", String(100), primary_key=True),
+    Column("holder", String(100), nullable=True),
+    Column("expires_at", DateTime, nullable=True),
+    Column("last_run_at", DateTime, nullable=True),
+    schema="dbo",
+)
+
+LEADER_ROW = "leader"
+
+
+class DatabaseElection:
+    """One leader across hosts: whichever worker holds an unexpired lease row in the primary database."""
+
+    def __init__(self, engine=None, lease_seconds: float = SCHEDULER_LEASE_SECONDS):
+        if engine is None:
+            from app.database import engine
+        self.engine = engine
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()[:50]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._created = False
+        self._renewed_at: Optional[float] = None
+
+    def _ensure_table(self, conn) -> None:
+        if not self._created:
+            state_table.create(conn, checkfirst=True)
+            self._created = True
+
+    def acquire(self) -> bool:
+        # Renew when a third of the lease is used, so one slow renewal doesn't lose it
+        if self._renewed_at is not None and time.monotonic() - self._renewed_at < self.lease_seconds / 3:
+            return True
+        self._renewed_at = None
+        now = datetime.utcnow()
+        values = {"holder": self.holder, "expires_at": now + timedelta(seconds=self.lease_seconds)}
+        try:
+            with self.engine.begin() as conn:
+                self._ensure_table(conn)
+                won = conn.execute(
+                    update(state_table)
+                    .where(state_table.c.name == LEADER_ROW,
+                           or_(state_table.c.holder == self.holder, state_table.c.holder.is_(None),
+                               state_table.c.expires_at < now))
+                    .values(**values)
+                ).rowcount
+                if not won and conn.execute(
+                    select(state_table.c.name).where(state_table.c.name == LEADER_ROW)
+                ).first() is None:
+                    conn.execute(insert(state_table).values(name=LEADER_ROW, **values))
+                    won = 1
+        except IntegrityError:
+            # Another worker inserted the lease row first
+            return False
+        if won:
+            self._renewed_at = time.monotonic()
+        return bool(won)
+
+    def release(self) -> None:
+        if self._renewed_at is None:
+            return
+        self._renewed_at = None
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(state_table)
+                .where(state_table.c.name == LEADER_ROW, state_table.c.holder == self.holder)
+                .values(holder=None, expires_at=None)
+            )
+
+    def load_runs(self) -> Dict[str, float]:
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            rows = conn.execute(
+                select(state_table.c.name, state_table.c.last_run_at)
+                .where(state_table.c.name.like("job:%"), state_table.c.last_run_at.is_not(None))
+            )
+            return {name[4:]: (last_run_at - datetime(1970, 1, 1)).total_seconds() for name, last_run_at in rows}
+
+    def save_run(self, name: str, started_at: float) -> None:
+        key, last_run_at = f"job:{name}", datetime.utcfromtimestamp(started_at)
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                update(state_table).where(state_table.c.name == key).values(last_run_at=last_run_at)
+            ).rowcount
+            if not updated:
+                conn.execute(insert(state_table).values(name=key, last_run_at=last_run_at))
+
+
+def _default_election():
+    if SCHEDULER_LEADER == "database":
+        return DatabaseElection()
+    if SCHEDULER_LEADER != "file":
+        logger.error(f"Unknown SCHEDULER_LEADER {SCHEDULER_LEADER!r}, using file")
+    return FileElection()
+
+
+class Scheduler:
+    def __init__(self, election=None):
+        self.jobs: Dict[str, Job] = {}
+        self.election = election
+        self.is_leader = False
+        self.leader_since: Optional[float] = None
+        self.elections_won = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def job(self, name: str, interval: float, jitter: float = SCHEDULER_JITTER):
+        """Decorator registering a generator function to run every ``interval`` seconds."""
+        def register(func: JobFunc) -> JobFunc:
+            self.jobs[name] = Job(name, func, interval, jitter)
+            return func
+        return register
+
+    def _elect(self) -> bool:
+        try:
+            leader = self.election.acquire()
+        except Exception as e:
+            logger.error(f"Scheduler election failed: {e}")
+            leader = False
+        if leader and not self.is_leader:
+            self.leader_since = time.time()
+            self.elections_won += 1
+            logger.info(f"Worker {os.getpid()} is now the scheduler leader")
+            self._load_schedule()
+        elif self.is_leader and not leader:
+            self.leader_since = None
+            logger.warning(f"Worker {os.getpid()} lost scheduler leadership")
+        self.is_leader = leader
+        return leader
+
+    def _load_schedule(self) -> None:
+        try:
+            runs = self.election.load_runs()
+        except Exception as e:
+            logger.error(f"Could not load scheduler state: {e}")
+            runs = {}
+        now = time.time()
+        for job in self.jobs.values():
+            last_run = runs.get(job.name)
+            if last_run is None:
+                # Never run anywhere yet: soon, but not in step with other hosts
+                job.next_run_at = now + random.uniform(0, job.interval * job.jitter)
+            else:
+                job.next_run_at = max(now, last_run + job.next_interval())
+
+    def _run(self, job: Job) -> None:
+        started = time.time()
+        job.running = True
+        job.last_started_at = started
+        job.last_items = 0
+        completed = False
+        steps = job.func()
+        try:
+            for count in steps:
+                job.chunks += 1
+                job.last_items += count or 0
+                if self._stop_event.wait(SCHEDULER_CHUNK_PAUSE_SECONDS) or not self._elect():
+                    break
+            else:
+                completed = True
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = f"{type(e).__name__}: {e}"
+            logger.error(f"Scheduled job {job.name} failed: {e}")
+        finally:
+            steps.close()
+            job.running = False
+
+        job.runs += 1
+        job.items += job.last_items
+        job.last_duration = time.time() - started
+        if completed:
+            logger.info(f"Scheduled job {job.name} handled {job.last_items} items in {job.last_duration:.2f}s")
+        elif job.last_error is None:
+            # Jobs are resumable; the next leader picks up where this one stopped
+            job.interrupted += 1
+            logger.info(f"Scheduled job {job.name} interrupted after {job.last_items} items")
+            return
+        # Failed runs count too, so a failing job waits an interval instead of retrying at once
+        job.next_run_at = started + job.next_interval()
+        try:
+            self.election.save_run(job.name, started)
+        except Exception as e:
+            logger.error(f"Could not save scheduler state for {job.name}: {e}")
+
+    def _loop(self) -> None:
+        while not self._stop_event.is_set():
+            wait = SCHEDULER_ELECTION_SECONDS
+            if self._elect():
+                for job in sorted(self.jobs.values(), key=lambda j: j.next_run_at):
+                    if self._stop_event.is_set() or not self.is_leader:
+                        break
+                    if job.next_run_at <= time.time():
+                        self._run(job)
+                next_due = min(job.next_run_at for job in self.jobs.values())
+                wait = max(0.05, min(wait, next_due - time.time()))
+            self._stop_event.wait(wait)
+        try:
+            self.election.release()
+        except Exception as e:
+            logger.error(f"Could not release scheduler leadership: {e}")
+        self.is_leader = False
+        self.leader_since = None
+
+    def start(self) -> None:
+        """Start this worker's scheduler thread; call after fork."""
+        if SCHEDULER_LEADER == "off" or not self.jobs:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self.election is None:
+            self.election = _default_election()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Stop after the current chunk and hand leadership to another worker."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "election": SCHEDULER_LEADER,
+            "leader": self.is_leader,
+            "leader_since": _timestamp(self.leader_since),
+            "elections_won": self.elections_won,
+            "jobs": [job.status() for job in self.jobs.values()],
+        }
+
+
+scheduler = Scheduler()
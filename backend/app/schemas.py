@@ -1,7 +1,30 @@
-from pydantic import BaseModel, EmailStr, field_validator
+from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
 from typing import Optional
 from datetime import datetime
 
+from app import breached_passwords
+
+def validate_username(v: str) -> str:
+    import re
+    if not re.match(r'^[a-zA-Z0-9_-]{3,30}$', v):
+         raise ValueError('Username must be 3-30 characters and contain only letters, numbers, underscores, or hyphens')
+    return v
+
+def validate_password_strength(v: str) -> str:
+    import re
+    if len(v) < 8:
+        raise ValueError('Password must be at least 8 characters')
+    if not re.search(r'[A-Za-z]', v):
+        raise ValueError('Password must contain at least one letter')
+    if not re.search(r'[0-9]', v):
+        raise ValueError('Password must contain at least one digit')
+    return validate_not_breached(v)
+
+def validate_not_breached(v: str) -> str:
+    if breached_passwords.is_breached(v):
+        raise ValueError('This password has appeared in a data breach, please choose a different one')
+    return v
+
 class UserCreate(BaseModel):
     email: EmailStr
     username: str
@@ -9,22 +32,39 @@ class UserCreate(BaseModel):
       
     @field_validator('username')
     def username_must_be_valid(cls, v):
-        import re
-        if not re.match(r'^[a-zA-Z0-9_-]{3,30}$', v):
-             raise ValueError('Username must be 3-30 characters and contain only letters, numbers, underscores, or hyphens')
-        return v
+        return validate_username(v)
            
     @field_validator('password')
     def password_must_be_strong(cls, v):
+        return validate_password_strength(v)
+
+class UserImport(BaseModel):
+    """One row of a bulk import: the UserCreate rules, but the password may arrive already hashed."""
+    email: EmailStr
+    username: str
+    password: Optional[str] = None
+    hashed_password: Optional[str] = None
+
+    @field_validator('username')
+    def username_must_be_valid(cls, v):
+        return validate_username(v)
+
+    @field_validator('password')
+    def password_must_be_strong(cls, v):
+        return validate_password_strength(v) if v else v
+
+    @field_validator('hashed_password')
+    def hash_must_be_bcrypt(cls, v):
         import re
-        if len(v) < 8:
-            raise ValueError('Password must be at least 8 characters')
-        if not re.search(r'[A-Za-z]', v):
-            raise ValueError('Password must contain at least one letter')
-        if not re.search(r'[0-9]', v):
-            raise ValueError('Password must contain at least one digit')
+        if v and not re.match(r'^\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}$', v):
+            raise ValueError('hashed_password must be a bcrypt hash')
         return v
 
+    @model_validator(mode='after')
+    def password_or_hash(self):
+        if not self.password and not self.hashed_password:
+            raise ValueError('Either password or hashed_password is required')
+        return self
 
 
 class UserOut(BaseModel):
@@ -36,6 +76,14 @@ class UserOut(BaseModel):
 
     model_config = {"from_attributes": True}
 
+class CurrentUser(BaseModel):
+    """Identity taken from a verified access token's claims, without a database lookup."""
+    id: str
+    username: Optional[str] = None
+    role: str = "user"
+    # Shard hint from the token; internal, never serialized
+    shard: Optional[int] = Field(default=None, exclude=True)
+
 class Token(BaseModel):
     access_token: str
     refresh_token: Optional[str] = None
@@ -55,9 +103,22 @@ class ResetPassword(BaseModel):
     token: str
     password: str
     confirm_password: str
+
+    @field_validator('password')
+    def password_must_not_be_breached(cls, v):
+        return validate_not_breached(v)
     
     @field_validator('confirm_password')
     def passwords_match(cls, v, values):
         if 'password' in values.data and v != values.data['password']:
             raise ValueError('Passwords do not match')
         return v
+
+# Admin schemas
+class ProfilerStart(BaseModel):
+    rate_hz: int = 100
+    duration_seconds: float = 30
+    mode: str = "wall"
+
+class TracemallocStart(BaseModel):
+    frames: int = 1
@@ -0,0 +1,246 @@
+"""
+Opt-in server-side sessions.
+
+Session data lives in a server-side store and the cookie carries only a
+random opaque id. Nothing runs for routes that don't ask for a session. A
+route that needs one declares it:
+
+    def route(session: ServerSession = Depends(get_session)): ...
+
+The cookie is set when the route writes to the session. Writes go
+straight to the store, so the next request sees them even if it lands on
+another worker (with the database store). Stores are keyed by a hash of the
+id, so a leaked store doesn't hand out live session ids.
+
+``SESSION_STORE=memory`` (default) keeps sessions in an LRU with a TTL in
+each worker, which fits a single worker or sticky routing. ``database`` keeps
+them in ``dbo.server_sessions``. Other backends subclass ``SessionStore``
+and are installed with ``configure()``.
+"""
+import abc
+import collections
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, MutableMapping, Optional
+
+from fastapi import Request, Response
+from sqlalchemy import Column, DateTime, MetaData, String, Table, Text, delete, select
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_COOKIE = os.getenv("SESSION_COOKIE", "session_id")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 3600))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000))
+
+# How often the database store deletes expired rows
+PURGE_INTERVAL_SECONDS = 300
+
+
+def _key(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+class SessionStore(abc.ABC):
+    """Backend interface. Keys are already hashed; data is a JSON-serializable dict."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The stored data, or None if the key is unknown or has expired."""
+
+    @abc.abstractmethod
+    def set(self, key: str, data: Dict[str, Any], ttl: int) -> None:
+        """Store data under key, replacing any earlier value, for ttl seconds."""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Forget key; unknown keys are ignored."""
+
+
+class MemorySessionStore(SessionStore):
+    """Per-worker LRU with expiry; the least recently used session goes first when full."""
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(data)
+
+    def set(self, key: str, data: Dict[str, Any], ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, dict(data))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_metadata = MetaData()
+
+sessions_table = Table(
+    "server_sessions", _metadata,
+    Column("id", String(64), primary_key=True),
+    Column("data", Text, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+    schema="dbo",
+)
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions shared by every worker, in the primary database."""
+
+    def __init__(self, engine=None):
+        if engine is None:
+            from app.database import engine
+        self.engine = engine
+        self._created = False
+        self._purged_at = 0.0
+
+    def _ensure_table(self, conn) -> None:
+        if not self._created:
+            sessions_table.create(conn, checkfirst=True)
+            self._created = True
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            data = conn.execute(
+                select(sessions_table.c.data)
+                .where(sessions_table.c.id == key, sessions_table.c.expires_at > datetime.utcnow())
+            ).scalar()
+        return json.loads(data) if data is not None else None
+
+    def set(self, key: str, data: Dict[str, Any], ttl: int) -> None:
+        values = {"data": json.dumps(data), "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            updated = conn.execute(
+                sessions_table.update().where(sessions_table.c.id == key).values(**values)
+            ).rowcount
+            if not updated:
+                conn.execute(sessions_table.insert().values(id=key, **values))
+            if time.monotonic() - self._purged_at > PURGE_INTERVAL_SECONDS:
+                self._purged_at = time.monotonic()
+                conn.execute(delete(sessions_table).where(sessions_table.c.expires_at <= datetime.utcnow()))
+
+    def delete(self, key: str) -> None:
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            conn.execute(delete(sessions_table).where(sessions_table.c.id == key))
+
+
+def _default_store() -> SessionStore:
+    if SESSION_STORE == "database":
+        return DatabaseSessionStore()
+    if SESSION_STORE != "memory":
+        logger.error(f"Unknown SESSION_STORE {SESSION_STORE!r}, using memory")
+    return MemorySessionStore()
+
+
+session_store: Optional[SessionStore] = None
+
+
+def configure(store: SessionStore) -> None:
+    """Install a session backend, e.g. a persistent one."""
+    global session_store
+    session_store = store
+
+
+def get_store() -> SessionStore:
+    global session_store
+    if session_store is None:
+        session_store = _default_store()
+    return session_store
+
+
+class ServerSession(MutableMapping):
+    """One request's session; every change is written to the store at once."""
+
+    def __init__(self, store: SessionStore, response: Response, session_id: Optional[str] = None,
+                 data: Optional[Dict[str, Any]] = None):
+        self._store = store
+        self._response = response
+        self.session_id = session_id
+        self._data = data or {}
+        self._cookie_set = False
+
+    def __getitem__(self, name: str) -> Any:
+        return self._data[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        self._data[name] = value
+        self._save()
+
+    def __delitem__(self, name: str) -> None:
+        del self._data[name]
+        self._save()
+
+    def _save(self) -> None:
+        if self.session_id is None:
+            self.session_id = secrets.token_urlsafe(24)
+        if not self._cookie_set:
+            self._set_cookie()
+        self._store.set(_key(self.session_id), self._data, SESSION_TTL_SECONDS)
+
+    def _set_cookie(self) -> None:
+        # Sent again by every request that writes, so the cookie expires with the stored session
+        self._cookie_set = True
+        self._response.set_cookie(
+            key=SESSION_COOKIE,
+            value=self.session_id,
+            httponly=True,
+            secure=True,
+            samesite="lax",
+            max_age=SESSION_TTL_SECONDS,
+        )
+
+    def clear(self) -> None:
+        """End the session: drop it from the store and expire the cookie."""
+        self._data = {}
+        if self.session_id is not None:
+            self._store.delete(_key(self.session_id))
+            self.session_id = None
+        self._response.delete_cookie(SESSION_COOKIE)
+
+
+def get_session(request: Request, response: Response) -> ServerSession:
+    """Dependency for the routes that use sessions."""
+    store = get_store()
+    session_id = request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        data = store.get(_key(session_id))
+        if data is not None:
+            return ServerSession(store, response, session_id, data)
+    # Unknown or expired ids are never reused; a fresh one is issued on the first write
+    return ServerSession(store, response)
@@ -0,0 +1,237 @@
+"""
+Hash-partitioned user storage.
+
+With ``DB_SHARD_URLS`` set, users are spread over several databases: the
+primary is shard 0 and each URL adds one more. A user's home shard is a jump
+consistent hash of their id, so adding a shard moves only about 1/N of the
+users. Everything else (revoked tokens, audit events, the directory) stays on
+the primary.
+
+The directory (``dbo.user_directory``) maps each normalized email and
+username to a user id and shard. A query filtering users by email, username
+or id reads the directory first and then runs on that one shard only, so
+logins stay single-shard; other user queries run on every shard and their
+results are concatenated. Tokens carry the shard in a ``shard`` claim, so
+loading the current user skips the directory. Users the directory doesn't
+know are looked for on shard 0, where every user created before sharding
+stays until ``rebalance_shards.py`` has backfilled the directory and moved
+them.
+
+Without ``DB_SHARD_URLS`` none of this is installed and sessions work as before.
+"""
+import hashlib
+import logging
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event, inspect, insert, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import ORMExecuteState, sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.schema import Column
+from sqlalchemy.sql.util import find_tables
+
+# Imported by app.database while app.models may still be initializing; only used inside functions
+from app import models
+
+logger = logging.getLogger(__name__)
+
+# Shard 0 is the primary database, which also holds the directory
+DIRECTORY_SHARD = "0"
+
+LOOKUP_COLUMNS = ("id", "email", "username")
+
+shards: Dict[str, Any] = {}
+directory_lookups = 0
+scatter_queries = 0
+
+
+def enabled() -> bool:
+    return len(shards) > 1
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Lamping and Veach's jump consistent hash of a 64-bit key."""
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def home_shard(user_id: str, shard_count: Optional[int] = None) -> str:
+    """The shard a user id hashes to."""
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "big")
+    return str(jump_hash(key, shard_count or len(shards) or 1))
+
+
+def directory_key(column: str, value: str) -> str:
+    # Emails and usernames are unique case-insensitively (the SQL Server collation)
+    return f"{column}:{value.strip().lower()}"
+
+
+def directory_entries(user_id: str, email: str, username: str, shard: str) -> List[Dict[str, Any]]:
+    return [
+        {"lookup_key": directory_key("email", email), "user_id": user_id, "shard": int(shard)},
+        {"lookup_key": directory_key("username", username), "user_id": user_id, "shard": int(shard)},
+    ]
+
+
+def shard_of(user: "models.User") -> Optional[int]:
+    """The shard a loaded user came from, for the token shard hint; None when not sharded."""
+    if not enabled():
+        return None
+    token = inspect(user).identity_token
+    return int(token) if token is not None else None
+
+
+# Choosers for ShardedSession
+
+def _choose_shard(mapper, instance, clause=None, **kw) -> str:
+    if isinstance(instance, models.User):
+        return home_shard(instance.id)
+    return DIRECTORY_SHARD
+
+
+def _choose_identity_shards(mapper, primary_key, **kw) -> List[str]:
+    # Only consulted for the in-memory identity map; loads from the database go through _choose_query_shards
+    if mapper.class_ is models.User:
+        return list(shards)
+    return [DIRECTORY_SHARD]
+
+
+def _lookup(clause) -> Optional[Tuple[str, Any]]:
+    """(column, value) if the clause is users.id/email/username = value."""
+    if not isinstance(clause, BinaryExpression) or clause.operator is not operators.eq:
+        return None
+    column, value = clause.left, clause.right
+    if isinstance(column, BindParameter):
+        column, value = value, column
+    if (isinstance(column, Column) and column.table is models.User.__table__ and column.name in LOOKUP_COLUMNS
+            and isinstance(value, BindParameter) and value.effective_value is not None):
+        return column.name, value.effective_value
+    return None
+
+
+def _lookups(whereclause) -> List[Tuple[str, Any]]:
+    """
+    Lookups that between them locate every row the WHERE clause can match:
+    one lookup ANDed with anything, or an OR of nothing but lookups.
+    Empty when the clause doesn't narrow the query to particular users.
+    """
+    if whereclause is None:
+        return []
+    found = _lookup(whereclause)
+    if found:
+        return [found]
+    if isinstance(whereclause, BooleanClauseList):
+        parts = [_lookup(clause) for clause in whereclause.clauses]
+        if whereclause.operator is operators.and_:
+            return [part for part in parts if part][:1]
+        if whereclause.operator is operators.or_ and all(parts):
+            return parts
+    return []
+
+
+def _resolve(session, column: str, value: Any) -> str:
+    global directory_lookups
+    directory_lookups += 1
+    table = models.UserDirectory.__table__
+    if column == "id":
+        query = select(table.c.shard).where(table.c.user_id == str(value)).limit(1)
+    else:
+        query = select(table.c.shard).where(table.c.lookup_key == directory_key(column, str(value)))
+    # Through the session so the lookup shares its transaction on the primary
+    conn = session.connection(bind_arguments={"shard_id": DIRECTORY_SHARD})
+    shard = conn.execute(query).scalar()
+    return str(shard) if shard is not None else DIRECTORY_SHARD
+
+
+def _choose_query_shards(context: ORMExecuteState) -> List[str]:
+    global scatter_queries
+    statement = context.statement
+    users = models.User.__table__
+    if getattr(statement, "table", None) is not users and users not in find_tables(statement):
+        return [DIRECTORY_SHARD]
+    if context.is_insert:
+        raise ValueError("User inserts outside a flush must go through sharding.insert_users")
+    lookups = _lookups(getattr(statement, "whereclause", None))
+    if lookups:
+        return list(dict.fromkeys(_resolve(context.session, column, value) for column, value in lookups))
+    scatter_queries += 1
+    return list(shards)
+
+
+def _add_directory_entries(session, flush_context, instances) -> None:
+    for obj in list(session.new):
+        if isinstance(obj, models.User):
+            # The id decides the shard, so it can't wait for the column default at insert time
+            if obj.id is None:
+                obj.id = str(uuid.uuid4())
+            for entry in directory_entries(obj.id, obj.email, obj.username, home_shard(obj.id)):
+                session.add(models.UserDirectory(**entry))
+
+
+def install(shard_engines: Sequence[Any]) -> sessionmaker:
+    """Register the shard engines and return a session factory that spans them."""
+    shards.clear()
+    shards.update({str(i): shard_engine for i, shard_engine in enumerate(shard_engines)})
+    factory = sessionmaker(
+        class_=ShardedSession,
+        autocommit=False,
+        autoflush=False,
+        shards=dict(shards),
+        shard_chooser=_choose_shard,
+        identity_chooser=_choose_identity_shards,
+        execute_chooser=_choose_query_shards,
+    )
+    event.listen(factory, "before_flush", _add_directory_entries)
+    logger.info(f"Sharding users across {len(shards)} databases")
+    return factory
+
+
+# Helpers for code that works on users outside single-row ORM operations
+
+def get_user(db, user_id: str, shard: Optional[int] = None) -> Optional["models.User"]:
+    """Load a user by id, straight from the hinted shard when given; falls back to the directory if they moved."""
+    if shard is not None and enabled() and str(shard) in shards:
+        user = db.get(models.User, user_id, identity_token=str(shard))
+        if user is not None:
+            return user
+    return db.get(models.User, user_id)
+
+
+def insert_users(db, rows: List[Dict[str, Any]]) -> None:
+    """Insert user rows with one executemany per shard, plus their directory entries."""
+    table = models.User.__table__
+    if not enabled():
+        db.execute(insert(table), rows)
+        return
+    by_shard: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    entries = []
+    for row in rows:
+        shard = home_shard(row["id"])
+        by_shard[shard].append(row)
+        entries.extend(directory_entries(row["id"], row["email"], row["username"], shard))
+    # The directory's primary key catches clashes with users on other shards
+    db.execute(insert(models.UserDirectory.__table__), entries, bind_arguments={"shard_id": DIRECTORY_SHARD})
+    for shard, shard_rows in by_shard.items():
+        db.execute(insert(table), shard_rows, bind_arguments={"shard_id": shard})
+
+
+def read_engines() -> Iterable[Any]:
+    """Engines that together hold every user: each shard, or the read engine when not sharded."""
+    from app import routing
+
+    return list(shards.values()) if enabled() else [routing.read_engine()]
+
+
+def status() -> Dict[str, Any]:
+    return {
+        "shards": len(shards) or 1,
+        "directory_lookups": directory_lookups,
+        "scatter_queries": scatter_queries,
+    }
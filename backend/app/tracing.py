@@ -0,0 +1,403 @@
+"""
+Request tracing.
+
+With TRACE_EXPORT_DIR or an OTLP endpoint set, every request gets a trace:
+a root span opened by TracingMiddleware, with child spans for each SQL
+statement (app/query_stats.py), each bcrypt call (app/utils.py), time queued
+for admission or for the hashing pool, and each email provider call. Spans
+are only collected in memory while the request runs. When it ends, the trace
+is kept at random at TRACE_SAMPLE_RATE (or when the caller's traceparent
+says it is sampled), and always when the response took TRACE_SLOW_MS or
+more or failed with a 5xx, so the slow tail is never sampled away. Kept
+traces are queued for a background thread that exports them in batches as
+OTLP/JSON: appended to a file per worker, and/or posted to any OTLP/HTTP
+collector. A request never waits on the export; if the queue fills, traces
+are dropped and counted.
+
+Every response carries its trace id in X-Trace-Id, so the frontend can
+report which request was slow.
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORT_DIR = os.getenv("TRACE_EXPORT_DIR", "")
+TRACE_EXPORT_MAX_MB = float(os.getenv("TRACE_EXPORT_MAX_MB", 200))
+# Base URL of an OTLP/HTTP collector, e.g. http://localhost:4318; traces are posted to /v1/traces
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")).rstrip("/")
+# Extra headers for the collector, e.g. an API key: "name=value,name=value"
+TRACE_OTLP_HEADERS = os.getenv("TRACE_OTLP_HEADERS", os.getenv("OTEL_EXPORTER_OTLP_HEADERS", ""))
+TRACE_OTLP_TIMEOUT = float(os.getenv("TRACE_OTLP_TIMEOUT", 5))
+TRACING_ENABLED = bool(TRACE_EXPORT_DIR or TRACE_OTLP_ENDPOINT)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 1000))
+# Bulk imports and exports issue thousands of statements; keep their first spans only
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", 256))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 2000))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 100))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", 2))
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "dreamapp-auth-api")
+
+TRACE_ID_HEADER = "X-Trace-Id"
+
+# OTLP span kinds and status codes
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_UNSET, STATUS_ERROR = 0, 2
+
+# Longest statement kept in a db.query span, after normalization
+MAX_STATEMENT_LENGTH = 2048
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "epoch_ns", "origin_ns", "spans", "dropped")
+
+    def __init__(self, trace_id: int, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # Spans are timed with perf_counter and placed on the wall clock through this pair
+        self.epoch_ns = time.time_ns()
+        self.origin_ns = time.perf_counter_ns()
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def new_span(self, name: str, parent_id: int, kind: int, attributes: Optional[Dict[str, Any]]) -> Optional["Span"]:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(self, name, parent_id, kind, attributes)
+        # list.append is atomic, so spans may be added from the threadpool and the hashing pool
+        self.spans.append(span)
+        return span
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: int, kind: int, attributes: Optional[Dict[str, Any]]):
+        self.trace = trace
+        self.name = name
+        self.span_id = random.getrandbits(64) or 1
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes if attributes is not None else {}
+        self.error: Optional[str] = None
+        self.end: Optional[int] = None
+        self.start = time.perf_counter_ns()
+
+    def finish(self, error: Optional[str] = None) -> None:
+        """End the span; only the first call counts."""
+        if self.end is None:
+            self.end = time.perf_counter_ns()
+            if error:
+                self.error = error
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current.get()
+    return f"{span.trace.trace_id:032x}" if span is not None else None
+
+
+def start_span(name: str, kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+    """Start a child of the current span without making it current; None outside a traced request."""
+    parent = _current.get()
+    if parent is None:
+        return None
+    return parent.trace.new_span(name, parent.span_id, kind, attributes)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+    """Run a block as a child span of the current one; does nothing outside a traced request."""
+    child = start_span(name, kind, attributes)
+    if child is None:
+        yield None
+        return
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def _parse_traceparent(value: str) -> Optional[Tuple[int, int, bool]]:
+    """Trace id, parent span id and sampled flag from a W3C traceparent header."""
+    parts = value.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[0] == "ff":
+        return None
+    try:
+        trace_id, parent_id, flags = int(parts[1], 16), int(parts[2], 16), int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if not trace_id or not parent_id:
+        return None
+    return trace_id, parent_id, bool(flags & 1)
+
+
+# Export encoding (OTLP/JSON, as accepted by OTLP/HTTP collectors and their file receivers)
+
+def _value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _encode_span(trace: Trace, span: Span, trace_end: int) -> Dict[str, Any]:
+    attributes = dict(span.attributes)
+    if "db.statement" in attributes:
+        # Imported here: query_stats records the spans, so it imports this module
+        from app.query_stats import normalize
+        attributes["db.statement"] = normalize(attributes["db.statement"])[:MAX_STATEMENT_LENGTH]
+    if span.end is None:
+        # Still running when the trace was exported, e.g. an abandoned hashing job
+        attributes["unfinished"] = True
+    encoded = {
+        "traceId": f"{trace.trace_id:032x}",
+        "spanId": f"{span.span_id:016x}",
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(trace.epoch_ns + span.start - trace.origin_ns),
+        "endTimeUnixNano": str(trace.epoch_ns + (span.end or trace_end) - trace.origin_ns),
+        "attributes": [{"key": key, "value": _value(value)} for key, value in attributes.items()],
+        "status": {"code": STATUS_ERROR, "message": span.error} if span.error else {"code": STATUS_UNSET},
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = f"{span.parent_id:016x}"
+    return encoded
+
+
+def encode(traces: List[Trace]) -> bytes:
+    """One OTLP ExportTraceServiceRequest holding every span of the given traces."""
+    spans = []
+    for trace in traces:
+        ends = [span.end for span in trace.spans if span.end is not None]
+        trace_end = max(ends) if ends else time.perf_counter_ns()
+        spans.extend(_encode_span(trace, span, trace_end) for span in list(trace.spans))
+    return json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+            {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+        ]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+    }]}, separators=(",", ":")).encode()
+
+
+def _otlp_headers() -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    for item in filter(None, TRACE_OTLP_HEADERS.split(",")):
+        name, _, value = item.partition("=")
+        headers[name.strip()] = urllib.parse.unquote(value.strip())
+    return headers
+
+
+class TraceExporter:
+    """Decides which finished traces to keep and exports them from a background thread."""
+
+    def __init__(self, directory: str = TRACE_EXPORT_DIR, endpoint: str = TRACE_OTLP_ENDPOINT,
+                 buffer_size: int = TRACE_BUFFER_SIZE, batch_size: int = TRACE_BATCH_SIZE,
+                 flush_interval: float = TRACE_FLUSH_SECONDS):
+        self.directory = directory
+        self.endpoint = endpoint
+        # deque appends and pops are atomic, so requests never take a lock here
+        self._buffer: Deque[Trace] = collections.deque(maxlen=buffer_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.max_file_bytes = int(TRACE_EXPORT_MAX_MB * 1024 * 1024)
+        self.traces = 0
+        self.kept = collections.Counter()
+        self.exported = 0
+        self.dropped = 0
+        self.last_error: Optional[str] = None
+
+    def offer(self, trace: Trace) -> bool:
+        """Keep a finished trace if it was sampled, slow or failed; never blocks."""
+        self.traces += 1
+        root = trace.spans[0]
+        if root.error:
+            reason = "error"
+        elif (root.end - root.start) / 1e6 >= TRACE_SLOW_MS:
+            reason = "slow"
+        elif trace.sampled:
+            reason = "sampled"
+        else:
+            return False
+        self.kept[reason] += 1
+        if len(self._buffer) == self._buffer.maxlen:
+            # The deque discards the oldest trace to make room
+            self.dropped += 1
+        self._buffer.append(trace)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def _drain(self) -> List[Trace]:
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _write_file(self, payload: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"traces-{os.getpid()}.jsonl")
+        if os.path.exists(path) and os.path.getsize(path) + len(payload) > self.max_file_bytes:
+            raise OSError(f"{path} is full")
+        with open(path, "ab") as f:
+            f.write(payload + b"\n")
+
+    def _post(self, payload: bytes) -> None:
+        request = urllib.request.Request(f"{self.endpoint}/v1/traces", data=payload,
+                                         headers=_otlp_headers(), method="POST")
+        with urllib.request.urlopen(request, timeout=TRACE_OTLP_TIMEOUT) as response:
+            response.read()
+
+    def flush(self) -> int:
+        """Export everything queued; returns the number of traces exported."""
+        total = 0
+        while True:
+            batch = self._drain()
+            if not batch:
+                return total
+            payload = encode(batch)
+            try:
+                if self.directory:
+                    self._write_file(payload)
+                if self.endpoint:
+                    self._post(payload)
+                total += len(batch)
+                self.exported += len(batch)
+                self.last_error = None
+            except Exception as e:
+                self.dropped += len(batch)
+                # Log once per outage rather than every flush
+                if self.last_error is None:
+                    logger.error(f"Trace export failed, dropping traces until it recovers: {e}")
+                self.last_error = type(e).__name__
+
+    def _loop(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def start(self) -> None:
+        if not TRACING_ENABLED or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Stop the exporter after a last flush of whatever is queued."""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": TRACING_ENABLED,
+            "sample_rate": TRACE_SAMPLE_RATE,
+            "slow_ms": TRACE_SLOW_MS,
+            "traces": self.traces,
+            "kept": dict(self.kept),
+            "buffered": len(self._buffer),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+        }
+
+
+exporter = TraceExporter()
+
+
+class TracingMiddleware:
+    """ASGI middleware giving each request a root span and an X-Trace-Id response header."""
+
+    def __init__(self, app, trace_exporter: Optional[TraceExporter] = None):
+        self.app = app
+        self.exporter = trace_exporter or exporter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                incoming = _parse_traceparent(value.decode("latin-1"))
+                break
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+            sampled = sampled or random.random() < TRACE_SAMPLE_RATE
+        else:
+            trace_id, parent_id, sampled = random.getrandbits(128) or 1, 0, random.random() < TRACE_SAMPLE_RATE
+        trace = Trace(trace_id, sampled)
+        root = trace.new_span(f"{scope['method']} {scope['path']}", parent_id, KIND_SERVER, None)
+        header = (TRACE_ID_HEADER.lower().encode(), f"{trace_id:032x}".encode())
+        status = 500
+
+        async def send_traced(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), header]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                # The client has its answer; background tasks such as emails show up after the root span
+                root.finish()
+            await send(message)
+
+        token = _current.set(root)
+        try:
+            await self.app(scope, receive, send_traced)
+        except BaseException as e:
+            root.finish(type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            root.finish()
+            try:
+                route = scope.get("route")
+                if route is not None and hasattr(route, "path"):
+                    # The path template keeps span names low-cardinality
+                    root.name = f"{scope['method']} {route.path}"
+                    root.attributes["http.route"] = route.path
+                root.attributes["http.method"] = scope["method"]
+                root.attributes["http.target"] = scope["path"]
+                root.attributes["http.status_code"] = status
+                if status >= 500 and not root.error:
+                    root.error = f"HTTP {status}"
+                if trace.dropped:
+                    root.attributes["dropped_spans"] = trace.dropped
+                self.exporter.offer(trace)
+            except Exception as e:
+                logger.error(f"Tracing failed: {e}")
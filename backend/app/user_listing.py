@@ -0,0 +1,229 @@
+"""
+Admin user listing and export.
+
+Pages are keyset-paginated on (created_at, id): the cursor is the last row's
+sort key, so each page is an index seek no matter how deep the caller goes,
+and rows inserted meanwhile neither shift nor repeat pages. Only the
+requested columns are selected, and secrets are never selectable.
+
+Exports stream the same query through a server-side cursor, fetching a
+bounded number of rows at a time and writing them out in chunks, so memory
+stays flat for any table size. Each worker runs a limited number of exports
+at once so a large export can't take the connections logins need.
+
+With sharded users, pages and exports merge each shard's ordered rows, so
+the order is the same as on a single database.
+"""
+import base64
+import binascii
+import contextlib
+import csv
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from app import models, sharding
+from app.resilience import breaker
+
+logger = logging.getLogger(__name__)
+
+# Columns an admin may list or export; hashed_password and refresh tokens are never exposed
+LISTABLE_COLUMNS = ("id", "email", "username", "role", "is_active", "created_at", "updated_at")
+DEFAULT_COLUMNS = LISTABLE_COLUMNS
+
+MAX_PAGE_SIZE = 500
+
+# Rows fetched from the server-side cursor per round trip, and rows per chunk written to the client
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 1000))
+
+# Concurrent exports per worker; each one holds a pool connection until it finishes
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 1))
+
+_export_slots = threading.BoundedSemaphore(max(1, EXPORT_CONCURRENCY))
+
+
+class ExportBusy(Exception):
+    """Every export slot in this worker is in use."""
+
+
+def parse_columns(fields: Optional[str]) -> Tuple[str, ...]:
+    """Validate a comma separated column list; the sort key columns are always included."""
+    if not fields:
+        return DEFAULT_COLUMNS
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in LISTABLE_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown or non-listable columns: {', '.join(unknown)}")
+    columns = list(dict.fromkeys(requested))
+    for key in ("id", "created_at"):
+        if key not in columns:
+            columns.append(key)
+    return tuple(columns)
+
+
+def encode_cursor(created_at: Optional[datetime], user_id: str) -> str:
+    raw = json.dumps([created_at.isoformat() if created_at else None, user_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, user_id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None), str(user_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def _query(columns: Sequence[str], role: Optional[str], is_active: Optional[bool], after: Optional[str]):
+    table = models.User.__table__
+    stmt = select(*(table.c[name] for name in columns))
+    if role is not None:
+        stmt = stmt.where(table.c.role == role)
+    if is_active is not None:
+        stmt = stmt.where(table.c.is_active == is_active)
+    if after:
+        created_at, user_id = decode_cursor(after)
+        if created_at is None:
+            # Rows without created_at sort first; continue through them by id, then the rest
+            stmt = stmt.where(or_(
+                and_(table.c.created_at.is_(None), table.c.id > user_id),
+                table.c.created_at.isnot(None),
+            ))
+        else:
+            # Spelled out because SQL Server has no row value comparison
+            stmt = stmt.where(or_(
+                table.c.created_at > created_at,
+                and_(table.c.created_at == created_at, table.c.id > user_id),
+            ))
+    return stmt.order_by(table.c.created_at, table.c.id)
+
+
+def _sort_key(row) -> Tuple[bool, datetime, str]:
+    # NULL created_at first, as both databases order them
+    return row.created_at is not None, row.created_at or datetime.min, row.id
+
+
+def _serialize(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def list_users(
+    db: Session,
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """One page of users plus the cursor for the next page (None on the last page)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # One extra row tells whether another page exists without a COUNT
+    rows = db.execute(_query(columns, role, is_active, cursor).limit(limit + 1)).all()
+    if sharding.enabled():
+        # Each shard returned its own first limit + 1 rows; the page is the first of all of them
+        rows = sorted(rows, key=_sort_key)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return {
+        "items": [{name: _serialize(value) for name, value in zip(columns, row)} for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def _format_chunk(rows: List[Any], columns: Sequence[str], fmt: str) -> str:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([[_serialize(value) for value in row] for row in rows])
+        return buffer.getvalue()
+    return "".join(
+        json.dumps({name: _serialize(value) for name, value in zip(columns, row)}) + "\n"
+        for row in rows
+    )
+
+
+class _Export:
+    """Iterator over an export's chunks that gives back its slot exactly once, even if never started."""
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if not self._released:
+            self._released = True
+            self._chunks.close()
+            _export_slots.release()
+
+    def __del__(self):
+        self.close()
+
+
+def export_users(
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+    fmt: str = "ndjson",
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+) -> Iterator[str]:
+    """
+    Stream every matching user as NDJSON or CSV.
+
+    Raises DatabaseUnavailable while the circuit breaker is open, and ExportBusy if this
+    worker's export slots are taken, both up front, before any response is sent.
+    """
+    # The export opens its own connections, so it doesn't pass through get_db's check
+    breaker.before_request()
+    if not _export_slots.acquire(blocking=False):
+        raise ExportBusy("An export is already running in this worker")
+    return _Export(_stream(columns, fmt, role, is_active))
+
+
+def _stream(columns: Sequence[str], fmt: str, role: Optional[str], is_active: Optional[bool]) -> Iterator[str]:
+    exported = 0
+    try:
+        if fmt == "csv":
+            yield _format_chunk([columns], columns, "csv")
+        # A connection of its own rather than a request session: it is held for the
+        # whole export, and stream_results keeps the driver from buffering the result.
+        # It reads from a replica when there is one; on the primary, READ_COMMITTED_SNAPSHOT
+        # (the Azure SQL default) means the long read never blocks logins updating users.
+        with contextlib.ExitStack() as stack:
+            results = [
+                stack.enter_context(read_engine.connect())
+                .execution_options(stream_results=True, yield_per=EXPORT_FETCH_SIZE)
+                .execute(_query(columns, role, is_active, None))
+                for read_engine in sharding.read_engines()
+            ]
+            if len(results) == 1:
+                chunks = results[0].partitions()
+            else:
+                # One ordered stream per shard, merged a row at a time
+                merged = heapq.merge(*results, key=_sort_key)
+                chunks = iter(lambda: list(itertools.islice(merged, EXPORT_FETCH_SIZE)), [])
+            for rows in chunks:
+                exported += len(rows)
+                yield _format_chunk(rows, columns, fmt)
+    finally:
+        logger.info(f"User export finished: {exported} rows")
@@ -4,13 +4,27 @@ from datetime import datetime, timedelta
 import os
 import secrets
 import string
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from typing import Optional, Tuple, Dict, Any
 
+from app import tracing
+
 load_dotenv()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt releases the GIL, so a small thread pool runs hashes in parallel
+# without blocking the event loop or the request threadpool
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", 4))
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
+def reset_hash_executor() -> None:
+    """Give a forked worker its own hashing pool; threads don't survive fork."""
+    global hash_executor
+    hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
     raise ValueError("SECRET_KEY environment variable is not set")
@@ -23,24 +37,26 @@ PASSWORD_RESET_EXPIRE_MINUTES = 60
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt."""
-    return pwd_context.hash(password)
+    with tracing.span("bcrypt.hash"):
+        return pwd_context.hash(password)
 
 def verify_password(plain: str, hashed: str) -> bool:
     """Verify a password against a hash."""
-    return pwd_context.verify(plain, hashed)
+    with tracing.span("bcrypt.verify"):
+        return pwd_context.verify(plain, hashed)
 
 def create_access_token(data: dict) -> str:
-    """Create a JWT access token."""
+    """Create a JWT access token with a unique jti so it can be revoked individually."""
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire, "type": "access"})
+    to_encode.update({"exp": expire, "type": "access", "jti": str(uuid.uuid4())})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def create_refresh_token(data: dict) -> str:
     """Create a JWT refresh token."""
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire, "type": "refresh"})
+    to_encode.update({"exp": expire, "type": "refresh", "jti": str(uuid.uuid4())})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def create_verification_token(data: dict) -> Tuple[str, datetime]:
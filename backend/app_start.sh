@@ -29,16 +29,5 @@ export PYTHONFAULTHANDLER=1
 
 # Start application with optimized settings
 echo "Starting application with gunicorn..."
-exec gunicorn app.main:app \
-  --bind=0.0.0.0:8000 \
-  --workers=2 \
-  --worker-class=uvicorn.workers.UvicornWorker \
-  --timeout=30 \
-  --graceful-timeout=20 \
-  --keep-alive=2 \
-  --max-requests=1000 \
-  --max-requests-jitter=50 \
-  --log-level=info \
-  --access-logfile=- \
-  --error-logfile=- \
-  --capture-output
\ No newline at end of file
+# Workers, timeouts, preloading and fork hooks come from gunicorn_config.py
+exec gunicorn -c gunicorn_config.py app.main:app
@@ -0,0 +1,131 @@
+"""
+Cold start benchmark: how long a new server takes to answer /health.
+
+Starts the server the way a new App Service instance does: the built
+artifact through start_artifact.sh (artifact check, then gunicorn), or the
+source tree with gunicorn when no artifact is given. It runs against a
+throwaway SQLite database, polls /health and fails when the median start
+time exceeds the budget. The artifact check and a bare ``import app.main``
+are timed separately, to show where the time goes.
+
+Usage (from the backend directory):
+    python build_artifact.py
+    python benchmarks/bench_cold_start.py [--artifact dist/artifact] [--budget 10] [--runs 3]
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds from process start to the first /health answer; scale-out waits this long per instance
+COLD_START_BUDGET_SECONDS = float(os.getenv("COLD_START_BUDGET_SECONDS", 10))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _environment(directory: str, artifact: bool) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'cold-start.db')}",
+        "SECRET_KEY": env.get("SECRET_KEY", "cold-start-benchmark"),
+        "AUDIT_SPILL_DIR": os.path.join(directory, "audit"),
+        "WEB_CONCURRENCY": env.get("WEB_CONCURRENCY", "2"),
+    })
+    if artifact:
+        env.pop("PYTHONPATH", None)
+    else:
+        env["PYTHONPATH"] = BACKEND
+    return env
+
+
+def _healthy(port: int) -> bool:
+    # Production mode only trusts known host names
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/health", headers={"Host": "localhost"})
+    try:
+        with urllib.request.urlopen(request, timeout=1) as response:
+            return response.status == 200
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return False
+
+
+def time_start(artifact: str, timeout: float) -> float:
+    """Seconds from launching the server until /health answers."""
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        env = _environment(directory, bool(artifact))
+        env["GUNICORN_CMD_ARGS"] = f"--bind 127.0.0.1:{port}"
+        if artifact:
+            command, cwd = ["bash", os.path.join(artifact, "start_artifact.sh")], artifact
+        else:
+            command, cwd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn_config.py", "app.main:app"], BACKEND
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Server exited with {process.returncode} before answering")
+                if _healthy(port):
+                    return time.perf_counter() - start
+                time.sleep(0.02)
+            raise RuntimeError(f"No /health answer within {timeout:.0f}s")
+        finally:
+            # start_artifact.sh execs gunicorn, so this is the master either way
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+
+def time_command(command, cwd: str, env: dict) -> float:
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(f"{' '.join(command)} failed:\n{result.stderr[-2000:]}")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server cold start against a budget")
+    parser.add_argument("--artifact", help="built artifact directory; default: run from source")
+    parser.add_argument("--budget", type=float, default=COLD_START_BUDGET_SECONDS)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    artifact = os.path.abspath(args.artifact) if args.artifact else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = _environment(directory, bool(artifact))
+        cwd = artifact or BACKEND
+        if artifact:
+            env.update({"PYTHONPATH": f"{artifact}:{os.path.join(artifact, 'site-packages')}",
+                        "PYTHONDONTWRITEBYTECODE": "1"})
+            print(f"artifact check   {time_command([sys.executable, 'verify_artifact.py'], cwd, env):6.2f}s")
+        print(f"import app.main  {time_command([sys.executable, '-c', 'import app.main'], cwd, env):6.2f}s")
+
+    times = []
+    for run in range(args.runs):
+        times.append(time_start(artifact, timeout=max(60.0, args.budget * 3)))
+        print(f"start {run + 1}          {times[-1]:6.2f}s to first /health")
+    median = statistics.median(times)
+    verdict = "within" if median <= args.budget else "OVER"
+    print(f"median {median:.2f}s, {verdict} the {args.budget:.1f}s budget ({'artifact' if artifact else 'source tree'})")
+    return 0 if median <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Query budget benchmark.
+
+Drives every auth route in-process against a throwaway SQLite database and
+reports SQL statements and query time per route. Exits non-zero if any route
+issues more statements than its budget in app/query_stats.py, so an added
+round trip fails the run.
+
+Usage (from the backend directory): python benchmarks/bench_queries.py [iterations]
+"""
+import os
+import sys
+import tempfile
+import threading
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_db_dir = tempfile.mkdtemp(prefix="dreamapp-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_db_dir, 'bench.db')}")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+os.environ.setdefault("QUERY_BUDGET_STRICT", "1")
+
+from fastapi.testclient import TestClient
+
+from app import auth, models, query_stats
+from app.database import engine
+from app.main import app
+
+
+def run(iterations: int) -> int:
+    # Creating the tables here at the same time as the app's startup thread fails on SQLite
+    for thread in threading.enumerate():
+        if thread.name == "db-setup":
+            thread.join()
+    models.Base.metadata.create_all(bind=engine)
+    # The per-IP rate limits would otherwise stop the run after a few requests
+    auth.limiter.enabled = False
+    app.state.limiter.enabled = False
+    warnings.simplefilter("error", query_stats.QueryBudgetWarning)
+
+    client = TestClient(app, base_url="https://testserver")
+    for i in range(iterations):
+        password = "benchmark1"
+        user = {"email": f"bench{i}@example.com", "username": f"bench{i}", "password": password}
+        client.post("/register", json=user).raise_for_status()
+
+        login = client.post("/token", data={"username": user["username"], "password": password})
+        login.raise_for_status()
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+
+        client.post("/token", data={"username": user["email"], "password": "wrong-password"})
+        client.post("/refresh").raise_for_status()
+        client.get("/me", headers=headers).raise_for_status()
+        client.post("/request-password-reset", json={"email": user["email"]}).raise_for_status()
+        client.post("/logout", headers=headers).raise_for_status()
+        login = client.post("/token", data={"username": user["username"], "password": password})
+        login.raise_for_status()
+        client.post("/logout-all", headers={"Authorization": f"Bearer {login.json()['access_token']}"}).raise_for_status()
+        client.get("/ping").raise_for_status()
+
+    report = query_stats.snapshot()
+    print(f"{'route':<26}{'requests':>9}{'queries/req':>13}{'query ms/req':>14}{'max':>6}{'budget':>8}")
+    over_budget = False
+    for route, stats in sorted(report["routes"].items()):
+        budget = "-" if stats["budget"] is None else stats["budget"]
+        print(f"{route:<26}{stats['requests']:>9}{stats['queries_per_request']:>13}"
+              f"{stats['query_ms_per_request']:>14}{stats['max_queries']:>6}{budget:>8}")
+        over_budget = over_budget or stats["over_budget"] > 0
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,95 @@
+"""
+Response serialization benchmark.
+
+Times how each auth route turns its result into a response body: FastAPI's
+default path (response_model validation, jsonable_encoder, the standard json
+module, and a threadpool hop for sync routes) against the path in
+app/responses.py that the routes use now. Only serialization is measured;
+nothing touches the database or goes over HTTP.
+
+Usage (from the backend directory): python benchmarks/bench_serialization.py [iterations]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+
+from app import models, responses, schemas, utils
+from app.main import app
+
+
+def _cases():
+    user_id = str(uuid.uuid4())
+    user = models.User(
+        id=user_id, email="bench@example.com", username="bench", hashed_password="x",
+        role="user", token_version=0, created_at=datetime.utcnow(),
+    )
+    access_token = utils.create_access_token({"sub": user_id, "token_version": 0, "username": "bench", "role": "user"})
+    current_user = schemas.CurrentUser.model_construct(id=user_id, username="bench", role="user")
+    reset_message = {"message": "If a user with that email exists, a password reset link has been sent"}
+
+    # (path, what the route used to return, how it builds its response now)
+    return [
+        ("/ping", {"status": "ok", "message": "API is working"}, responses.PING),
+        ("/health", {"status": "healthy"}, responses.HEALTHY),
+        ("/register", user, lambda: responses.model_response(schemas.UserOut.model_construct(
+            id=user.id, email=user.email, username=user.username, role=user.role))),
+        ("/token", schemas.Token(access_token=access_token, refresh_token=None),
+         lambda: responses.model_response(schemas.Token.model_construct(access_token=access_token, refresh_token=None))),
+        ("/refresh", schemas.Token(access_token=access_token, refresh_token=None),
+         lambda: responses.model_response(schemas.Token.model_construct(access_token=access_token, refresh_token=None))),
+        ("/me", current_user, lambda: responses.model_response(current_user)),
+        ("/request-password-reset", reset_message, responses.PASSWORD_RESET_REQUESTED),
+        ("/reset-password", {"message": "Password reset successfully"}, responses.PASSWORD_RESET),
+        ("/logout", {"message": "Logged out"}, responses.LOGGED_OUT),
+    ]
+
+
+def _routes():
+    return {route.path: route for route in app.routes if isinstance(route, APIRoute)}
+
+
+async def _time_default(route: APIRoute, content, iterations: int) -> float:
+    is_coroutine = asyncio.iscoroutinefunction(route.dependant.call)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        body = await serialize_response(field=route.response_field, response_content=content, is_coroutine=is_coroutine)
+        JSONResponse(body)
+    return time.perf_counter() - start
+
+
+def _time_fast(build, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build()
+    return time.perf_counter() - start
+
+
+async def run(iterations: int) -> int:
+    routes = _routes()
+    print(f"orjson: {'yes' if responses.ORJSON_AVAILABLE else 'no (standard json)'}")
+    print(f"{'route':<26}{'default us':>12}{'fast us':>10}{'speedup':>9}")
+    for path, content, build in _cases():
+        route = routes[path]
+        # Both paths must produce the same JSON
+        default_body = JSONResponse(await serialize_response(field=route.response_field, response_content=content)).body
+        assert json.loads(build().body) == json.loads(default_body), path
+        default = await _time_default(route, content, iterations)
+        fast = _time_fast(build, iterations)
+        print(f"{path:<26}{default / iterations * 1e6:>12.1f}{fast / iterations * 1e6:>10.1f}{default / fast:>8.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)))
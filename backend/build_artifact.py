@@ -0,0 +1,117 @@
+"""
+Build a self-contained deployment artifact, so servers start without pip.
+
+The artifact holds the app and the runtime scripts, with every requirement
+installed from wheels into site-packages. All bytecode is compiled ahead of
+time as checked-hash pycs: they stay valid whatever the file timestamps
+(deploys reset them), and Python still rejects any pyc that doesn't match
+its source. A manifest records the interpreter, platform and the SHA-256 of
+every file; start_artifact.sh checks it before starting gunicorn.
+
+Build with the Python version and platform the servers run (CI uses 3.10
+on Linux x86_64, like the App Service image). Wheels are kept in --wheels
+between builds, so only changed requirements are downloaded again.
+
+Usage: python build_artifact.py [--output dist/artifact] [--wheels build/wheels]
+"""
+import argparse
+import compileall
+import importlib.metadata
+import json
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import verify_artifact
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# What runs on the server; everything else in the repo stays out of the artifact
+RUNTIME_FILES = [
+    "app",
+    "gunicorn_config.py",
+    "start_artifact.sh",
+    "verify_artifact.py",
+    "import_users.py",
+    "rebalance_shards.py",
+    "build_breached_passwords.py",
+]
+
+
+def run(*command: str) -> None:
+    print(f"+ {' '.join(command)}")
+    subprocess.check_call(command)
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the deployment artifact")
+    parser.add_argument("--output", default=os.path.join(HERE, "dist", "artifact"))
+    parser.add_argument("--wheels", default=os.path.join(HERE, "build", "wheels"))
+    parser.add_argument("--requirements", default=os.path.join(HERE, "requirements.txt"))
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    output = os.path.abspath(args.output)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    run(sys.executable, "-m", "pip", "wheel", "--quiet", "-r", args.requirements, "-w", args.wheels)
+    run(sys.executable, "-m", "pip", "install", "--quiet", "--no-index", "--find-links", args.wheels,
+        "--no-compile", "--target", os.path.join(output, "site-packages"), "-r", args.requirements)
+
+    for name in RUNTIME_FILES:
+        source, target = os.path.join(HERE, name), os.path.join(output, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, target, ignore=shutil.ignore_patterns("__pycache__", "*.pyc", "*.db"))
+        else:
+            shutil.copy2(source, target)
+    # Without requirements.txt App Service has nothing to build, but say so explicitly
+    with open(os.path.join(output, ".deployment"), "w") as f:
+        f.write("[config]\nSCM_DO_BUILD_DURING_DEPLOYMENT=false\n")
+
+    compiled = compileall.compile_dir(
+        output, quiet=1, workers=0, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH
+    )
+    if not compiled:
+        # Usually a dependency's test or Python 2 file; the app itself must compile
+        if not compileall.compile_dir(os.path.join(output, "app"), quiet=1,
+                                      invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH):
+            sys.exit("The app failed to compile")
+        print("Some dependency files did not compile; they will be compiled in memory if imported")
+
+    with open(args.requirements, "rb") as f:
+        requirements = f.read().decode()
+    manifest = {
+        **verify_artifact.runtime(),
+        "built_at": datetime.utcnow().isoformat() + "Z",
+        "commit": commit(),
+        "requirements": requirements.splitlines(),
+        # What pip resolved, including unpinned transitive dependencies
+        "installed": sorted(
+            f"{dist.metadata['Name']}=={dist.version}"
+            for dist in importlib.metadata.distributions(path=[os.path.join(output, "site-packages")])
+        ),
+        "files": verify_artifact.file_hashes(output),
+    }
+    with open(os.path.join(output, verify_artifact.MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    size = sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(output) for name in names)
+    print(f"Built {output}: {len(manifest['files'])} files, {size / 1048576:.1f} MB, "
+          f"for {manifest['python']} on {manifest['platform']}, in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Convert the Have I Been Pwned SHA-1 password list into the binary file read by
+app/breached_passwords.py.
+
+Download the list ordered by hash (lines of "SHA1HEX:COUNT"), then:
+
+    python build_breached_passwords.py pwned-passwords-sha1-ordered-by-hash-v8.txt breached.bin [--min-count 10]
+
+and point BREACHED_PASSWORDS_FILE at the output. The input is streamed, so
+memory use stays small regardless of its size.
+"""
+import argparse
+import array
+import os
+import sys
+
+from app.breached_passwords import DEFAULT_RECORD_SIZE, FANOUT, FANOUT_ENTRIES, HEADER, MAGIC
+
+
+def build(source, output_path: str, record_size: int = DEFAULT_RECORD_SIZE, min_count: int = 1) -> int:
+    fanout = array.array("Q", [0] * FANOUT_ENTRIES)
+    count = 0
+    previous = b""
+    temp_path = output_path + ".tmp"
+
+    with open(temp_path, "wb") as out:
+        # Header and fan-out are rewritten once the record count is known
+        out.write(HEADER.pack(MAGIC, record_size, 0))
+        out.write(FANOUT.pack(*fanout))
+
+        for line_number, line in enumerate(source, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            digest_hex, _, seen = line.partition(":")
+            if seen and int(seen) < min_count:
+                continue
+            try:
+                prefix = bytes.fromhex(digest_hex)[:record_size]
+            except ValueError:
+                prefix = b""
+            if len(prefix) != record_size:
+                raise ValueError(f"Line {line_number}: not a SHA-1 hash")
+            if prefix < previous:
+                raise ValueError(f"Line {line_number}: input is not sorted by hash; use the 'ordered by hash' download")
+            if prefix == previous:
+                continue
+            out.write(prefix)
+            # Every bucket after this prefix's starts past it
+            fanout[int.from_bytes(prefix[:2], "big") + 1] = count + 1
+            previous = prefix
+            count += 1
+
+        # Empty buckets start where the previous bucket ended
+        for i in range(1, FANOUT_ENTRIES):
+            fanout[i] = max(fanout[i], fanout[i - 1])
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, record_size, count))
+        out.write(FANOUT.pack(*fanout))
+
+    os.replace(temp_path, output_path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the breached password index")
+    parser.add_argument("source", help="HIBP SHA-1 list ordered by hash, or - for stdin")
+    parser.add_argument("output", help="binary index to write")
+    parser.add_argument("--prefix-bytes", type=int, default=DEFAULT_RECORD_SIZE,
+                        help="bytes of each SHA-1 to keep (default %(default)s)")
+    parser.add_argument("--min-count", type=int, default=1,
+                        help="skip passwords seen fewer times than this in breaches")
+    args = parser.parse_args()
+
+    if not 4 <= args.prefix_bytes <= 20:
+        parser.error("--prefix-bytes must be between 4 and 20")
+
+    if args.source == "-":
+        count = build(sys.stdin, args.output, args.prefix_bytes, args.min_count)
+    else:
+        with open(args.source, encoding="ascii") as source:
+            count = build(source, args.output, args.prefix_bytes, args.min_count)
+
+    size_mb = os.path.getsize(args.output) / 1048576
+    print(f"Wrote {count} hashes to {args.output} ({size_mb:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,83 @@
 """
 Configuration file for gunicorn server.
-Used by Azure App Service to start the application.
+Used by Azure App Service to start the application:
+
+    gunicorn -c gunicorn_config.py app.main:app
+
+The app is imported once in the master and shared with workers copy-on-write.
+Garbage collection stays off in the master and everything imported is frozen
+before each fork, so the collector doesn't touch (and un-share) those pages
+in the workers. Per-process state is rebuilt in post_fork.
 """
+import gc
+import multiprocessing
+import os
+import sys
+
+# Keep the collector from dirtying shared pages while the app is imported;
+# workers turn it back on after fork
+gc.disable()
 
 # Bind to 0.0.0.0:8000
 bind = "0.0.0.0:8000"
 
-# Number of worker processes - reduce for less memory usage
-workers = 2
+# Import the app in the master so workers start from shared, already-imported code
+preload_app = True
+
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def _memory_budget_mb():
+    """Memory this container may use: explicit budget, then cgroup limit, then physical RAM."""
+    if os.getenv("WORKER_MEMORY_BUDGET_MB"):
+        return float(os.getenv("WORKER_MEMORY_BUDGET_MB"))
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            # cgroup v1 reports "no limit" as a huge number
+            if value != "max" and int(value) < 1 << 60:
+                return int(value) / 1048576
+        except (OSError, ValueError):
+            pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _worker_count():
+    """One async worker per core, capped so every worker can reach its RSS limit."""
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.getenv("WEB_CONCURRENCY"))
+    workers = _available_cores()
+    budget = _memory_budget_mb()
+    if budget:
+        # Leave a fifth of the budget for the master, the OS and page cache
+        per_worker = float(os.getenv("MAX_WORKER_RSS_MB", 350)) or 350
+        workers = min(workers, int(budget * 0.8 // per_worker))
+    return max(1, workers)
+
+
+# Number of worker processes, sized from available cores and memory (override with WEB_CONCURRENCY)
+workers = _worker_count()
 
 # Maximum number of simultaneous clients
 backlog = 2048
 
-# Maximum number of requests a worker will process before restarting
-max_requests = 1000
-
-# Restart workers randomly to avoid memory issues
-max_requests_jitter = 50
+# Workers are no longer restarted after a fixed number of requests. Each worker
+# checks its own private memory and restarts gracefully once it passes MAX_WORKER_RSS_MB
+# (see app/memory.py), so healthy workers avoid needless cold starts.
+max_requests = 0
 
 # Timeout for requests
 timeout = 30  # Reduced timeout to prevent worker blocking
@@ -24,11 +85,52 @@ timeout = 30  # Reduced timeout to prevent worker blocking
 # Worker timeout for graceful reload
 graceful_timeout = 30
 
+keepalive = 2
+
 # Process name
 proc_name = "dreamapp_auth_api"
 
 # Log level
 loglevel = "info"
+accesslog = "-"
+errorlog = "-"
+capture_output = True
 
 # Use the Uvicorn worker
-worker_class = "uvicorn.workers.UvicornWorker"
\ No newline at end of file
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def when_ready(server):
+    # Compact the heap once after the app import, before the first fork
+    gc.collect()
+    budget = _memory_budget_mb()
+    server.log.info(f"Starting {workers} workers ({_available_cores()} cores, "
+                    f"memory budget {f'{budget:.0f} MB' if budget else 'unknown'})")
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far into the permanent generation so the
+    # worker's collector never scans (and copies) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+    # Only needed when the app was imported in the master
+    if "app.main" not in sys.modules:
+        return
+    from app import auth, concurrency, database, memory, utils
+    from app.main import app
+
+    # Connections and threads don't survive fork; drop every inherited pool
+    # (the master's setup thread has already connected) without closing the
+    # master's sockets, and start fresh per-worker state
+    for engine in database.all_engines:
+        engine.dispose(close=False)
+    utils.reset_hash_executor()
+    concurrency.admission.reset()
+    memory.recycle_policy.reset()
+    # The per-IP rate limit counters are per worker too (memory:// storage)
+    auth.reset_limiter_storage(auth.limiter)
+    auth.reset_limiter_storage(app.state.limiter)
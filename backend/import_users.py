@@ -0,0 +1,45 @@
+"""
+Bulk-import users from a CSV or NDJSON file.
+
+Rows need email, username and either password (validated like /register and
+hashed here) or hashed_password (an existing bcrypt hash, stored as-is).
+
+Usage: python import_users.py users.csv [--batch-size 500] [--hash-workers 4] [--report duplicates.csv]
+"""
+import argparse
+import logging
+import sys
+
+from app import bulk_import
+from app.database import SessionLocal
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-import users from CSV or NDJSON")
+    parser.add_argument("path", help="input file, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="default: guessed from the file extension")
+    parser.add_argument("--batch-size", type=int, default=bulk_import.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--hash-workers", type=int, default=bulk_import.DEFAULT_HASH_WORKERS)
+    parser.add_argument("--report", default="import-report.csv", help="where to write skipped rows")
+    args = parser.parse_args()
+
+    fmt = args.format or bulk_import.detect_format(args.path)
+    db = SessionLocal()
+    try:
+        if args.path == "-":
+            result = bulk_import.import_users(db, sys.stdin, fmt, args.report,
+                                              batch_size=args.batch_size, hash_workers=args.hash_workers)
+        else:
+            with open(args.path, encoding="utf-8-sig", newline="") as stream:
+                result = bulk_import.import_users(db, stream, fmt, args.report,
+                                                  batch_size=args.batch_size, hash_workers=args.hash_workers)
+    finally:
+        db.close()
+
+    print(result.as_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Fill the shard directory and move users onto the shard their id hashes to.
+
+Run with the app's environment after adding a URL to DB_SHARD_URLS (and after
+first enabling sharding, to index the users already on the primary):
+
+    python rebalance_shards.py [--batch-size 500] [--dry-run]
+
+Every user first gets directory entries for the shard that holds them. Then
+users whose home shard has changed are moved a batch at a time: copied to
+the new shard, switched over in the directory, and deleted from the old
+shard, with the old rows locked throughout so no write is lost. The app
+keeps serving and finds each user on one shard or the other. It is safe to
+interrupt and run again.
+"""
+import argparse
+import logging
+from collections import defaultdict
+from typing import Dict, Iterator, List
+
+from sqlalchemy import delete, insert, select, update
+
+from app import models, sharding
+from app.database import shard_engines
+
+logger = logging.getLogger("rebalance_shards")
+
+users = models.User.__table__
+directory = models.UserDirectory.__table__
+directory_engine = shard_engines[0]
+
+
+def _user_batches(shard_engine, batch_size: int, *columns) -> Iterator[list]:
+    """All users on a shard in id order, one short read transaction per batch."""
+    last_id = None
+    while True:
+        query = select(*(columns or [users])).order_by(users.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(users.c.id > last_id)
+        with shard_engine.connect() as conn:
+            rows = conn.execute(query).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def backfill_directory(batch_size: int, dry_run: bool = False) -> int:
+    """Add missing directory entries for every user, pointing at the shard that holds them."""
+    added = 0
+    for shard, shard_engine in enumerate(shard_engines):
+        for rows in _user_batches(shard_engine, batch_size, users.c.id, users.c.email, users.c.username):
+            entries = [
+                entry for row in rows
+                for entry in sharding.directory_entries(row.id, row.email, row.username, str(shard))
+            ]
+            with directory_engine.begin() as conn:
+                known = dict(conn.execute(
+                    select(directory.c.lookup_key, directory.c.user_id)
+                    .where(directory.c.lookup_key.in_([entry["lookup_key"] for entry in entries]))
+                ).all())
+                missing = []
+                for entry in entries:
+                    owner = known.get(entry["lookup_key"])
+                    if owner is None:
+                        missing.append(entry)
+                    elif owner != entry["user_id"]:
+                        logger.warning(f"{entry['lookup_key']} belongs to both {owner} and {entry['user_id']}")
+                if missing and not dry_run:
+                    conn.execute(insert(directory), missing)
+            added += len(missing)
+    return added
+
+
+def move_users(source: int, target: int, rows: List) -> None:
+    """Move a batch of user rows from one shard to another."""
+    ids = [row.id for row in rows]
+    with directory_engine.connect() as conn:
+        placed = dict(conn.execute(
+            select(directory.c.user_id, directory.c.shard).where(directory.c.user_id.in_(ids))
+        ).all())
+
+    # The source rows stay locked from the copy through the directory switch to the
+    # delete, so a request that found the user on the source can't write in between
+    # and have its change left behind. The batch read is only a hint; what gets copied
+    # is the locked current row.
+    with shard_engines[source].begin() as conn:
+        current = conn.execute(select(users).where(users.c.id.in_(ids)).with_for_update()).all()
+        # A rerun after an interruption finds some users already switched over; their
+        # target copy is the live one and must not be written to again
+        to_copy = [row for row in current if placed.get(row.id) != target]
+        if to_copy:
+            copied = [row.id for row in to_copy]
+            with shard_engines[target].begin() as target_conn:
+                target_conn.execute(delete(users).where(users.c.id.in_(copied)))
+                target_conn.execute(insert(users), [dict(row._mapping) for row in to_copy])
+            with directory_engine.begin() as directory_conn:
+                directory_conn.execute(update(directory).where(directory.c.user_id.in_(copied)).values(shard=target))
+        conn.execute(delete(users).where(users.c.id.in_(ids)))
+
+
+def rebalance(batch_size: int, dry_run: bool = False) -> Dict[str, int]:
+    moves: Dict[str, int] = defaultdict(int)
+    for source, shard_engine in enumerate(shard_engines):
+        for rows in _user_batches(shard_engine, batch_size):
+            by_target = defaultdict(list)
+            for row in rows:
+                target = int(sharding.home_shard(row.id, len(shard_engines)))
+                if target != source:
+                    by_target[target].append(row)
+            for target, moving in by_target.items():
+                if not dry_run:
+                    move_users(source, target, moving)
+                moves[f"{source}->{target}"] += len(moving)
+                logger.info(f"{'Would move' if dry_run else 'Moved'} {len(moving)} users from shard {source} to {target}")
+    return dict(moves)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the shard directory and move users to their home shards")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="users per batch, at most 1000 (default %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without changing it")
+    args = parser.parse_args()
+
+    if not 1 <= args.batch_size <= 1000:
+        # Directory checks bind two keys per user, and SQL Server allows 2100 parameters
+        parser.error("--batch-size must be between 1 and 1000")
+    if len(shard_engines) < 2:
+        parser.error("DB_SHARD_URLS is not set; there is only one shard")
+
+    logging.basicConfig(level=logging.INFO)
+    # A newly added shard starts out empty, without tables (even for a dry run, which then reads from them)
+    for shard_engine in shard_engines:
+        models.Base.metadata.create_all(bind=shard_engine)
+
+    added = backfill_directory(args.batch_size, args.dry_run)
+    print(f"{'Would add' if args.dry_run else 'Added'} {added} directory entries")
+    moves = rebalance(args.batch_size, args.dry_run)
+    total = sum(moves.values())
+    print(f"{'Would move' if args.dry_run else 'Moved'} {total} users" + (f": {moves}" if moves else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""
+The app as served for replay_traffic.py, with the per-address rate limits off.
+
+Replayed traffic all comes from one address, so the production limits would
+reject it after a few requests. Only for local replays, never for deployment:
+
+    DATABASE_URL=sqlite:///./replay.db SECRET_KEY=replay \\
+        gunicorn -c gunicorn_config.py replay_app:app
+"""
+from app import auth
+from app.main import app
+
+auth.limiter.enabled = False
+app.state.limiter.enabled = False
@@ -0,0 +1,292 @@
+"""
+Replay captured traffic (app/capture.py) against a local instance for capacity testing.
+
+Each captured request is sent at its original offset from the start of the
+capture, divided by --speed, so bursts and gaps are preserved. A request
+that began after the same user's previous one finished also waits for that
+response, so a slower server doesn't reorder a session. Every hashed
+user gets a synthetic account. Requests from the same user and client share
+an access token and refresh cookie, the way a browser's tabs do. Requests
+are shaped to reproduce the captured outcome: a failed login sends a wrong
+password, a request without a token sends none. Routes that can't be
+reproduced safely (admin, introspection) are skipped.
+
+Run the target from replay_app.py, which turns the per-address rate limits
+off, e.g. against SQLite and no email provider (EMAIL_PROVIDER=none, the
+default):
+
+    DATABASE_URL=sqlite:///./replay.db SECRET_KEY=replay \\
+        gunicorn -c gunicorn_config.py replay_app:app
+
+then, with the same DATABASE_URL (used to create the accounts):
+
+    python replay_traffic.py /tmp/dreamapp-capture --url http://127.0.0.1:8000 --speed 4
+
+Usage: python replay_traffic.py CAPTURE [CAPTURE ...] [--url URL] [--speed 1] [--connections 200]
+       [--no-seed] [--summary]
+Needs httpx (requirements.dev.txt).
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from app import capture
+
+PASSWORD = "Replay-pass-2024"
+WRONG_PASSWORD = "Replay-wrong-2024"
+# Late by more than this and the replay client, not the server, is the bottleneck
+LATE_DISPATCH_SECONDS = 0.05
+SKIPPED_PREFIXES = ("/admin", "/introspect", "/openapi", "/docs", "/redoc")
+
+
+def username_for(identity: int) -> str:
+    return f"r{identity:016x}"
+
+
+def email_for(identity: int) -> str:
+    return f"{username_for(identity)}@replay.example.com"
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def summarize(records: List[capture.Captured]) -> None:
+    span = records[-1].started_at - records[0].started_at if records else 0
+    users = {r.identity for r in records if r.flags & capture.FLAG_USER_ID}
+    clients = {r.client for r in records}
+    print(f"{len(records)} requests over {span:.0f}s ({len(records) / max(span, 1):.1f}/s), "
+          f"{len(users)} users, {len(clients)} clients")
+    by_route = collections.defaultdict(list)
+    for record in records:
+        by_route[record.route].append(record)
+    print(f"{'route':<32}{'count':>8}{'2xx':>7}{'4xx':>7}{'5xx':>7}{'p50 ms':>9}{'p99 ms':>9}")
+    for route, items in sorted(by_route.items(), key=lambda item: -len(item[1])):
+        classes = collections.Counter(r.status // 100 for r in items)
+        durations = [r.duration * 1000 for r in items]
+        print(f"{route:<32}{len(items):>8}{classes[2]:>7}{classes[4]:>7}{classes[5]:>7}"
+              f"{percentile(durations, 0.5):>9.1f}{percentile(durations, 0.99):>9.1f}")
+
+
+def seed_accounts(records: List[capture.Captured]) -> int:
+    """Create an account for every user the capture acts for, except those it registers itself."""
+    from app import bulk_import, models, utils
+    from app.database import SessionLocal, shard_engines
+
+    registered, users = set(), set()
+    for record in records:
+        if record.route == "POST /register" and record.status < 300:
+            registered.add(record.identity)
+        elif record.flags & capture.FLAG_USER_ID and record.identity not in registered:
+            users.add(record.identity)
+    for shard_engine in shard_engines:
+        models.Base.metadata.create_all(bind=shard_engine)
+    # One shared hash; bcrypt cost is paid at login, as in production
+    hashed = utils.hash_password(PASSWORD)
+    rows = "".join(
+        json.dumps({"email": email_for(i), "username": username_for(i), "hashed_password": hashed}) + "\n"
+        for i in sorted(users) + [0]
+    )
+    db = SessionLocal()
+    try:
+        report = os.path.join(tempfile.gettempdir(), "replay-seed-report.csv")
+        result = bulk_import.import_users(db, io.StringIO(rows), "ndjson", report)
+    finally:
+        db.close()
+    return result.inserted
+
+
+class Session:
+    """A user's browser: one access token and refresh cookie shared by its tabs."""
+
+    def __init__(self, identity: int):
+        self.identity = identity
+        self.access_token: Optional[str] = None
+        self.refresh_token: Optional[str] = None
+        self.login_lock = asyncio.Lock()
+
+
+class Replayer:
+    def __init__(self, client, speed: float):
+        self.client = client
+        self.speed = speed
+        self.sessions: Dict[tuple, Session] = {}
+        self.latencies = collections.defaultdict(list)
+        self.matched = collections.Counter()
+        self.mismatched = collections.Counter()
+        self.errors = collections.Counter()
+        self.skipped = collections.Counter()
+        self.setup_logins = 0
+        self.late = 0
+
+    def session_for(self, record: capture.Captured) -> Session:
+        key = (record.identity, record.client)
+        if key not in self.sessions:
+            self.sessions[key] = Session(record.identity)
+        return self.sessions[key]
+
+    def _remember(self, session: Session, response) -> None:
+        if response.status_code < 300 and "access_token" in response.text:
+            session.access_token = response.json()["access_token"]
+        refresh_token = response.cookies.get("refresh_token")
+        if refresh_token:
+            session.refresh_token = refresh_token
+
+    async def login(self, session: Session) -> None:
+        """Sign a session in outside the measured traffic, when the capture started mid-session."""
+        async with session.login_lock:
+            if session.access_token:
+                return
+            self.setup_logins += 1
+            response = await self.client.post("/token", data={
+                "username": username_for(session.identity), "password": PASSWORD,
+            })
+            self._remember(session, response)
+
+    async def request_for(self, record: capture.Captured, session: Session) -> Optional[dict]:
+        method, path = record.route.split(" ", 1)
+        ok = record.status < 300
+        identity = record.identity
+        if path == "/register":
+            if not ok:
+                # A clash with an existing account
+                return {"json": {"email": email_for(0), "username": username_for(0), "password": PASSWORD}}
+            return {"json": {"email": email_for(identity), "username": username_for(identity), "password": PASSWORD}}
+        if path == "/token":
+            return {"data": {"username": username_for(identity), "password": PASSWORD if ok else WRONG_PASSWORD}}
+        if path == "/request-password-reset":
+            return {"json": {"email": email_for(identity)}}
+        if path == "/reset-password":
+            # Reset tokens only exist in emails; this replays the failure path
+            return {"json": {"token": "replay", "password": PASSWORD}}
+        if path == "/verify-email":
+            return {"json": {"token": "replay"}}
+        headers, cookies = {}, {}
+        if path == "/refresh" and record.flags & capture.FLAG_REFRESH_COOKIE:
+            if not session.refresh_token and ok:
+                await self.login(session)
+            if session.refresh_token:
+                cookies["refresh_token"] = session.refresh_token
+        if record.flags & capture.FLAG_BEARER:
+            if not session.access_token and ok:
+                await self.login(session)
+            if session.access_token:
+                headers["Authorization"] = f"Bearer {session.access_token}"
+        request = {"headers": headers}
+        if cookies:
+            # The refresh cookie is Secure and path-scoped; send it explicitly over plain HTTP
+            request["headers"]["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+        return request
+
+    async def play(self, record: capture.Captured, after: Optional[asyncio.Task] = None) -> None:
+        if after is not None:
+            # The user waited for this response in the capture, so the replay does too
+            await after
+        method, path = record.route.split(" ", 1)
+        session = self.session_for(record)
+        request = await self.request_for(record, session)
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **request)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            return
+        self.latencies[record.route].append((time.perf_counter() - start) * 1000)
+        if response.status_code // 100 == record.status // 100:
+            self.matched[record.route] += 1
+        else:
+            self.mismatched[record.route] += 1
+        if path in ("/token", "/refresh"):
+            self._remember(session, response)
+        elif path in ("/logout", "/logout-all") and response.status_code < 300:
+            session.access_token = session.refresh_token = None
+
+    async def run(self, records: List[capture.Captured]) -> float:
+        tasks = []
+        # Each user and client's latest request, and when it finished in the capture
+        latest: Dict[tuple, tuple] = {}
+        origin, started = records[0].started_at, time.perf_counter()
+        for record in records:
+            path = record.route.split(" ", 1)[1]
+            if path == capture.UNMATCHED or path.startswith(SKIPPED_PREFIXES):
+                self.skipped[record.route] += 1
+                continue
+            due = started + (record.started_at - origin) / self.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > LATE_DISPATCH_SECONDS:
+                self.late += 1
+            key, after = (record.identity, record.client), None
+            if record.identity and key in latest and record.started_at >= latest[key][1]:
+                after = latest[key][0]
+            task = asyncio.create_task(self.play(record, after))
+            latest[key] = (task, record.started_at + record.duration)
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def report(self, records: List[capture.Captured], elapsed: float) -> None:
+        captured = collections.defaultdict(list)
+        for record in records:
+            captured[record.route].append(record.duration * 1000)
+        sent = sum(len(values) for values in self.latencies.values())
+        print(f"\nReplayed {sent} requests in {elapsed:.1f}s ({sent / max(elapsed, 1e-9):.1f}/s) at {self.speed}x, "
+              f"{self.setup_logins} setup logins, {self.late} dispatched late")
+        print(f"{'route':<32}{'count':>7}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}"
+              f"{'captured p50':>14}{'p99':>8}{'same status':>13}")
+        for route, values in sorted(self.latencies.items(), key=lambda item: -len(item[1])):
+            total = self.matched[route] + self.mismatched[route]
+            print(f"{route:<32}{len(values):>7}{percentile(values, 0.5):>8.1f}{percentile(values, 0.9):>8.1f}"
+                  f"{percentile(values, 0.99):>8.1f}{max(values):>8.1f}"
+                  f"{percentile(captured[route], 0.5):>14.1f}{percentile(captured[route], 0.99):>8.1f}"
+                  f"{self.matched[route] / total:>12.0%}")
+        if self.skipped:
+            print(f"Skipped: {dict(self.skipped)}")
+        if self.errors:
+            print(f"Connection errors: {dict(self.errors)}")
+
+
+async def replay(records: List[capture.Captured], url: str, speed: float, connections: int) -> None:
+    import httpx
+
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        replayer = Replayer(client, speed)
+        elapsed = await replayer.run(records)
+        replayer.report(records, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a local instance")
+    parser.add_argument("captures", nargs="+", help="capture files, or directories of them")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="2 replays twice as fast")
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--no-seed", action="store_true", help="the accounts already exist")
+    parser.add_argument("--summary", action="store_true", help="describe the capture without replaying it")
+    args = parser.parse_args()
+
+    records = capture.load(args.captures)
+    if not records:
+        sys.exit("No captured requests found")
+    summarize(records)
+    if args.summary:
+        return
+    if not args.no_seed:
+        logging.basicConfig(level=logging.WARNING)
+        print(f"Seeded {seed_accounts(records)} accounts")
+    asyncio.run(replay(records, args.url, args.speed, args.connections))
+
+
+if __name__ == "__main__":
+    main()
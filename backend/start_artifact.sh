@@ -0,0 +1,17 @@
+#!/bin/bash
+# Start a prebuilt artifact (see build_artifact.py): check it, then run gunicorn.
+# Nothing is installed or compiled here, so a new instance serves within seconds.
+set -e
+cd "$(dirname "$0")"
+
+export ENVIRONMENT="${ENVIRONMENT:-production}"
+export PYTHONUNBUFFERED=1
+export PYTHONFAULTHANDLER=1
+# Bytecode ships with the artifact; never write pyc files next to the verified ones
+export PYTHONDONTWRITEBYTECODE=1
+export PYTHONPATH="$(pwd):$(pwd)/site-packages"
+
+python verify_artifact.py
+
+# Workers, timeouts, preloading and fork hooks come from gunicorn_config.py
+exec python -m gunicorn -c gunicorn_config.py app.main:app
@@ -67,16 +67,6 @@ echo "Starting application with gunicorn in Azure..."
 export APP_MODULE="app.main:app"
 echo "Using app module: $APP_MODULE"
 
-gunicorn $APP_MODULE \
-  --bind=0.0.0.0:8000 \
-  --workers=2 \
-  --worker-class=uvicorn.workers.UvicornWorker \
-  --timeout=30 \
-  --graceful-timeout=20 \
-  --keep-alive=2 \
-  --max-requests=1000 \
-  --max-requests-jitter=50 \
-  --log-level=debug \
-  --access-logfile=- \
-  --error-logfile=- \
-  --capture-output
\ No newline at end of file
+# Workers, timeouts, preloading and fork hooks come from gunicorn_config.py
+gunicorn -c gunicorn_config.py $APP_MODULE \
+  --log-level=debug
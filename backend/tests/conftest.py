@@ -0,0 +1,80 @@
+"""
+Shared fixtures. The app reads its configuration at import time, so the
+environment is set up here, before anything imports app.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+_workdir = tempfile.mkdtemp(prefix="dreamapp-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'test.db')}"
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["AUDIT_SPILL_DIR"] = os.path.join(_workdir, "audit-spill")
+# A table of its own, so runs never see each other's lockouts
+os.environ["LOGIN_TRACKER_NAMESPACE"] = f"tests-{uuid.uuid4().hex[:8]}"
+os.environ.pop("DB_SHARD_URLS", None)
+os.environ.pop("DB_READ_REPLICA_URLS", None)
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import auth, migrations, revocation
+from app.database import SessionLocal, engine
+from app.login_guard import failed_logins
+from app.main import app
+
+PASSWORD = "Test-pass-2024"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    # Creating the tables alongside the app's startup thread fails on SQLite
+    for thread in threading.enumerate():
+        if thread.name == "db-setup":
+            thread.join()
+    migrations.setup(engine)
+    yield
+    os.unlink(failed_logins.path)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture
+def client():
+    # Every request comes from the same address; the per-IP limits would stop the suite
+    auth.limiter.enabled = False
+    app.state.limiter.enabled = False
+    return TestClient(app, base_url="https://testserver")
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture(autouse=True)
+def revocation_state():
+    """Each test starts with empty in-memory revocation state."""
+    revocation.token_versions = revocation.TokenVersionMap()
+    revocation.deny_list = revocation.DenyList()
+    yield
+
+
+@pytest.fixture
+def register(client):
+    """Register a fresh user and log them in; returns (user, access token, refresh token)."""
+    def _register():
+        name = f"u{uuid.uuid4().hex[:12]}"
+        response = client.post("/register", json={
+            "email": f"{name}@example.com", "username": name, "password": PASSWORD,
+        })
+        assert response.status_code == 200, response.text
+        login = client.post("/token", data={"username": name, "password": PASSWORD})
+        assert login.status_code == 200, login.text
+        return response.json(), login.json()["access_token"], login.cookies.get("refresh_token")
+    return _register
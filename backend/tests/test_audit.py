@@ -0,0 +1,102 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, inspect, select
+from sqlalchemy.exc import OperationalError
+
+from app import audit
+from app.database import engine
+
+
+@pytest.fixture
+def spill_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(audit, "AUDIT_SPILL_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _events(count, now=None):
+    marker = uuid.uuid4().hex
+    now = now or datetime.utcnow()
+    return marker, [(now, "login", None, marker, "192.0.2.1", False, "bad password") for _ in range(count)]
+
+
+def _stored(marker, day=None):
+    table = audit.table_for(day or datetime.utcnow())
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(table).where(table.c.subject == marker)).scalar()
+
+
+def _dead_pid():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def test_failed_flush_spills_and_replays(spill_dir, monkeypatch):
+    log = audit.AuditLog(batch_size=4)
+    marker, events = _events(10)
+    for event in events:
+        log.record(event)
+
+    def unavailable(events):
+        raise OperationalError("INSERT", {}, Exception("database is down"))
+
+    monkeypatch.setattr(log, "_insert", unavailable)
+    assert log.flush() == 0
+    assert log.spilled == 10
+    assert log.last_error == "OperationalError"
+    with open(log._spill_path()) as f:
+        assert len(f.readlines()) == 10
+    assert log.status()["buffered"] == 0
+
+    # Still down: the replay stops at its first insert and keeps the file
+    log.flush()
+    assert os.path.exists(log._spill_path())
+
+    monkeypatch.delattr(log, "_insert")
+    log.flush()
+    assert _stored(marker) == 10
+    assert log.written == 10
+    assert not os.path.exists(log._spill_path())
+
+
+def test_orphaned_spills_are_adopted(spill_dir):
+    orphan_marker, orphaned = _events(3)
+    live_marker, live = _events(2)
+    writer = audit.AuditLog()
+    writer._spill(orphaned)
+    os.rename(writer._spill_path(), spill_dir / f"spill-{_dead_pid()}.ndjson")
+    writer._spill(live)
+    # A spill from a worker that is still running stays with it
+    live_path = spill_dir / f"spill-{os.getppid()}.ndjson"
+    os.rename(writer._spill_path(), live_path)
+
+    log = audit.AuditLog()
+    log._adopt_orphaned_spills()
+    adopted = log._spill_files()
+    assert len(adopted) == 1 and os.path.basename(adopted[0]).startswith(f"spill-{os.getpid()}-")
+
+    log.flush()
+    assert _stored(orphan_marker) == 3
+    assert _stored(live_marker) == 0
+    assert live_path.exists()
+    assert log._spill_files() == []
+
+
+def test_drop_expired_tables():
+    now = datetime.utcnow()
+    days = [now - timedelta(days=audit.AUDIT_RETENTION_DAYS + 5), now - timedelta(days=audit.AUDIT_RETENTION_DAYS + 1),
+            now - timedelta(days=audit.AUDIT_RETENTION_DAYS - 1), now]
+    with engine.begin() as conn:
+        for day in days:
+            audit.table_for(day).create(conn, checkfirst=True)
+
+    expired = sorted(audit.table_for(day).name for day in days[:2])
+    assert sorted(audit.AuditLog().drop_expired_tables(now)) == expired
+    remaining = set(inspect(engine).get_table_names())
+    assert not remaining & set(expired)
+    assert {audit.table_for(day).name for day in days[2:]} <= remaining
@@ -0,0 +1,81 @@
+import hashlib
+
+import pytest
+from pydantic import ValidationError
+
+from app import breached_passwords, schemas
+from build_breached_passwords import build
+
+BREACHED = ["Password123", "Qwerty2024!", "letmein99"]
+SEEN_ONCE = "Rarely-used-7"
+
+# Digests at the first and last records of their fan-out buckets, and at both ends of the table
+EDGES = [
+    "0000" + "00" * 18,
+    "00ffff" + "ff" * 17,
+    "0100" + "00" * 18,
+    "ffff" + "ff" * 18,
+]
+# Digests next to the edges that are not in the table; some differ only in the stored prefix's last byte
+NEIGHBOURS = [
+    "0000" + "00" * 7 + "01" + "00" * 10,
+    "00fffe" + "ff" * 17,
+    "0001" + "00" * 18,
+    "0100" + "00" * 7 + "01" + "00" * 10,
+    "ffff" + "ff" * 7 + "fe" + "ff" * 10,
+]
+
+
+def _sha1(password: str) -> str:
+    return hashlib.sha1(password.encode()).hexdigest().upper()
+
+
+@pytest.fixture
+def index(tmp_path):
+    lines = [f"{_sha1(password)}:{100 + i}" for i, password in enumerate(BREACHED)]
+    lines += [f"{digest.upper()}:50" for digest in EDGES]
+    lines.append(f"{_sha1(SEEN_ONCE)}:1")
+    # The same 10-byte prefix twice is stored once
+    lines.append(f"{_sha1(BREACHED[0])[:-2]}00:7")
+    path = str(tmp_path / "breached.bin")
+    assert build(sorted(lines), path, min_count=2) == len(BREACHED) + len(EDGES)
+    return breached_passwords.BreachedPasswordIndex(path)
+
+
+def test_hits_and_misses(index):
+    for password in BREACHED:
+        assert index.contains(password)
+    assert not index.contains(SEEN_ONCE)
+    assert not index.contains("Never-breached-42")
+    assert not index.contains("password123")
+
+
+def test_bucket_boundaries(index):
+    for digest in EDGES:
+        assert index.contains_digest(bytes.fromhex(digest))
+    for digest in NEIGHBOURS:
+        assert not index.contains_digest(bytes.fromhex(digest))
+
+
+def test_rejects_unsorted_input_and_damaged_files(tmp_path, index):
+    with pytest.raises(ValueError, match="not sorted"):
+        build([f"{EDGES[1]}:2", f"{EDGES[0]}:2"], str(tmp_path / "unsorted.bin"))
+
+    truncated = tmp_path / "truncated.bin"
+    with open(index.path, "rb") as f:
+        truncated.write_bytes(f.read()[:-3])
+    with pytest.raises(ValueError, match="truncated"):
+        breached_passwords.BreachedPasswordIndex(str(truncated))
+
+
+def test_schemas_reject_breached_passwords(index, monkeypatch):
+    monkeypatch.setattr(breached_passwords, "_index", index)
+    monkeypatch.setattr(breached_passwords, "_index_loaded", True)
+
+    with pytest.raises(ValidationError, match="data breach"):
+        schemas.UserCreate(email="new@example.com", username="newuser", password="Password123")
+    with pytest.raises(ValidationError, match="data breach"):
+        schemas.ResetPassword(token="t", password="Qwerty2024!", confirm_password="Qwerty2024!")
+
+    schemas.UserCreate(email="new@example.com", username="newuser", password="Never-breached-42")
+    schemas.ResetPassword(token="t", password="Never-breached-42", confirm_password="Never-breached-42")
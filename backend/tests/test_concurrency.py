@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.concurrency import (
+    AdaptiveLimiter, AdmissionControlMiddleware,
+    PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL,
+)
+
+
+def test_limit_grows_while_used_and_backs_off_on_slow_requests():
+    limiter = AdaptiveLimiter(initial_limit=10, min_limit=4, max_limit=12)
+    # Idle capacity doesn't grow the limit
+    limiter.record("/token", 0.01)
+    assert limiter.limit == 10
+
+    limiter.in_flight = 8
+    limiter.record("/token", 0.01)
+    assert limiter.limit == pytest.approx(10.1)
+    for _ in range(200):
+        limiter.record("/token", 0.01)
+    assert limiter.limit == 12
+
+    # Well past the route's baseline: one multiplicative decrease per observed latency
+    limiter.record("/token", 1.0)
+    assert limiter.limit == pytest.approx(12 * 0.9)
+    limiter.record("/token", 1.0)
+    assert limiter.limit == pytest.approx(12 * 0.9)
+    for _ in range(50):
+        limiter._last_decrease = 0.0
+        limiter.record("/token", 1.0)
+    assert limiter.limit == 4
+
+
+def test_classes_fill_their_share_of_the_limit():
+    async def admitted(limiter, priority):
+        count = 0
+        while await limiter.acquire(priority):
+            count += 1
+        return count
+
+    async def scenario():
+        limiter = AdaptiveLimiter(initial_limit=10)
+        # Low priority work stops at half the limit and is shed after its short queue target
+        assert await admitted(limiter, PRIORITY_LOW) == 5
+        assert limiter.rejected == 1
+        assert await admitted(limiter, PRIORITY_NORMAL) == 4
+        assert await admitted(limiter, PRIORITY_HIGH) == 1
+        assert limiter.in_flight == 10
+
+        # A freed slot goes to the most important waiter first
+        low = asyncio.ensure_future(limiter.acquire(PRIORITY_LOW))
+        high = asyncio.ensure_future(limiter.acquire(PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        limiter.release()
+        assert await high is True
+        assert await low is False
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_gives_back_its_slot():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial_limit=2)
+        for _ in range(2):
+            assert await limiter.acquire(PRIORITY_HIGH)
+
+        # Cancelled while still queued: nothing to give back
+        queued = asyncio.ensure_future(limiter.acquire(PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert limiter.in_flight == 2 and limiter.stats()["queued"] == 0
+
+        # Cancelled (e.g. by its deadline) in the same loop turn as it is handed a slot
+        waiter = asyncio.ensure_future(limiter.acquire(PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        limiter.release()
+        assert limiter.in_flight == 2
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def shedding():
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1)
+    app = FastAPI()
+    app.add_middleware(AdmissionControlMiddleware, limiter=limiter)
+
+    @app.get("/work")
+    def work():
+        return {"ok": True}
+
+    @app.get("/health")
+    def health():
+        return {"status": "healthy"}
+
+    return limiter, TestClient(app)
+
+
+def test_middleware_sheds_with_503_when_full(shedding):
+    limiter, client = shedding
+    # Another request holds the only slot
+    limiter.in_flight = 1
+    response = client.get("/work")
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json() == {"detail": "Server overloaded, retry later"}
+    assert limiter.rejected == 1
+    # Probes are exempt
+    assert client.get("/health").status_code == 200
+
+    limiter.in_flight = 0
+    assert client.get("/work").status_code == 200
+    assert limiter.in_flight == 0 and limiter.admitted == 1
@@ -0,0 +1,99 @@
+import base64
+import json
+import time
+
+import pytest
+from jose import jwt
+
+from app import introspection, utils
+
+KEY = utils.SECRET_KEY
+
+
+def _segment(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+
+def _claims(**overrides):
+    claims = {"sub": "user-1", "type": "access", "jti": "jti-1", "exp": int(time.time()) + 60}
+    claims.update(overrides)
+    return claims
+
+
+VALID = jwt.encode(_claims(), KEY, algorithm="HS256")
+TOKENS = {
+    "valid": VALID,
+    "expired": jwt.encode(_claims(exp=int(time.time()) - 5), KEY, algorithm="HS256"),
+    "wrong key": jwt.encode(_claims(), "another-secret", algorithm="HS256"),
+    "HS512": jwt.encode(_claims(), KEY, algorithm="HS512"),
+    "alg none": f"{_segment({'alg': 'none', 'typ': 'JWT'})}.{_segment(_claims())}.",
+    # The HS256 signature, relabelled as another algorithm
+    "alg swapped": f"{_segment({'alg': 'HS512', 'typ': 'JWT'})}.{VALID.split('.', 1)[1]}",
+    "tampered": f"{VALID.split('.')[0]}.{_segment(_claims(sub='admin'))}.{VALID.split('.')[2]}",
+    "truncated": VALID[:-4],
+    "not base64": "###.###.###",
+    "two segments": VALID.rsplit(".", 1)[0],
+    "empty": "",
+    "non-object payload": f"{VALID.split('.')[0]}.{_segment([1, 2])}.x",
+    "oversized": jwt.encode(_claims(pad="x" * introspection.MAX_TOKEN_LENGTH), KEY, algorithm="HS256"),
+}
+
+
+def _jose(token: str):
+    try:
+        return utils.verify_token(token)
+    except ValueError:
+        return None
+
+
+@pytest.mark.parametrize("name", list(TOKENS))
+def test_verifier_matches_jose(name):
+    token = TOKENS[name]
+    expected = _jose(token) if len(token) <= introspection.MAX_TOKEN_LENGTH else None
+    assert introspection.verifier.verify([token]) == [expected]
+    assert (expected is not None) == (name == "valid")
+
+
+def test_tokens_without_expiry_are_rejected():
+    token = jwt.encode({"sub": "user-1", "type": "access"}, KEY, algorithm="HS256")
+    assert introspection.verifier.verify([token]) == [None]
+
+
+def test_verifier_keeps_batch_order_and_duplicates():
+    batch = [TOKENS["valid"], TOKENS["expired"], TOKENS["valid"]]
+    payloads = introspection.verifier.verify(batch)
+    assert payloads[0] == payloads[2] == _jose(TOKENS["valid"])
+    assert payloads[1] is None
+
+
+@pytest.fixture
+def service(client, monkeypatch):
+    monkeypatch.setitem(introspection.CLIENTS, "gateway", "gateway-secret")
+    return lambda tokens, auth=("gateway", "gateway-secret"): client.post(
+        "/introspect", json={"tokens": tokens}, auth=auth
+    )
+
+
+def test_introspect_batch(client, register, service):
+    user, access, refresh = register()
+    _, revoked, _ = register()
+    client.post("/logout", headers={"Authorization": f"Bearer {revoked}"})
+
+    response = service([access, revoked, refresh, TOKENS["alg swapped"], access])
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["active"] for result in results] == [True, False, False, False, True]
+    assert results[0]["sub"] == user["id"]
+    assert results[0]["username"] == user["username"]
+    assert 0 <= int(response.headers["cache-control"].rsplit("=", 1)[1]) <= introspection.INTROSPECT_CACHE_SECONDS
+
+
+def test_introspect_sees_logout_all(client, register, service):
+    _, access, _ = register()
+    client.post("/logout-all", headers={"Authorization": f"Bearer {access}"})
+    assert service([access]).json()["results"] == [{"active": False}]
+
+
+def test_introspect_requires_client_credentials(service):
+    assert service([VALID], auth=("gateway", "wrong")).status_code == 401
+    assert service([VALID], auth=("unknown", "gateway-secret")).status_code == 401
@@ -0,0 +1,113 @@
+import pytest
+from sqlalchemy import event
+
+from app import login_guard, utils
+from app.database import engine
+from app.login_guard import LOCKOUT_BASE_SECONDS, LOCKOUT_THRESHOLD, FAILURE_HALF_LIFE_SECONDS, failed_logins
+
+PASSWORD = "Test-pass-2024"
+
+
+class Clock:
+    def __init__(self, now: float = 1_700_000_000):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(login_guard, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    return login_guard.FailedLoginTracker(path=str(tmp_path / "failures"), slots=64)
+
+
+def _fail(client, identifier):
+    return client.post("/token", data={"username": identifier, "password": "wrong-password"})
+
+
+def test_locks_after_threshold_and_backs_off(tracker, clock):
+    for _ in range(LOCKOUT_THRESHOLD - 1):
+        assert tracker.record_failure("alice") == 0
+    assert tracker.retry_after("alice") == 0
+
+    assert tracker.record_failure("alice") == LOCKOUT_BASE_SECONDS
+    assert tracker.retry_after("alice") == LOCKOUT_BASE_SECONDS
+    # Names are compared case-insensitively
+    assert tracker.retry_after(" Alice ") == LOCKOUT_BASE_SECONDS
+
+    clock.now += 10
+    assert tracker.retry_after("alice") == LOCKOUT_BASE_SECONDS - 10
+    assert tracker.record_failure("alice") == 2 * LOCKOUT_BASE_SECONDS
+    assert tracker.stats()["locked"] == 1
+
+
+def test_failures_decay(tracker, clock):
+    for _ in range(LOCKOUT_THRESHOLD - 1):
+        tracker.record_failure("bob")
+    # After one half-life the earlier failures count for half
+    clock.now += FAILURE_HALF_LIFE_SECONDS
+    assert tracker.record_failure("bob") == 0
+    for _ in range(LOCKOUT_THRESHOLD // 2 - 1):
+        assert tracker.record_failure("bob") == 0
+    assert tracker.record_failure("bob") > 0
+
+
+def test_lockout_covers_aliases(tracker, clock):
+    for _ in range(LOCKOUT_THRESHOLD):
+        tracker.record_failure("carol", "carol@example.com")
+    assert tracker.retry_after("carol@example.com") == LOCKOUT_BASE_SECONDS
+    tracker.reset("carol", "carol@example.com")
+    assert tracker.retry_after("carol") == tracker.retry_after("carol@example.com") == 0
+
+
+def test_token_answers_429_with_retry_after(client, register):
+    user, _, _ = register()
+    for _ in range(LOCKOUT_THRESHOLD):
+        assert _fail(client, user["username"]).status_code == 401
+
+    response = client.post("/token", data={"username": user["username"], "password": PASSWORD})
+    assert response.status_code == 429
+    assert LOCKOUT_BASE_SECONDS - 2 <= int(response.headers["Retry-After"]) <= LOCKOUT_BASE_SECONDS
+
+
+def test_username_and_email_count_together(client, register):
+    user, _, _ = register()
+    for attempt in range(LOCKOUT_THRESHOLD):
+        identifier = user["email"] if attempt % 2 else user["username"]
+        assert _fail(client, identifier).status_code == 401
+    assert _fail(client, user["username"]).status_code == 429
+    assert _fail(client, user["email"].upper()).status_code == 429
+
+
+def test_successful_login_resets_failures(client, register):
+    user, _, _ = register()
+    for _ in range(LOCKOUT_THRESHOLD - 1):
+        _fail(client, user["email"])
+    assert client.post("/token", data={"username": user["username"], "password": PASSWORD}).status_code == 200
+    assert _fail(client, user["username"]).status_code == 401
+    assert failed_logins.retry_after(user["username"]) == 0
+
+
+def test_locked_account_costs_no_lookup_or_hashing(client, register, monkeypatch):
+    user, _, _ = register()
+    for _ in range(LOCKOUT_THRESHOLD):
+        _fail(client, user["username"])
+
+    verified, statements = [], []
+    monkeypatch.setattr(utils, "verify_password", lambda *args: verified.append(args) or True)
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.post("/token", data={"username": user["username"], "password": PASSWORD})
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert response.status_code == 429
+    assert verified == []
+    assert statements == []
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from app import memory
+
+MB = 1024 * 1024
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/smaps_rollup"), reason="needs /proc/self/smaps_rollup")
+def test_private_memory_leaves_out_pages_shared_with_the_parent():
+    inherited = bytearray(64 * MB)
+    for offset in range(0, len(inherited), 4096):
+        inherited[offset] = 1
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        before = memory.private_bytes()
+        for offset in range(0, 16 * MB, 4096):
+            inherited[offset] = 2
+        os.write(write_end, f"{memory.rss_bytes()} {before} {memory.private_bytes()}".encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    rss, before, after = map(int, os.read(read_end, 100).split())
+    os.close(read_end)
+    os.close(write_end)
+
+    assert rss > 64 * MB
+    assert before < 32 * MB
+    # Only the pages the child wrote to became its own
+    assert 14 * MB < after - before < 32 * MB
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from app import deadlines, resilience
+
+
+class FakeOdbcError(Exception):
+    """Shaped like pyodbc's errors: (sqlstate, message with native error numbers)."""
+
+
+def odbc_error(sqlstate: str, message: str, wrapper=OperationalError):
+    return wrapper("SELECT 1", {}, FakeOdbcError(sqlstate, f"[{sqlstate}] [Microsoft][ODBC Driver 18 for SQL Server]{message}"))
+
+
+STATEMENT_TIMEOUT = odbc_error("HYT00", "Query timeout expired (0) (SQLExecDirectW)")
+EXECUTION_TIMEOUT = odbc_error("42000", "Execution Timeout Expired (-2) (SQLExecDirectW)")
+LINK_FAILURE = odbc_error("08S01", "TCP Provider: An existing connection was forcibly closed (10054)")
+THROTTLED = odbc_error("42000", "Resource ID : 1. The request limit for the database is 90 (10928)")
+SYNTAX_ERROR = odbc_error("42000", "Incorrect syntax near 'FORM'. (102)", ProgrammingError)
+
+
+@pytest.mark.parametrize("error, transient, timeout", [
+    (STATEMENT_TIMEOUT, True, True),
+    (EXECUTION_TIMEOUT, True, True),
+    (LINK_FAILURE, True, False),
+    (THROTTLED, True, False),
+    (SYNTAX_ERROR, False, False),
+])
+def test_classification(error, transient, timeout):
+    assert resilience.is_transient(error) is transient
+    assert resilience.is_timeout(error) is timeout
+
+
+def test_statement_timeouts_do_not_count_against_the_breaker():
+    # A timeout on an open connection is the request's own deadline running out
+    assert not resilience.counts_against_breaker(STATEMENT_TIMEOUT, connected=True)
+    assert not resilience.counts_against_breaker(EXECUTION_TIMEOUT, connected=True)
+    # Timing out while connecting says the database is unreachable
+    assert resilience.counts_against_breaker(STATEMENT_TIMEOUT, connected=False)
+
+
+def test_connection_failures_count_against_the_breaker():
+    assert resilience.counts_against_breaker(LINK_FAILURE, connected=True)
+    assert resilience.counts_against_breaker(THROTTLED, connected=True)
+    assert resilience.counts_against_breaker(SYNTAX_ERROR, connected=True, is_disconnect=True)
+    assert not resilience.counts_against_breaker(SYNTAX_ERROR, connected=True)
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = resilience.CircuitBreaker(failure_threshold=2, open_seconds=0.05, probes=1)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(resilience.DatabaseUnavailable):
+        breaker.before_request()
+
+    time.sleep(0.06)
+    breaker.before_request()
+    assert breaker.state == breaker.HALF_OPEN
+    with pytest.raises(resilience.DatabaseUnavailable):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+
+
+@pytest.fixture
+def failing_engine(tmp_path, monkeypatch):
+    """An engine whose errors all classify as transient, feeding a fresh breaker."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'breaker.db'}")
+    resilience.install(engine)
+    monkeypatch.setattr(resilience, "breaker", resilience.CircuitBreaker())
+    monkeypatch.setattr(resilience, "is_transient", lambda exc: True)
+    yield engine
+    engine.dispose()
+
+
+def _fail(engine):
+    with engine.connect() as conn, pytest.raises(OperationalError):
+        conn.execute(text("SELECT * FROM missing"))
+
+
+def test_errors_count_against_the_breaker(failing_engine):
+    _fail(failing_engine)
+    assert resilience.breaker.consecutive_failures == 1
+
+
+def test_errors_past_the_deadline_do_not_count(failing_engine):
+    token = deadlines.start(0.001)
+    try:
+        time.sleep(0.01)
+        _fail(failing_engine)
+    finally:
+        deadlines.reset(token)
+    assert resilience.breaker.consecutive_failures == 0
@@ -0,0 +1,108 @@
+import time
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, inspect, text
+
+from app import auth, migrations, models, revocation
+
+
+def _accepted(token: str) -> bool:
+    """Whether authenticated routes would take the access token."""
+    try:
+        auth.verify_access_token(token)
+    except HTTPException:
+        return False
+    return True
+
+
+def test_token_versions_only_move_forward():
+    versions = revocation.TokenVersionMap()
+    assert versions.current("a") == 0
+    versions.update("a", 2)
+    versions.update("a", 1)
+    assert versions.current("a") == 2
+    versions.update("b", 0)
+    assert len(versions) == 1
+
+
+def test_deny_list_drops_expired_entries():
+    deny_list = revocation.DenyList()
+    deny_list.add("expired", time.time() - 1)
+    assert not deny_list.contains("expired")
+    assert len(deny_list) == 0
+
+    deny_list.add("short", time.time() + 0.05)
+    deny_list.add("long", time.time() + 60)
+    time.sleep(0.1)
+    assert not deny_list.contains("short")
+    assert deny_list.prune() == 1
+    assert deny_list.contains("long")
+
+
+def test_is_revoked_checks_jti_and_version():
+    revocation.deny_list.add("jti-1", time.time() + 60)
+    assert revocation.is_revoked({"sub": "a", "jti": "jti-1"})
+    assert not revocation.is_revoked({"sub": "a", "jti": "jti-2"})
+
+    revocation.token_versions.update("a", 1)
+    assert revocation.is_revoked({"sub": "a", "jti": "jti-2", "token_version": 0})
+    assert not revocation.is_revoked({"sub": "a", "jti": "jti-2", "token_version": 1})
+    # Tokens from before token_version existed carry no claim
+    assert revocation.is_revoked({"sub": "a"})
+
+
+def test_logout_revokes_only_that_token(client, register):
+    user, first, _ = register()
+    login = client.post("/token", data={"username": user["username"], "password": "Test-pass-2024"})
+    second = login.json()["access_token"]
+    assert client.post("/logout", headers={"Authorization": f"Bearer {first}"}).status_code == 200
+
+    assert not _accepted(first)
+    assert _accepted(second)
+
+
+def test_logout_all_revokes_access_and_refresh_tokens(client, register):
+    user, access, refresh = register()
+    client.cookies.clear()
+    client.cookies.set("refresh_token", refresh, path="/refresh")
+    refreshed = client.post("/refresh")
+    assert refreshed.status_code == 200
+    refresh = refreshed.cookies.get("refresh_token")
+
+    response = client.post("/logout-all", headers={"Authorization": f"Bearer {access}"})
+    assert response.status_code == 200
+    assert revocation.token_versions.current(user["id"]) == 1
+
+    assert not _accepted(access)
+    client.cookies.clear()
+    client.cookies.set("refresh_token", refresh, path="/refresh")
+    assert client.post("/refresh").status_code == 401
+
+    login = client.post("/token", data={"username": user["username"], "password": "Test-pass-2024"})
+    assert _accepted(login.json()["access_token"])
+
+
+def test_other_workers_pick_up_revocations(client, register, db):
+    user, access, _ = register()
+    _, logged_out, _ = register()
+    client.post("/logout-all", headers={"Authorization": f"Bearer {access}"})
+    client.post("/logout", headers={"Authorization": f"Bearer {logged_out}"})
+
+    # A worker that missed both revocations learns of them on its next sync
+    revocation.token_versions = revocation.TokenVersionMap()
+    revocation.deny_list = revocation.DenyList()
+    revocation.sync(db)
+    assert revocation.token_versions.current(user["id"]) == 1
+    assert not _accepted(logged_out)
+
+
+def test_upgrade_adds_token_version_to_existing_tables(tmp_path):
+    old = create_engine(f"sqlite:///{tmp_path / 'old.db'}").execution_options(schema_translate_map={"dbo": None})
+    models.Base.metadata.create_all(bind=old)
+    with old.begin() as conn:
+        conn.execute(text("DROP INDEX ix_users_updated_at"))
+        conn.execute(text("ALTER TABLE users DROP COLUMN token_version"))
+
+    assert migrations.upgrade(old) == ["column users.token_version", "index ix_users_updated_at"]
+    assert "token_version" in {column["name"] for column in inspect(old).get_columns("users")}
+    assert migrations.upgrade(old) == []
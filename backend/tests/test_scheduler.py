@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from app import maintenance, scheduler as scheduler_module
+from app.scheduler import FileElection, Job, Scheduler
+
+
+class Election:
+    """Stands in for a leader election; leadership ends after ``lose_after`` acquire calls."""
+
+    def __init__(self, lose_after=None):
+        self.lose_after = lose_after
+        self.calls = 0
+        self.saved = {}
+
+    def acquire(self):
+        self.calls += 1
+        return self.lose_after is None or self.calls <= self.lose_after
+
+    def load_runs(self):
+        return dict(self.saved)
+
+    def save_run(self, name, started_at):
+        self.saved[name] = started_at
+
+
+@pytest.fixture(autouse=True)
+def no_pause(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "SCHEDULER_CHUNK_PAUSE_SECONDS", 0)
+
+
+def _leader(election):
+    scheduler = Scheduler(election)
+    scheduler.is_leader = True
+    return scheduler
+
+
+def _job(chunks, fail=False):
+    closed = []
+
+    def func():
+        try:
+            yield from chunks
+            if fail:
+                raise RuntimeError("boom")
+        finally:
+            closed.append(True)
+    return Job("test", func, interval=60, jitter=0), closed
+
+
+def test_completed_run_is_saved_and_rescheduled():
+    election = Election()
+    job, closed = _job([3, 2, 0])
+    _leader(election)._run(job)
+    assert (job.runs, job.chunks, job.items, job.last_items) == (1, 3, 5, 5)
+    assert job.last_error is None and job.interrupted == 0 and not job.running
+    assert election.saved["test"] == job.last_started_at
+    assert job.next_run_at == job.last_started_at + 60
+    assert closed
+
+
+def test_run_stops_when_leadership_is_lost():
+    election = Election(lose_after=1)
+    job, closed = _job([1, 1, 1, 1])
+    job.next_run_at = 123.0
+    scheduler = _leader(election)
+    scheduler._run(job)
+    assert job.chunks == 2 and job.last_items == 2
+    assert job.interrupted == 1 and job.failures == 0
+    # Not recorded as run, so the next leader resumes it on the old schedule
+    assert election.saved == {} and job.next_run_at == 123.0
+    assert not scheduler.is_leader
+    assert closed
+
+
+def test_run_stops_on_shutdown():
+    job, closed = _job([1, 1, 1])
+    scheduler = _leader(Election())
+    scheduler._stop_event.set()
+    scheduler._run(job)
+    assert job.chunks == 1 and job.interrupted == 1
+    assert closed
+
+
+def test_failed_run_waits_an_interval():
+    election = Election()
+    job, closed = _job([4], fail=True)
+    _leader(election)._run(job)
+    assert job.failures == 1 and job.interrupted == 0
+    assert job.last_error == "RuntimeError: boom"
+    assert job.items == 4
+    assert election.saved["test"] == job.last_started_at
+    assert job.next_run_at == job.last_started_at + 60
+    assert closed
+
+
+def test_file_election_has_one_leader(tmp_path):
+    first, second = FileElection(str(tmp_path)), FileElection(str(tmp_path))
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+
+    # Another process on the host is kept out too
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if not FileElection(str(tmp_path)).acquire() else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+    second.release()
+
+
+def test_file_election_keeps_the_schedule(tmp_path):
+    election = FileElection(str(tmp_path))
+    assert election.load_runs() == {}
+    election.save_run("a", 100.0)
+    election.save_run("b", 200.0)
+    assert FileElection(str(tmp_path)).load_runs() == {"a": 100.0, "b": 200.0}
+
+
+def test_maintenance_jobs_are_registered():
+    scheduler = Scheduler()
+    maintenance.register(scheduler)
+    assert set(scheduler.jobs) == {"purge-expired-refresh-tokens", "purge-revoked-tokens", "drop-expired-audit-tables"}
+    assert set(scheduler_module.scheduler.jobs) == set(scheduler.jobs)
@@ -0,0 +1,155 @@
+import time
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app import sessions
+from app.database import engine
+from app.sessions import ServerSession, get_session
+
+# Routes that only exist for these tests
+session_app = FastAPI()
+
+
+@session_app.post("/visit")
+def visit(session: ServerSession = Depends(get_session)):
+    session["visits"] = session.get("visits", 0) + 1
+    return dict(session)
+
+
+@session_app.get("/peek")
+def peek(session: ServerSession = Depends(get_session)):
+    return dict(session)
+
+
+@session_app.post("/end")
+def end(session: ServerSession = Depends(get_session)):
+    session.clear()
+    return {}
+
+
+@pytest.fixture
+def store():
+    saved = sessions.session_store
+    memory = sessions.MemorySessionStore(max_entries=2)
+    sessions.configure(memory)
+    yield memory
+    sessions.configure(saved)
+
+
+def _browser():
+    # The cookie is Secure, so it only comes back over https
+    return TestClient(session_app, base_url="https://testserver")
+
+
+def _issued_id(response) -> str:
+    # Read from the header: the client drops a cookie whose max-age has already passed
+    name, value = response.headers["set-cookie"].split(";")[0].split("=", 1)
+    assert name == sessions.SESSION_COOKIE
+    return value
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        sessions.SessionStore()
+
+
+def test_cookie_holds_only_an_opaque_id(store):
+    browser = _browser()
+    assert browser.get("/peek").json() == {}
+    assert sessions.SESSION_COOKIE not in browser.cookies
+
+    response = browser.post("/visit")
+    assert response.json() == {"visits": 1}
+    session_id = browser.cookies[sessions.SESSION_COOKIE]
+    cookie = response.headers["set-cookie"].lower()
+    assert "httponly" in cookie and "secure" in cookie and "visits" not in cookie
+    # The store is keyed by a hash, never by the id the browser holds
+    assert store.get(sessions._key(session_id)) == {"visits": 1}
+    assert store.get(session_id) is None
+
+    assert browser.post("/visit").json() == {"visits": 2}
+    assert browser.get("/peek").json() == {"visits": 2}
+    assert browser.cookies[sessions.SESSION_COOKIE] == session_id
+
+
+def test_unknown_ids_are_not_reused(store):
+    browser = _browser()
+    browser.cookies.set(sessions.SESSION_COOKIE, "made-up")
+    response = browser.post("/visit")
+    assert response.json() == {"visits": 1}
+    assert _issued_id(response) != "made-up"
+
+
+def test_sessions_expire(store, monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_TTL_SECONDS", 0.05)
+    session_id = _issued_id(_browser().post("/visit"))
+    time.sleep(0.1)
+    # A client that keeps sending the id past the cookie's max-age gets nothing back
+    browser = _browser()
+    browser.cookies.set(sessions.SESSION_COOKIE, session_id)
+    assert browser.get("/peek").json() == {}
+    assert len(store) == 0
+
+
+def test_least_recently_used_session_is_evicted(store):
+    first, second, third = _browser(), _browser(), _browser()
+    first.post("/visit")
+    second.post("/visit")
+    # Reading the first session makes the second the least recently used
+    assert first.get("/peek").json() == {"visits": 1}
+    third.post("/visit")
+    assert store.evicted == 1
+    assert second.get("/peek").json() == {}
+    assert first.get("/peek").json() == {"visits": 1}
+    assert third.get("/peek").json() == {"visits": 1}
+
+
+def test_clear_ends_the_session(store):
+    browser = _browser()
+    browser.post("/visit")
+    session_id = browser.cookies[sessions.SESSION_COOKIE]
+    response = browser.post("/end")
+    assert sessions.SESSION_COOKIE in response.headers["set-cookie"]
+    assert store.get(sessions._key(session_id)) is None
+
+
+def test_database_store_round_trips():
+    store = sessions.DatabaseSessionStore(engine)
+    store.set("key-1", {"user": "a", "items": [1, 2]}, 60)
+    assert store.get("key-1") == {"user": "a", "items": [1, 2]}
+    store.set("key-1", {"user": "b"}, 60)
+    assert store.get("key-1") == {"user": "b"}
+    store.delete("key-1")
+    assert store.get("key-1") is None
+    store.delete("key-1")
+
+    store.set("key-2", {"user": "c"}, -1)
+    assert store.get("key-2") is None
+
+
+def test_routes_share_database_sessions():
+    saved = sessions.session_store
+    sessions.configure(sessions.DatabaseSessionStore(engine))
+    try:
+        browser = _browser()
+        browser.post("/visit")
+        assert browser.post("/visit").json() == {"visits": 2}
+        # Another worker with its own store object sees the same session
+        sessions.configure(sessions.DatabaseSessionStore(engine))
+        assert browser.get("/peek").json() == {"visits": 2}
+    finally:
+        sessions.configure(saved)
+
+
+def test_auth_routes_send_no_session_cookie(client, register):
+    user, _, _ = register()
+    login = client.post("/token", data={"username": user["username"], "password": "Test-pass-2024"})
+    client.cookies.clear()
+    client.cookies.set("refresh_token", login.cookies.get("refresh_token"), path="/refresh")
+    refreshed = client.post("/refresh")
+    health = client.get("/health")
+    for response in (login, refreshed, health):
+        assert response.status_code == 200
+        assert sessions.SESSION_COOKIE not in response.headers.get("set-cookie", "")
@@ -0,0 +1,143 @@
+import pytest
+from sqlalchemy import and_, event, or_, select
+
+import rebalance_shards
+from app import migrations, models, query_stats, sharding
+from app.database import _make_engine
+
+User = models.User
+
+
+def test_jump_hash_moves_only_the_new_share():
+    keys = range(2000)
+    before = [sharding.jump_hash(key, 3) for key in keys]
+    after = [sharding.jump_hash(key, 4) for key in keys]
+    moved = [new for old, new in zip(before, after) if old != new]
+    assert set(moved) == {3}
+    assert 0.2 < len(moved) / len(before) < 0.3
+    assert sharding.home_shard("some-user", 4) == sharding.home_shard("some-user", 4)
+
+
+@pytest.mark.parametrize("clause, expected", [
+    (None, []),
+    (User.email == "a@example.com", [("email", "a@example.com")]),
+    (and_(User.username == "a", User.is_active == True), [("username", "a")]),  # noqa: E712
+    (or_(User.email == "a@example.com", User.username == "a"), [("email", "a@example.com"), ("username", "a")]),
+    # One side of the OR could match anyone, so every shard has to be asked
+    (or_(User.email == "a@example.com", User.is_active == True), []),  # noqa: E712
+    (User.role == "admin", []),
+])
+def test_lookups(clause, expected):
+    assert sharding._lookups(clause) == expected
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    """A session factory over three SQLite shards, with the app's own shards restored afterwards."""
+    saved = dict(sharding.shards)
+    engines = [_make_engine(f"sqlite:///{tmp_path / f'shard{i}.db'}") for i in range(3)]
+    for engine in engines:
+        migrations.setup(engine)
+    statements = []
+    for shard_id, engine in enumerate(engines):
+        event.listen(engine, "before_cursor_execute",
+                     lambda *args, shard_id=shard_id, **kw: statements.append(shard_id))
+    factory = sharding.install(engines)
+    yield factory, engines, statements
+    sharding.shards.clear()
+    sharding.shards.update(saved)
+    for engine in engines:
+        engine.dispose()
+
+
+def _add_users(factory, count):
+    with factory() as db:
+        users = [User(email=f"user{i}@example.com", username=f"user{i}", hashed_password="x") for i in range(count)]
+        db.add_all(users)
+        db.commit()
+        return [(user.id, user.username) for user in users]
+
+
+def test_users_live_on_their_home_shard(sharded):
+    factory, engines, _ = sharded
+    users, directory = User.__table__, models.UserDirectory.__table__
+    for user_id, username in _add_users(factory, 12):
+        shard = int(sharding.home_shard(user_id))
+        with engines[shard].connect() as conn:
+            assert conn.execute(select(users.c.username).where(users.c.id == user_id)).scalar() == username
+        # Directory keys ignore case, like the SQL Server collation
+        key = sharding.directory_key("username", username.upper())
+        with engines[0].connect() as conn:
+            assert conn.execute(select(directory.c.shard).where(directory.c.lookup_key == key)).scalar() == shard
+
+
+def test_lookups_read_the_directory_then_one_shard(sharded):
+    factory, _, statements = sharded
+    users = _add_users(factory, 6)
+    user_id, username = users[-1]
+    statements.clear()
+    with factory() as db:
+        found = db.query(User).filter(User.username == username).first()
+    assert found.id == user_id
+    # The /token budget allows exactly this one extra statement when sharded
+    assert statements == [0, int(sharding.home_shard(user_id))]
+
+
+def test_shard_claim_skips_the_directory(sharded):
+    factory, _, statements = sharded
+    user_id, _ = _add_users(factory, 3)[0]
+    shard = int(sharding.home_shard(user_id))
+    statements.clear()
+    with factory() as db:
+        assert sharding.get_user(db, user_id, shard).id == user_id
+    assert statements == [shard]
+
+
+def test_other_queries_scatter(sharded):
+    factory, _, statements = sharded
+    _add_users(factory, 9)
+    statements.clear()
+    with factory() as db:
+        assert len(db.query(User).filter(User.role == "user").all()) == 9
+    assert sorted(statements) == [0, 1, 2]
+
+
+def test_move_keeps_writes_made_during_the_move(sharded, monkeypatch):
+    factory, engines, _ = sharded
+    monkeypatch.setattr(rebalance_shards, "shard_engines", engines)
+    monkeypatch.setattr(rebalance_shards, "directory_engine", engines[0])
+    users, directory = User.__table__, models.UserDirectory.__table__
+    user_id = next(user_id for user_id, _ in _add_users(factory, 12) if sharding.home_shard(user_id) == "1")
+    with engines[1].connect() as conn:
+        batch = conn.execute(select(users).where(users.c.id == user_id)).all()
+
+    # A request changes the user after the batch was read, before it is moved
+    with factory() as db:
+        sharding.get_user(db, user_id, "1").hashed_password = "changed"
+        db.commit()
+    statements = []
+    for shard_id, engine in enumerate(engines):
+        event.listen(engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args, shard_id=shard_id: statements.append((shard_id, statement.split()[0])))
+    rebalance_shards.move_users(1, 2, batch)
+    moved = list(statements)
+
+    with engines[2].connect() as conn:
+        assert conn.execute(select(users.c.hashed_password).where(users.c.id == user_id)).scalar() == "changed"
+    with engines[1].connect() as conn:
+        assert conn.execute(select(users.c.id).where(users.c.id == user_id)).first() is None
+    with engines[0].connect() as conn:
+        assert set(conn.execute(select(directory.c.shard).where(directory.c.user_id == user_id)).scalars()) == {2}
+    # Once the directory points at the new shard, the move no longer writes to it
+    switch = moved.index((0, "UPDATE"))
+    assert all(shard_id != 2 for shard_id, _ in moved[switch:])
+
+
+def test_budgets_grow_with_the_shards(sharded):
+    assert query_stats.budget_for("/token") == query_stats.QUERY_BUDGETS["/token"] + 1
+    assert query_stats.budget_for("/admin/users") == query_stats.QUERY_BUDGETS["/admin/users"] * 3
+    assert query_stats.budget_for("/me") == 0
+
+
+def test_budgets_unchanged_without_shards():
+    assert query_stats.budget_for("/token") == query_stats.QUERY_BUDGETS["/token"]
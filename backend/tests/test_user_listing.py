@@ -0,0 +1,117 @@
+import base64
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, update
+
+from app import models, user_listing
+
+users = models.User.__table__
+
+
+@pytest.fixture
+def listed(db):
+    """Users under a role of their own: three without created_at, four created at the same moment, two later."""
+    role = f"r{uuid.uuid4().hex[:12]}"
+    moment = datetime(2024, 1, 1, 12, 0, 0)
+    created = [None] * 3 + [moment] * 4 + [moment + timedelta(seconds=1), moment + timedelta(days=1)]
+    rows = []
+    for created_at in created:
+        name = uuid.uuid4().hex[:12]
+        rows.append({"id": str(uuid.uuid4()), "email": f"{name}@example.com", "username": name,
+                     "hashed_password": "x", "role": role, "is_active": True,
+                     "created_at": created_at, "updated_at": moment})
+    db.execute(insert(users), rows)
+    db.commit()
+    expected = [row["id"] for row in sorted(rows, key=lambda row: (row["created_at"] is not None,
+                                                                     row["created_at"] or datetime.min, row["id"]))]
+    return role, expected
+
+
+@pytest.fixture
+def admin(client, register, db):
+    user, _, _ = register()
+    db.execute(update(users).where(users.c.id == user["id"]).values(role="admin"))
+    db.commit()
+    login = client.post("/token", data={"username": user["username"], "password": "Test-pass-2024"})
+    return {"Authorization": f"Bearer {login.json()['access_token']}"}
+
+
+def test_pages_cover_every_row_once(db, listed):
+    role, expected = listed
+    seen, cursor = [], None
+    while True:
+        page = user_listing.list_users(db, ("id", "created_at"), limit=2, cursor=cursor, role=role)
+        seen += [item["id"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    # Pages break inside the NULL created_at rows and inside the rows sharing one created_at
+    assert seen == expected
+
+
+def test_cursor_within_rows_without_created_at(db, listed):
+    role, expected = listed
+    cursor = user_listing.encode_cursor(None, expected[0])
+    page = user_listing.list_users(db, ("id", "created_at"), limit=3, cursor=cursor, role=role)
+    assert [item["id"] for item in page["items"]] == expected[1:4]
+    assert page["items"][1]["created_at"] is None and page["items"][2]["created_at"] is not None
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    _b64(b"not json"),
+    _b64(b'["2024-01-01T00:00:00"]'),
+    _b64(b'["yesterday", "some-id"]'),
+    _b64(b"42"),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        user_listing.decode_cursor(cursor)
+
+
+def test_listing_endpoint_rejects_bad_input(client, admin):
+    assert client.get("/admin/users", params={"cursor": "not a cursor"}, headers=admin).status_code == 400
+    assert client.get("/admin/users", params={"fields": "hashed_password"}, headers=admin).status_code == 400
+
+
+def test_csv_export(client, admin, listed):
+    role, expected = listed
+    response = client.get("/admin/users/export", params={"format": "csv", "role": role, "fields": "id,username"},
+                          headers=admin)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "username", "created_at"]
+    assert [row[0] for row in rows[1:]] == expected
+
+
+def test_ndjson_export(client, admin, listed):
+    role, expected = listed
+    response = client.get("/admin/users/export", params={"role": role}, headers=admin)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == expected
+    assert set(lines[0]) == set(user_listing.LISTABLE_COLUMNS)
+
+
+def test_export_busy(client, admin, listed):
+    role, _ = listed
+    assert user_listing._export_slots.acquire(blocking=False)
+    try:
+        response = client.get("/admin/users/export", params={"role": role}, headers=admin)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "30"
+    finally:
+        user_listing._export_slots.release()
+    # A finished export gives its slot back
+    assert client.get("/admin/users/export", params={"role": role}, headers=admin).status_code == 200
+    assert client.get("/admin/users/export", params={"role": role}, headers=admin).status_code == 200
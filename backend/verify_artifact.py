@@ -0,0 +1,83 @@
+"""
+Check a deployment artifact built by build_artifact.py before starting it.
+
+Fails when the interpreter or platform differs from the build's (the
+precompiled bytecode and native wheels would not load), or when any file
+differs from the manifest: missing, changed, or an unexpected importable
+file (.py, .pyc, .so, .pth). Other new files, such as logs or a SQLite
+database, are allowed. start_artifact.sh runs this before gunicorn.
+
+Usage: python verify_artifact.py [artifact directory, default: this file's directory]
+"""
+import hashlib
+import json
+import os
+import sys
+import sysconfig
+import time
+from typing import Dict, List
+
+MANIFEST = "MANIFEST.json"
+IMPORTABLE = (".py", ".pyc", ".so", ".pth")
+
+
+def file_hashes(root: str) -> Dict[str, str]:
+    """SHA-256 of every file under root, by relative path, except the manifest."""
+    hashes = {}
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            if relative == MANIFEST:
+                continue
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            hashes[relative] = digest.hexdigest()
+    return hashes
+
+
+def runtime() -> Dict[str, str]:
+    return {"python": sys.implementation.cache_tag, "platform": sysconfig.get_platform()}
+
+
+def verify(root: str) -> List[str]:
+    """Everything wrong with the artifact at root; empty when it is intact."""
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        return [f"Cannot read {MANIFEST}: {e}"]
+
+    problems = [
+        f"Built for {key} {manifest.get(key)}, running on {value}"
+        for key, value in runtime().items() if manifest.get(key) != value
+    ]
+    expected, actual = manifest.get("files", {}), file_hashes(root)
+    for path, digest in expected.items():
+        if path not in actual:
+            problems.append(f"Missing: {path}")
+        elif actual[path] != digest:
+            problems.append(f"Changed: {path}")
+    for path in actual.keys() - expected.keys():
+        if path.endswith(IMPORTABLE):
+            problems.append(f"Unexpected: {path}")
+    return problems
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    problems = verify(root)
+    if problems:
+        print(f"Artifact check failed ({len(problems)} problems):", file=sys.stderr)
+        for problem in problems[:50]:
+            print(f"  {problem}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Artifact verified in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()